@@ -0,0 +1,74 @@
+"""
+Benchmark truncating long posts: closing open tags with close_open_tags vs BeautifulSoup.
+
+Posts are generated in telegram html (as message.html_text) and truncated to their first
+chunk the way BasePost.truncate_post_text does. BeautifulSoup is no longer a dependency of
+the bot, it is installed with the development requirements:
+
+    pip install -r requirements-dev.txt
+    python src/benchmarks/truncate_post_text.py
+"""
+import random
+import sys
+import timeit
+
+from loguru import logger
+from src.constants import MESSAGE_SPLIT_CHAR_LIMIT, POST_CHAR_LIMIT
+from src.utils.html_tags import close_open_tags
+from telebot import util
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    sys.exit('BeautifulSoup is required to run the benchmark: pip install -r requirements-dev.txt')
+
+NUM_POSTS = 100
+NUM_REPEATS = 5
+TAG_TEMPLATES = [
+    '<b>{}</b>', '<i>{}</i>', '<u>{}</u>', '<s>{}</s>', '<code>{}</code>',
+    '<pre>{}</pre>', '<a href="https://example.com">{}</a>',
+]
+
+
+def generate_post(num_characters: int, seed: int) -> str:
+    """
+    Generate a post of plain words and formatted words, with lines of code in pre tags.
+    """
+    rand = random.Random(seed)
+    parts, length = [], 0
+    while length < num_characters:
+        words = ' '.join(rand.choice(['lorem', 'ipsum', 'dolor', 'sit', 'amet.', 'x &lt; y']) for _ in range(8))
+        if rand.random() < 0.3:
+            words = rand.choice(TAG_TEMPLATES).format(words.replace(' ', '\n    ', 1))
+        parts.append(words)
+        length += len(words) + 1
+    return ' '.join(parts)
+
+
+def first_chunk(post_text: str) -> str:
+    return util.smart_split(post_text, chars_per_string=MESSAGE_SPLIT_CHAR_LIMIT)[0]
+
+
+def close_tags_with_beautifulsoup(text: str) -> str:
+    return BeautifulSoup(text, 'html.parser').prettify()
+
+
+def is_balanced(text: str) -> bool:
+    return BeautifulSoup(text, 'html.parser').decode() == text
+
+
+if __name__ == '__main__':
+    num_characters = max(POST_CHAR_LIMIT.values())
+    posts = [generate_post(num_characters, seed) for seed in range(NUM_POSTS)]
+    chunks = [first_chunk(post_text) for post_text in posts]
+    assert all(is_balanced(close_open_tags(chunk)) for chunk in chunks)
+
+    logger.info(f'Truncating {NUM_POSTS} posts of {num_characters} characters, best of {NUM_REPEATS}...')
+    benchmarks = [
+        ('smart_split (same for both)', first_chunk, posts),
+        ('close_open_tags', close_open_tags, chunks),
+        ('beautifulsoup', close_tags_with_beautifulsoup, chunks),
+    ]
+    for name, func, texts in benchmarks:
+        seconds = min(timeit.repeat(lambda: [func(text) for text in texts], number=1, repeat=NUM_REPEATS))
+        logger.info(f'{name}: {seconds / NUM_POSTS * 1e6:.1f} us per post')
@@ -7,6 +7,8 @@ from telebot import apihelper
 apihelper.ENABLE_MIDDLEWARE = True
 
 # Initialize bot
+# Handlers run in the thread that processes the update (see src/dispatcher.py),
+# the worker pool of telebot would not keep the order of updates of a chat.
 bot = telebot.TeleBot(
-    os.environ['TELEGRAMBOT_TOKEN'], parse_mode='HTML'
+    os.environ['TELEGRAMBOT_TOKEN'], parse_mode='HTML', threaded=False
 )
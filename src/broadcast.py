@@ -0,0 +1,311 @@
+import concurrent.futures
+import datetime
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Iterable
+
+import requests
+from bson.objectid import ObjectId
+from loguru import logger
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError
+from telebot.apihelper import ApiTelegramException
+
+from src import constants
+from src.utils.common import chunked_iterable
+from src.utils.rate_limit import RateLimiter
+
+# Shared by all broadcasts of the process, so that together they stay within Telegram limits.
+rate_limiter = RateLimiter(
+    rate=constants.BROADCAST_MESSAGES_PER_SECOND,
+    chat_rate=constants.BROADCAST_CHAT_MESSAGES_PER_SECOND,
+)
+
+broadcast_status = SimpleNamespace(
+    RUNNING='running',
+    DONE='done',
+)
+
+delivery_status = SimpleNamespace(
+    PENDING='pending',
+    SENT='sent',
+    FAILED='failed',
+)
+
+
+class Broadcast:
+    """
+    Send a post to many users within Telegram rate limits.
+
+    Audience is either a list of chat ids or a query on users collection. Query audiences are
+    streamed from a cursor in _id order and progress is checkpointed in broadcasts collection
+    after each batch, so that a broadcast interrupted by a restart resumes where it stopped.
+
+    Each recipient of a query audience is claimed in broadcast_deliveries as pending before the post
+    is sent to them, and the claim is set to sent or failed after the send. On resume, recipients
+    that were sent the post are skipped, and pending or failed claims of the interrupted run are sent
+    again once their lease (BROADCAST_CLAIM_LEASE) expires. Claims are removed when the broadcast is
+    done, or by their TTL index.
+    """
+    def __init__(self, post, chat_ids: Iterable = None, query: dict = None):
+        """
+        :param post: Post handler (Question, Answer, Comment) to send.
+        :param chat_ids: Chat ids to send post to. Not checkpointed.
+        :param query: Users collection query of the audience, used if chat_ids is None.
+        """
+        self.post = post
+        self.db = post.db
+        self.chat_ids = chat_ids
+        self.query = query if query is not None else {}
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+        # Claims of recipients made by this run of the broadcast
+        self.run_id = ObjectId()
+
+        # Post is rendered once for the whole audience
+        self.post_text = None
+        self.shared_keys = None
+
+    @classmethod
+    def resume_all(cls, db, stackbot) -> None:
+        """
+        Resume broadcasts that were interrupted before they were done.
+        """
+        from src.user import User
+
+        for doc in db.broadcasts.find({'status': broadcast_status.RUNNING}):
+            post = db.post.find_one({'_id': doc['post_id']}, {'type': 1})
+            if not post:
+                continue
+
+            logger.info(f'Resuming broadcast of post {doc["post_id"]}...')
+            post_handler = User.get_post_handler(None, post['type'])(db=db, stackbot=stackbot, post_id=doc['post_id'])
+            cls(post_handler, query=doc['query']).start()
+
+    def start(self) -> threading.Thread:
+        """
+        Run broadcast in a background thread.
+
+        Post is rendered before the thread starts, with the lookups of the update that started it.
+        """
+        self.render()
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self) -> Counter:
+        """
+        Send post to the whole audience.
+
+        :return: Delivery stats: number of sent, failed and retried messages.
+        """
+        if self.post_text is None:
+            self.render()
+
+        if self.chat_ids is not None:
+            # Users may be in the audience more than once, e.g. post owner who follows the post.
+            self.send_batch(list(dict.fromkeys(self.chat_ids)))
+            return self.stats
+
+        checkpoint = self.load_checkpoint()
+        self.stats.update(checkpoint.get('stats', {}))
+        for batch in chunked_iterable(self.get_audience(checkpoint.get('last_user_id')), constants.BROADCAST_BATCH_SIZE):
+            chat_ids = self.claim_recipients([user['chat']['id'] for user in batch])
+            self.update_claims(self.send_batch(chat_ids))
+            self.save_checkpoint(last_user_id=batch[-1]['_id'])
+
+        self.resend_interrupted_claims()
+        self.save_checkpoint(status=broadcast_status.DONE)
+        self.db.broadcast_deliveries.delete_many({'post_id': self.post.post_id})
+        logger.info(f'Broadcast of post {self.post.post_id} is done: {dict(self.stats)}')
+        return self.stats
+
+    def get_audience(self, last_user_id=None):
+        query = dict(self.query)
+        if last_user_id is not None:
+            query = {'$and': [query, {'_id': {'$gt': last_user_id}}]}
+
+        return self.db.users.find(query, {'chat.id': 1}).sort('_id', 1)
+
+    def claim_recipients(self, chat_ids: list) -> list:
+        """
+        Claim recipients of the post as pending before it is sent to them.
+
+        Recipients claimed before (by the same broadcast before a restart) are left out, unless their
+        claim is pending or failed and its lease has expired.
+
+        :param chat_ids: Unique ids of the users in a batch of the audience.
+        :return: Unique ids of the users to send the post to.
+        """
+        chat_ids = list(dict.fromkeys(chat_ids))
+        if not chat_ids:
+            return []
+
+        claimed_at = datetime.datetime.utcnow()
+        docs = [
+            {
+                'post_id': self.post.post_id, 'chat_id': chat_id, 'run_id': self.run_id,
+                'status': delivery_status.PENDING, 'claimed_at': claimed_at,
+            }
+            for chat_id in chat_ids
+        ]
+        try:
+            self.db.broadcast_deliveries.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate key errors are recipients that are already claimed
+            claimed = {docs[error['index']]['chat_id'] for error in e.details['writeErrors'] if error['code'] == 11000}
+            if len(claimed) != len(e.details['writeErrors']):
+                raise
+
+            reclaimed = {chat_id for chat_id in claimed if self.reclaim(chat_id)}
+            self.stats['skipped'] += len(claimed) - len(reclaimed)
+            chat_ids = [chat_id for chat_id in chat_ids if chat_id not in claimed or chat_id in reclaimed]
+
+        return chat_ids
+
+    def reclaim(self, chat_id: int) -> bool:
+        """
+        Claim a recipient again if the post was not sent to them and the lease of their claim has expired.
+
+        :param chat_id: Unique id of the user.
+        :return: True if the recipient is claimed by this run.
+        """
+        now = datetime.datetime.utcnow()
+        claim = self.db.broadcast_deliveries.find_one_and_update(
+            {
+                'post_id': self.post.post_id, 'chat_id': chat_id,
+                'status': {'$in': [delivery_status.PENDING, delivery_status.FAILED]},
+                'claimed_at': {'$lt': now - datetime.timedelta(seconds=constants.BROADCAST_CLAIM_LEASE)},
+            },
+            {'$set': {'run_id': self.run_id, 'status': delivery_status.PENDING, 'claimed_at': now}},
+        )
+        return claim is not None
+
+    def update_claims(self, deliveries: dict) -> None:
+        """
+        Set claims of the recipients to sent or failed after the post is sent to them.
+
+        :param deliveries: Whether the post is delivered, by unique id of the user.
+        """
+        for delivered, status in [(True, delivery_status.SENT), (False, delivery_status.FAILED)]:
+            chat_ids = [chat_id for chat_id, is_delivered in deliveries.items() if is_delivered is delivered]
+            if chat_ids:
+                self.db.broadcast_deliveries.update_many(
+                    {'post_id': self.post.post_id, 'chat_id': {'$in': chat_ids}, 'run_id': self.run_id},
+                    {'$set': {'status': status}},
+                )
+
+    def resend_interrupted_claims(self) -> None:
+        """
+        Send the post again to recipients whose claims were left pending or failed by an earlier run.
+
+        Claims of checkpointed batches are not in the audience of this run. They are sent again once
+        their lease expires, so that a run that is still sending them is not raced.
+        """
+        query = {
+            'post_id': self.post.post_id, 'run_id': {'$ne': self.run_id},
+            'status': {'$in': [delivery_status.PENDING, delivery_status.FAILED]},
+        }
+        while True:
+            oldest_claim = self.db.broadcast_deliveries.find_one(query, sort=[('claimed_at', 1)])
+            if oldest_claim is None:
+                return
+
+            lease_end = oldest_claim['claimed_at'] + datetime.timedelta(seconds=constants.BROADCAST_CLAIM_LEASE)
+            time.sleep(max((lease_end - datetime.datetime.utcnow()).total_seconds(), 0))
+
+            claims = self.db.broadcast_deliveries.find(query, {'chat_id': 1}).sort('claimed_at', 1)
+            chat_ids = [claim['chat_id'] for claim in claims.limit(constants.BROADCAST_BATCH_SIZE)]
+            self.update_claims(self.send_batch([chat_id for chat_id in chat_ids if self.reclaim(chat_id)]))
+
+    def render(self) -> None:
+        """
+        Render post text and the keys that are the same for all users.
+        """
+        self.post_text = self.post.get_text()
+        self.shared_keys = self.post.get_shared_keys()
+
+    def send_batch(self, chat_ids: Iterable) -> dict:
+        """
+        Send post to a batch of users in parallel.
+
+        :param chat_ids: Unique ids of the users.
+        :return: Whether the post is delivered, by unique id of the user.
+        """
+        # Like status is the only part of the keyboard that depends on the user
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return {}
+
+        likers = self.post.get_likers(chat_ids)
+
+        deliveries = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=constants.BROADCAST_MAX_WORKERS) as executor:
+            for chat_id, delivered in zip(chat_ids, executor.map(lambda chat_id: self.send(chat_id, chat_id in likers), chat_ids)):
+                deliveries[chat_id] = delivered
+                self.count('sent' if delivered else 'failed')
+
+        return deliveries
+
+    def send(self, chat_id: int, liked_by_user: bool = False) -> bool:
+        """
+        Send post to one chat, retrying with exponential backoff.
+
+        :param chat_id: Unique id of the user.
+        :param liked_by_user: If True, user has liked the post.
+        :return: True if post is delivered.
+        """
+        post_keyboard = self.post.get_viewer_keyboard(*self.shared_keys, liked_by_user=liked_by_user)
+        for attempt in range(constants.BROADCAST_MAX_RETRIES + 1):
+            if attempt:
+                self.count('retried')
+
+            rate_limiter.acquire(chat_id)
+            try:
+                self.post.send_to_one(chat_id, post_text=self.post_text, post_keyboard=post_keyboard)
+                return True
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    # Flood control: Telegram tells us how long to wait before sending anything else.
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    rate_limiter.pause(retry_after)
+                    continue
+                elif e.error_code in [400, 403]:
+                    # Bot is blocked by the user, chat not found, etc. Retrying won't help.
+                    logger.debug(f'Could not send post to {chat_id}: {e.description}')
+                    return False
+                logger.debug(f'Error sending post to {chat_id}: {e}')
+            except requests.exceptions.ConnectionError as e:
+                # Request did not reach Telegram, so it is safe to send again
+                logger.debug(f'Error sending post to {chat_id}: {e}')
+            except Exception as e:
+                # Post may have been delivered (e.g. read timeout), sending again could send it twice
+                logger.debug(f'Error sending post to {chat_id}: {e}')
+                return False
+
+            time.sleep(constants.BROADCAST_RETRY_BACKOFF * 2 ** attempt)
+
+        return False
+
+    def count(self, key: str) -> None:
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def load_checkpoint(self) -> dict:
+        return self.db.broadcasts.find_one_and_update(
+            {'post_id': self.post.post_id},
+            {
+                '$set': {'status': broadcast_status.RUNNING},
+                '$setOnInsert': {'query': self.query, 'created_at': time.time()},
+            },
+            upsert=True, return_document=ReturnDocument.AFTER,
+        )
+
+    def save_checkpoint(self, **kwargs) -> None:
+        self.db.broadcasts.update_one(
+            {'post_id': self.post.post_id},
+            {'$set': {'updated_at': time.time(), 'stats': dict(self.stats), **kwargs}},
+        )
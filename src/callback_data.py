@@ -0,0 +1,94 @@
+import base64
+import binascii
+import struct
+
+from bson.objectid import ObjectId
+from telebot import types
+
+from src.constants import callback_actions, callback_codes
+from src.data_models.gallery import Gallery
+
+# Encoded callback data is CALLBACK_DATA_PREFIX + urlsafe base64 of the binary payload (49 bytes at most).
+# Telegram allows 64 bytes of callback data. The prefix is not in the base64 alphabet, so encoded
+# callback data is told apart from action codes and prefixed callback data (e.g. file:).
+CALLBACK_DATA_PREFIX = '#'
+CALLBACK_DATA_VERSION = 1
+
+# version, action code, post id
+HEADER = struct.Struct('>B3s12s')
+# gallery session id, total, position (only for messages in a browsable gallery)
+GALLERY = struct.Struct('>12sII')
+NULL_ID = bytes(12)
+
+
+class CallbackData:
+    """
+    Self-describing callback data of inline keys: action, post and gallery of the message.
+
+    Everything a callback needs to know about its message travels with the button, so callbacks
+    are handled without looking up the message in database or parsing its text.
+    """
+    def __init__(self, action: str, post_id: ObjectId = None, gallery: Gallery = None):
+        """
+        :param action: Inline key of the button.
+        :param post_id: Unique id of the post shown in the message.
+        :param gallery: Gallery the post is browsed in (if any).
+        """
+        self.action = action
+        self.post_id = post_id
+        self.gallery = gallery
+
+    def encode(self) -> str:
+        post_id = ObjectId(self.post_id).binary if self.post_id else NULL_ID
+        payload = HEADER.pack(CALLBACK_DATA_VERSION, callback_codes[self.action].encode(), post_id)
+
+        if self.gallery is not None and self.gallery.is_browsable:
+            payload += GALLERY.pack(self.gallery.save().binary, self.gallery.total, self.gallery.position or 0)
+
+        return CALLBACK_DATA_PREFIX + base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+    @classmethod
+    def decode(cls, db, data: str):
+        """
+        :param db: MongoDB connection, used by the gallery to load its session when needed.
+        :param data: Callback data of the button.
+        :return: CallbackData or None if data is not encoded by this version.
+        """
+        if not data.startswith(CALLBACK_DATA_PREFIX):
+            return
+
+        encoded = data[len(CALLBACK_DATA_PREFIX):]
+        try:
+            payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+            version, code, post_id = HEADER.unpack_from(payload)
+        except (binascii.Error, struct.error):
+            return
+
+        if version != CALLBACK_DATA_VERSION:
+            return
+
+        gallery = None
+        if len(payload) == HEADER.size + GALLERY.size:
+            session_id, total, position = GALLERY.unpack_from(payload, HEADER.size)
+            gallery = Gallery(db, session_id=ObjectId(session_id), total=total, position=position or None)
+
+        code = code.decode()
+        return cls(
+            action=callback_actions.get(code, code),
+            post_id=ObjectId(post_id) if post_id != NULL_ID else None,
+            gallery=gallery,
+        )
+
+    @classmethod
+    def encode_keyboard(cls, reply_markup: types.InlineKeyboardMarkup, post_id: ObjectId = None, gallery: Gallery = None):
+        """
+        Encode action codes of inline keyboard buttons with the post and gallery of the message.
+        Buttons with other callback data (e.g. file:) and already encoded buttons are kept as they are.
+        """
+        for row in reply_markup.keyboard:
+            for button in row:
+                action = callback_actions.get(button.callback_data)
+                if action is not None:
+                    button.callback_data = cls(action, post_id, gallery).encode()
+
+        return reply_markup
@@ -1,6 +1,7 @@
 from types import SimpleNamespace
 
 from src.data import DATA_DIR
+from src.utils.emojis import load_constants
 from src.utils.io import read_file
 from src.utils.keyboard import create_keyboard
 
@@ -62,6 +63,9 @@ inline_keys = SimpleNamespace(
     show_more=u'\u2193 Show More',
     show_less=u'\u2191 Show Less',
     export_gallery=':inbox_tray: Export',
+    export_html=':page_facing_up: HTML',
+    export_jsonl=':bar_chart: JSON Lines',
+    export_zip=':package: ZIP Bundle',
     bookmark=':pushpin: Bookmark',
     unbookmark=':pushpin: Unbookmark',
     attachments=':paperclip:',
@@ -104,10 +108,59 @@ inline_keys_groups = {
     inline_keys.last_page: 9 + 20,
 }
 
+# Inline keys send a compact action code as callback data instead of their text, and callbacks
+# are dispatched by the code. Codes are kept when keys are renamed, as old messages still send them.
+callback_codes = {
+    inline_keys.actions: 'act',
+    inline_keys.back: 'bck',
+    inline_keys.answer: 'ans',
+    inline_keys.follow: 'flw',
+    inline_keys.unfollow: 'ufl',
+    inline_keys.like: 'lik',
+    inline_keys.unlike: 'ulk',
+    inline_keys.accept: 'acc',
+    inline_keys.unaccept: 'uac',
+    inline_keys.comment: 'cmt',
+    inline_keys.delete: 'del',
+    inline_keys.undelete: 'udl',
+    inline_keys.open: 'opn',
+    inline_keys.close: 'cls',
+    inline_keys.edit: 'edt',
+    inline_keys.change_identity: 'cid',
+    inline_keys.ananymous: 'ian',
+    inline_keys.first_name: 'ifn',
+    inline_keys.username: 'iun',
+    inline_keys.alias: 'ial',
+    inline_keys.mute: 'mut',
+    inline_keys.unmute: 'umt',
+    inline_keys.show_comments: 'scm',
+    inline_keys.show_answers: 'san',
+    inline_keys.original_post: 'org',
+    inline_keys.next_post: 'nxt',
+    inline_keys.page_number: 'pgn',
+    inline_keys.prev_post: 'prv',
+    inline_keys.last_page: 'lst',
+    inline_keys.first_page: 'fst',
+    inline_keys.show_more: 'smr',
+    inline_keys.show_less: 'sls',
+    inline_keys.export_gallery: 'exp',
+    inline_keys.export_html: 'exh',
+    inline_keys.export_jsonl: 'exj',
+    inline_keys.export_zip: 'exz',
+    inline_keys.bookmark: 'bkm',
+    inline_keys.unbookmark: 'ubk',
+    inline_keys.attachments: 'att',
+}
+callback_actions = {code: key for key, code in callback_codes.items()}
+
+# Callback data of attachment keys: FILE_CALLBACK_PREFIX + file_unique_id
+FILE_CALLBACK_PREFIX = 'file:'
+
 
 keyboards = SimpleNamespace(
     main=create_keyboard(keys.ask_question, keys.search_questions, keys.my_data, keys.settings),
     send_post=create_keyboard(keys.cancel, keys.send_post),
+    search=create_keyboard(keys.back),
     my_data=create_keyboard(
         keys.my_questions, keys.my_answers, keys.my_comments, keys.my_bookmarks,
         keys.back, reply_row_width=2),
@@ -159,6 +212,12 @@ EMOJI = {
     post_types.COMMENT: ':speech_balloon:',
 }
 
+# Denormalized counters of open replies kept on the replied to post
+REPLY_COUNTER_FIELDS = {
+    post_types.ANSWER: 'num_answers',
+    post_types.COMMENT: 'num_comments',
+}
+
 HTML_ICON = {
     post_types.QUESTION: '&#10067;',
     post_types.ANSWER: '&#11088;',
@@ -201,6 +260,69 @@ DELETE_BOT_MESSAGES_AFTER_TIME = 1
 DELETE_USER_MESSAGES_AFTER_TIME = 1
 DELETE_FILE_MESSAGES_AFTER_TIME = 1 * 60 * 60
 
+# Renders of auto updated messages (e.g. gallery page flips) are written in batches
+AUTO_UPDATE_FLUSH_INTERVAL = 5  # seconds, less than the UPDATE_DELAY of the auto update job
+
+# Broadcasting posts: Telegram allows about 30 messages per second overall and 1 per second per chat
+BROADCAST_MESSAGES_PER_SECOND = 25
+BROADCAST_CHAT_MESSAGES_PER_SECOND = 1
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_MAX_WORKERS = 8
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_RETRY_BACKOFF = 1  # seconds, doubled on every retry
+BROADCAST_CLAIM_LEASE = 10 * 60  # seconds before a pending or failed recipient of a resumed broadcast is sent again
+BROADCAST_DELIVERY_TTL = 30 * 24 * 60 * 60  # seconds, claims of broadcasts that never finish are removed
+
+# Webhook mode
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024  # bytes, larger requests are rejected before they are read
+
+# Updates are processed in order per chat on lanes, chats of different lanes in parallel
+DISPATCHER_NUM_LANES = 8
+DISPATCHER_MAX_QUEUE_SIZE = 1000  # per lane
+DISPATCHER_STATS_INTERVAL = 60  # seconds between stats stored in database
+
+# Process-wide cache of hot user documents between updates (set max size to 0 to disable).
+# Writes to users by other processes (jobs, export workers) are seen by the bot after at most USER_CACHE_TTL.
+USER_CACHE_MAX_SIZE = 10000
+USER_CACHE_TTL = 60  # seconds
+
+# Gallery sessions expire when not used for GALLERY_SESSION_TTL. Warm sessions are cached in memory.
+GALLERY_SESSION_TTL = 7 * 24 * 60 * 60  # seconds
+GALLERY_SESSION_CACHE_MAX_SIZE = 10000
+GALLERY_SESSION_CACHE_TTL = 10 * 60  # seconds
+GALLERY_WINDOW_SIZE = 20  # posts fetched ahead on every gallery query
+GALLERY_MAX_WINDOW_SIZE = 100
+GALLERY_PREFETCH_MARGIN = 5  # window is refilled when the user is this close to its edge
+GALLERY_PREFETCH_WORKERS = 4
+
+# Export format of each export key. The zip bundle has the html, jsonl and a csv manifest of the attachments.
+EXPORT_FORMATS = {
+    inline_keys.export_html: 'html',
+    inline_keys.export_jsonl: 'jsonl',
+    inline_keys.export_zip: 'zip',
+}
+
+# Gallery exports read EXPORT_BATCH_SIZE posts (and their answers) per batch. They are rendered in
+# EXPORT_MAX_WORKERS processes and each user can have EXPORT_MAX_JOBS_PER_USER exports queued or running.
+EXPORT_BATCH_SIZE = 100
+EXPORT_MAX_WORKERS = 2
+EXPORT_MAX_JOBS_PER_USER = 1
+EXPORT_PROGRESS_INTERVAL = 5  # seconds between updates of the progress message
+
+# Full-text search of questions (BM25). The index is stored in SEARCH_INDEX_DIR and
+# the journal of changes is folded into a new snapshot every SEARCH_INDEX_COMPACT_AFTER changes.
+SEARCH_INDEX_DIR = DATA_DIR / 'search_index'
+SEARCH_INDEX_COMPACT_AFTER = 1000
+SEARCH_MAX_RESULTS = GALLERY_MAX_WINDOW_SIZE  # ranked galleries are held in their window
+SEARCH_BM25_K1 = 1.5
+SEARCH_BM25_B = 0.75
+
+# Open questions this similar (TF-IDF cosine similarity) to a new question are shown before it is sent
+SIMILAR_QUESTIONS_LIMIT = 3
+SIMILAR_QUESTIONS_MIN_SCORE = 0.5
+
 # Constant Text Messages
 # General Templates
 HOW_TO_ASK_QUESTION_GUIDE = read_file(DATA_DIR / 'guide.html')
@@ -263,3 +385,33 @@ SETTINGS_START_MESSAGE = (
 
 # Gallery Templates
 GALLERY_NO_POSTS_MESSAGE = ':red_exclamation_mark: No {post_type} found.'
+GALLERY_EXPIRED_MESSAGE = ':hourglass_done: This list has expired, please open it again.'
+
+# Export Templates
+EXPORT_STARTED_MESSAGE = (
+    ':hourglass_not_done: Exporting <strong>{num_posts}</strong> post(s), the file will be sent shortly...'
+)
+EXPORT_PROGRESS_MESSAGE = (
+    ':hourglass_not_done: Exporting <strong>{num_posts}</strong> post(s)... <strong>{percent}%</strong>'
+)
+EXPORT_DONE_MESSAGE = ':check_mark_button: Export is ready.'
+EXPORT_FAILED_MESSAGE = ':cross_mark: Export failed, please try again.'
+EXPORT_IN_PROGRESS_MESSAGE = ':hourglass_not_done: Your previous export is not finished yet.'
+
+# Search Templates
+SEARCH_START_MESSAGE = (
+    ':magnifying_glass_tilted_right: Send the <strong>keywords</strong> you are looking for.\n\n'
+    f'When done, click <strong>{keys.back}</strong>.'
+)
+SEARCH_NO_RESULTS_MESSAGE = ':red_exclamation_mark: No question found for <strong>{query}</strong>.'
+SIMILAR_QUESTIONS_MESSAGE = (
+    ':warning: <strong>{num_questions}</strong> similar question(s) already asked, they may answer yours.\n\n'
+    f'If your question is different, click <strong>{keys.send_post}</strong> again.'
+)
+
+# Emojize constant texts once, so sending them (and demojizing the keys users click) is a table lookup
+load_constants(
+    *vars(keys).values(), *vars(inline_keys).values(),
+    *vars(post_status).values(), *vars(user_identity).values(), *EMOJI.values(),
+    *[value for name, value in list(globals().items()) if name.isupper() and isinstance(value, str)],
+)
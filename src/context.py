@@ -0,0 +1,32 @@
+class UpdateContext:
+    """
+    Context of a single telegram update (message or callback query).
+
+    It is created by the handlers middleware and attached to the update object as `context`,
+    so every handler receives the user, post and lookups of its own update. Nothing about the
+    update is stored on the shared StackBot instance, which makes it safe to process updates
+    of different chats in parallel.
+    """
+    def __init__(self, user):
+        """
+        :param user: User who sent the update.
+        """
+        self.user = user
+
+    @property
+    def post(self):
+        """
+        Post handler of the post the update is about.
+        """
+        return self.user.post
+
+    @post.setter
+    def post(self, post_handler):
+        self.user.post = post_handler
+
+    @property
+    def identity_map(self):
+        """
+        Posts loaded during the update.
+        """
+        return self.user.identity_map
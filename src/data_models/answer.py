@@ -1,7 +1,9 @@
-from bson.objectid import ObjectId
+import time
+
 from src import constants
 from src.constants import inline_keys, post_status, post_types
 from src.data_models.base import BasePost
+from src.search import search_index
 from src.utils.keyboard import create_keyboard
 from telebot import types
 
@@ -18,7 +20,7 @@ class Answer(BasePost):
         :return: The question of the answer.
         """
         post = self.as_dict()
-        return self.db.post.find_one({'_id': ObjectId(post['replied_to_post_id'])})
+        return self.identity_map.get(post['replied_to_post_id'])
 
     @property
     def emoji(self) -> str:
@@ -47,7 +49,7 @@ class Answer(BasePost):
         post = self.as_dict()
 
         # Send to the user who asked question
-        question = self.db.post.find_one({'_id': ObjectId(post['replied_to_post_id'])})
+        question = self.question
         question_owner_chat_id = question['chat']['id']
 
         # Send to Followers
@@ -66,7 +68,7 @@ class Answer(BasePost):
         keys, _ = super().get_actions_keys_and_owner()
 
         answer = self.as_dict()
-        question = self.db.post.find_one({'_id': ObjectId(answer['replied_to_post_id'])})
+        question = self.question
         question_owner_chat_id = question['chat']['id']
 
         if self.chat_id == question_owner_chat_id:
@@ -89,29 +91,46 @@ class Answer(BasePost):
         :return: The answer post.
         """
         answer = self.as_dict()
-        question = self.db.post.find_one({'_id': ObjectId(answer['replied_to_post_id'])})
+        question = self.question
         question_owner_chat_id = question['chat']['id']
 
+        # updated_at marks the posts as changed for the auto update job
+        current_time = time.time()
+
         # Check if it's already the accepted answer
         if question.get('accepted_answer') == answer['_id']:
             self.db.post.update_one(
                 {'_id': question['_id']},
-                {'$set': {'status': post_status.OPEN}},
-                {'$unset': {'accepted_answer': 1}}
+                {'$set': {'status': post_status.OPEN, 'updated_at': current_time}, '$unset': {'accepted_answer': 1}},
+            )
+            self.db.post.update_one(
+                {'_id': answer['_id']}, {'$set': {'updated_at': current_time}, '$unset': {'accepted': 1}}
             )
-            self.db.post.update_one({'_id': answer['_id']}, {'$unset': {'accepted': 1}})
+            self.identity_map.invalidate(question['_id'], answer['_id'])
+
+            # Question is open again, so it is searchable again
+            search_index.index_post({**question, 'status': post_status.OPEN})
         else:
             # Add accepted answer to question
             self.db.post.update_one(
                 {'_id': question['_id']},
-                {'$set': {'status': post_status.RESOLVED, 'accepted_answer': answer['_id']}}
+                {'$set': {'status': post_status.RESOLVED, 'accepted_answer': answer['_id'], 'updated_at': current_time}}
             )
 
-            # Unaccept the previous accepted answer
-            self.db.post.update_one({'accepted': True, 'type': post_types.ANSWER}, {'$unset': {'accepted': 1}})
+            # Unaccept the previous accepted answer of the question
+            self.db.post.update_many(
+                {'accepted': True, 'type': post_types.ANSWER, 'replied_to_post_id': question['_id']},
+                {'$set': {'updated_at': current_time}, '$unset': {'accepted': 1}}
+            )
 
             # Accept the new answer
-            self.db.post.update_one({'_id': answer['_id']}, {'$set': {'accepted': True}})
+            self.db.post.update_one({'_id': answer['_id']}, {'$set': {'accepted': True, 'updated_at': current_time}})
+
+            # Previous accepted answer is updated by query, so we drop all cached posts.
+            self.identity_map.invalidate()
+
+            # Resolved questions are not searchable
+            search_index.index_post({**question, 'status': post_status.RESOLVED})
 
             # Send to the answer owner that the question is accepted
             answer_owner_chat_id = answer['chat']['id']
@@ -1,15 +1,18 @@
-import concurrent.futures
 import json
-from typing import Any, List, Tuple
+import time
+from typing import Any, List, Tuple, Union
 
-from bs4 import BeautifulSoup
 from bson.objectid import ObjectId
 from src import constants
+from src.broadcast import Broadcast
 from src.constants import (SUPPORTED_CONTENT_TYPES, inline_keys, post_status,
                            post_types)
-from src.data import DATA_DIR
+from src.data_models.gallery import Gallery
+from src.data_models.identity_map import PostIdentityMap
+from src.search import search_index
 from src.utils.common import (human_readable_size, human_readable_unix_time,
                               json_encoder)
+from src.utils.html_tags import close_open_tags
 from src.utils.keyboard import create_keyboard
 from telebot import types, util
 
@@ -20,18 +23,22 @@ class BasePost:
     """
     def __init__(
         self, db, stackbot, post_id: str = None, chat_id: str = None,
-        is_gallery: bool = False, gallery_filters=None
+        gallery: Gallery = None, identity_map: PostIdentityMap = None
     ):
         self.db = db
         self.collection = self.db.post
         self.stackbot = stackbot
+
+        # Posts are loaded once per update and shared between all post handlers of the update
+        self.identity_map = identity_map or PostIdentityMap(db)
         self.chat_id = chat_id
         self.supported_content_types = SUPPORTED_CONTENT_TYPES
 
         # post_id has setter and getter to convert it to ObjectId in case it is a string
         self._post_id = post_id
-        self.is_gallery = is_gallery
-        self.gallery_filters = gallery_filters
+
+        # Gallery the post is browsed in (if any)
+        self.gallery = gallery
 
         # Show more and show less buttons
         self.post_text_length_button = None
@@ -42,6 +49,10 @@ class BasePost:
     def emoji(self):
         return self._emoji
 
+    @property
+    def is_gallery(self) -> bool:
+        return self.gallery is not None and self.gallery.is_browsable
+
     @property
     def post_id(self):
         if isinstance(self._post_id, str):
@@ -56,10 +67,7 @@ class BasePost:
             self._post_id = post_id
 
     def as_dict(self) -> dict:
-        if not self.post_id:
-            return {}
-
-        return self.db.post.find_one({'_id': ObjectId(self.post_id)}) or {}
+        return self.identity_map.get(self.post_id)
 
     @property
     def owner_chat_id(self) -> str:
@@ -138,6 +146,7 @@ class BasePost:
         self.post_id = output.upserted_id or self.collection.find_one({
             'chat.id': message.chat.id, 'status': post_status.PREP
         })['_id']
+        self.identity_map.invalidate(self.post_id)
 
     def submit(self) -> str:
         """
@@ -151,25 +160,65 @@ class BasePost:
 
         # Stor raw text for search, keywords, similarity, etc.
         post_text = self.get_post_text(post)
-        if len(post_text) < constants.MIN_POST_TEXT_LENGTH:
+        if self.is_post_text_too_short(post_text):
             self.stackbot.send_message(self.chat_id, constants.MIN_POST_TEXT_LENGTH_MESSAGE)
             return
 
         # Update post status to OPEN (from PREP)
+        # Collapsed text of long posts is computed once here, so rendering does not split and parse the text.
+        truncated_text, needs_truncation = self.truncate_post_text(post_text)
         self.collection.update_one({'_id': post['_id']}, {'$set': {
-            'status': post_status.OPEN, 'raw_text': post_text,
+            'status': post_status.OPEN, 'raw_text': post_text, 'updated_at': time.time(),
+            'truncated_text': truncated_text, 'needs_truncation': needs_truncation,
         }})
+        self.update_reply_counter(post, 1)
+        self.identity_map.invalidate(post['_id'])
+
+        # Questions are searchable as soon as they are open (re-submitting replaces the indexed text)
+        if post['type'] == post_types.QUESTION:
+            search_index.index_post({**post, 'status': post_status.OPEN, 'raw_text': post_text})
         return post['_id']
 
-    def send_to_one(self, chat_id: str, preview: bool = False, schedule: bool = False) -> types.Message:
+    @staticmethod
+    def is_post_text_too_short(post_text: str) -> bool:
+        return len(post_text) < constants.MIN_POST_TEXT_LENGTH
+
+    def update_reply_counter(self, post: dict, amount: int) -> None:
+        """
+        Increment number of answers/comments of the post that post is replied to.
+
+        :param post: Reply post (answer, comment).
+        :param amount: Value to add to the counter, e.g. 1 when a reply opens and -1 when it closes.
+        """
+        counter_field = constants.REPLY_COUNTER_FIELDS.get(post.get('type'))
+        replied_to_post_id = post.get('replied_to_post_id')
+        if not (counter_field and replied_to_post_id):
+            return
+
+        self.collection.update_one(
+            {'_id': ObjectId(replied_to_post_id)},
+            {'$inc': {counter_field: amount}, '$set': {'updated_at': time.time()}}
+        )
+        self.identity_map.invalidate(replied_to_post_id)
+
+    def send_to_one(
+        self, chat_id: str, preview: bool = False,
+        post_text: str = None, post_keyboard: types.InlineKeyboardMarkup = None,
+        delete_after: Union[int, bool] = False,
+    ) -> types.Message:
         """
         Send post to user with chat_id.
 
         :param chat_id: Unique id of the user
         :param preview: If True, send post in preview mode. Default is False.
+        :param post_text: Pre-rendered post text, e.g. when post is rendered once for many users.
+        :param post_keyboard: Pre-rendered post keyboard for the user.
+        :param delete_after: Auto delete message in seconds, e.g. for posts that are shown only for a while.
+            Default is False (posts are kept).
         :return: Message sent to user.
         """
-        post_text, post_keyboard = self.get_text_and_keyboard(preview=preview)
+        if post_text is None:
+            post_text, post_keyboard = self.get_text_and_keyboard(preview=preview)
 
         # If post is sent to a user, then we should automatically update
         # it once in while to keep it fresh, for example, update number of likes.
@@ -179,35 +228,45 @@ class BasePost:
         sent_message = self.stackbot.send_message(
             chat_id=chat_id, text=post_text,
             reply_markup=post_keyboard,
-            delete_after=False,
+            delete_after=delete_after,
             auto_update=auto_update,
-            post_id=self.post_id,
+            post=self,
         )
 
         return sent_message
 
-    def send_to_many(self, chat_ids: list) -> types.Message:
+    def send_to_many(self, chat_ids: list, wait: bool = False) -> Broadcast:
         """
-        Send post to all users.
+        Send post to many users within Telegram rate limits.
+
+        The broadcast runs in background by default, so that rate limit sleeps and retries
+        don't hold up the next updates of the sender.
 
         :param chat_ids: List of unique ids of the users.
-        :return: Message sent to users.
+        :param wait: If True, return after the post is sent to all users, e.g. to read broadcast.stats
+            (sent, failed, retried). Default is False.
+        :return: Broadcast of the post.
         """
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for chat_id in chat_ids:
-                sent_message = executor.submit(self.send_to_one, chat_id, schedule=True)
+        broadcast = Broadcast(self, chat_ids=chat_ids)
+        if wait:
+            broadcast.run()
+        else:
+            broadcast.start()
 
-        return sent_message
+        return broadcast
 
-    def send_to_all(self) -> types.Message:
+    def send_to_all(self) -> Broadcast:
         """
         Send post with post_id to all users.
 
-        :param post_id: Unique id of the post.
-        :return: Message sent to users.
+        Users are streamed from database and the broadcast runs in background with
+        checkpoints, so it resumes after a restart.
+
+        :return: Running broadcast.
         """
-        chat_ids = list(map(lambda user: user['chat']['id'], self.db.users.find()))
-        return self.send_to_many(chat_ids)
+        broadcast = Broadcast(self, query={})
+        broadcast.start()
+        return broadcast
 
     @staticmethod
     def get_post_text(post):
@@ -222,6 +281,47 @@ class BasePost:
     def get_post_text_and_attachments(post):
         return BasePost.get_post_text(post), BasePost.get_post_attachments(post)
 
+    @staticmethod
+    def truncate_post_text(post_text: str) -> Tuple[str, bool]:
+        """
+        Truncate long post text to its first chunk, shown until the user clicks show more.
+
+        :param post_text: Post text (telegram html).
+        :return: Truncated text (None if the text is not long) and whether the text needs truncation.
+        """
+        # Splits one string into multiple strings, with a maximum amount of `chars_per_string` (max. 4096)
+        # Splits by last '\n', '. ' or ' ' in exactly this priority.
+        # smart_split returns a list with the splitted text.
+        splitted_text = util.smart_split(post_text, chars_per_string=constants.MESSAGE_SPLIT_CHAR_LIMIT)
+        if len(splitted_text) <= 1:
+            return None, False
+
+        # If we truncate the text, some html tags may become unclosed resulting in
+        # parsing html error. We therfore close the open tags at the end of the first chunk.
+        return close_open_tags(splitted_text[0]), True
+
+    def get_truncated_text(self, post: dict) -> Tuple[str, bool]:
+        """
+        Get truncated text of the post and whether it needs truncation.
+
+        They are stored when the post is submitted. Posts that are being typed (previews) and
+        posts submitted before they were stored are truncated on the fly.
+        """
+        if 'needs_truncation' in post:
+            return post.get('truncated_text'), post['needs_truncation']
+
+        return self.truncate_post_text(self.get_post_text(post) or constants.EMPTY_QUESTION_TEXT_MESSAGE)
+
+    def get_post_text_length_button(self, post: dict, truncate: bool = True) -> str:
+        """
+        Get show more/less key of the post, None if the post text is not long.
+        """
+        _, needs_truncation = self.get_truncated_text(post)
+        if not needs_truncation:
+            return None
+
+        return inline_keys.show_more if truncate else inline_keys.show_less
+
     def get_text(self, preview: bool = False, prettify: bool = True, truncate: bool = True) -> str:
         """
         Get post text.
@@ -242,21 +342,14 @@ class BasePost:
         if not post_text:
             post_text = constants.EMPTY_QUESTION_TEXT_MESSAGE
 
-        # Splits one string into multiple strings, with a maximum amount of `chars_per_string` (max. 4096)
-        # Splits by last '\n', '. ' or ' ' in exactly this priority.
-        # smart_split returns a list with the splitted text.
-        splitted_text = util.smart_split(post_text, chars_per_string=constants.MESSAGE_SPLIT_CHAR_LIMIT)
-        if truncate and len(splitted_text) > 1:
-            post_text = splitted_text[0]
-            # If we truncate the text, some html tags may become unclosed resulting in
-            # parsing html error. We therfore use beautifulsoup to close the tags.
-            soup = BeautifulSoup(post_text, 'html.parser')
-            post_text = soup.prettify()
-
-            self.post_text_length_button = inline_keys.show_more
-
-        elif not truncate and len(splitted_text) > 1:
-            self.post_text_length_button = inline_keys.show_less
+        # Long posts are truncated to their first chunk with show more/less keys
+        truncated_text, needs_truncation = self.get_truncated_text(post)
+        if needs_truncation:
+            if truncate:
+                post_text = truncated_text
+                self.post_text_length_button = inline_keys.show_more
+            else:
+                self.post_text_length_button = inline_keys.show_less
 
         # Prettify adds extra information such as post type, from_user, date, etc.
         # Otherwise only raw text is returned.
@@ -285,11 +378,29 @@ class BasePost:
             - In preview mode, there is no actions button.
         :return: Post keyboard.
         """
+        keys, callback_data = self.get_shared_keys(preview=preview, truncate=truncate)
+
+        # If it's a preview message, we are done!
+        if preview:
+            post_keyboard = create_keyboard(*keys, callback_data=callback_data, is_inline=True)
+            return post_keyboard
+
+        liked_by_user = self.chat_id in self.get_likers([self.chat_id])
+        return self.get_viewer_keyboard(keys, callback_data, liked_by_user=liked_by_user)
+
+    def get_shared_keys(self, preview: bool = False, truncate: bool = True) -> Tuple[List, List]:
+        """
+        Get keys of the post keyboard that are the same for all users who see the post.
+
+        Shared keys are rendered once per post and completed for each user with get_viewer_keyboard.
+
+        :return: Keys and their callback data.
+        """
         post = self.as_dict()
 
         keys, callback_data = [], []
         # Add back to original post key
-        original_post = self.db.post.find_one({'_id': ObjectId(post['replied_to_post_id'])})
+        original_post = self.identity_map.get(post['replied_to_post_id'])
         if original_post:
             keys.append(inline_keys.original_post)
             callback_data.append(inline_keys.original_post)
@@ -300,21 +411,17 @@ class BasePost:
             callback_data.append(inline_keys.attachments)
 
         # show more/less button
-        self.get_text(preview=preview, truncate=truncate)
+        self.post_text_length_button = self.get_post_text_length_button(post, truncate=truncate)
         if self.post_text_length_button:
             keys.append(self.post_text_length_button)
             callback_data.append(self.post_text_length_button)
 
-        # If it's a preview message, we are done!
         if preview:
-            post_keyboard = create_keyboard(*keys, callback_data=callback_data, is_inline=True)
-            return post_keyboard
+            return keys, callback_data
 
         # Add comments, answers, etc.
-        num_comments = self.db.post.count_documents(
-            {'replied_to_post_id': self.post_id, 'type': post_types.COMMENT, 'status': post_status.OPEN})
-        num_answers = self.db.post.count_documents(
-            {'replied_to_post_id': self.post_id, 'type': post_types.ANSWER, 'status': post_status.OPEN})
+        num_comments = post.get('num_comments', 0)
+        num_answers = post.get('num_answers', 0)
         if num_comments:
             keys.append(f'{inline_keys.show_comments} ({num_comments})')
             callback_data.append(inline_keys.show_comments)
@@ -322,16 +429,33 @@ class BasePost:
             keys.append(f'{inline_keys.show_answers} ({num_answers})')
             callback_data.append(inline_keys.show_answers)
 
+        return keys, callback_data
+
+    def get_viewer_keyboard(
+        self, shared_keys: List, shared_callback_data: List, liked_by_user: bool, gallery: Gallery = None
+    ) -> types.InlineKeyboardMarkup:
+        """
+        Complete shared keys with the keys that depend on the user: like status and gallery position.
+
+        :param shared_keys: Keys returned by get_shared_keys.
+        :param shared_callback_data: Callback data returned by get_shared_keys.
+        :param liked_by_user: If True, user has liked the post.
+        :param gallery: Gallery of the user message. Defaults to the gallery of the post handler.
+        :return: Post keyboard.
+        """
+        post = self.as_dict()
+        gallery = gallery or self.gallery
+        keys, callback_data = list(shared_keys), list(shared_callback_data)
+
         # Add actions, like, etc. keys
-        liked_by_user = self.collection.find_one({'_id': ObjectId(self.post_id), 'likes': self.chat_id})
         like_key = inline_keys.like if liked_by_user else inline_keys.unlike
-        num_likes = len(post.get('likes', []))
+        num_likes = post.get('num_likes', 0)
         new_like_key = f'{like_key} ({num_likes})' if num_likes else like_key
 
         keys.extend([new_like_key, inline_keys.actions])
         callback_data.extend([inline_keys.like, inline_keys.actions])
 
-        if not self.is_gallery:
+        if not (gallery and gallery.is_browsable):
             post_keyboard = create_keyboard(*keys, callback_data=callback_data, is_inline=True)
             return post_keyboard
 
@@ -339,11 +463,8 @@ class BasePost:
         # can choose to go to next or previous post.
 
         # Find current page number
-        conditions = self.gallery_filters.copy()
-        num_posts = self.db.post.count_documents(conditions)
-
-        conditions.update({'date': {'$lt': post['date']}})
-        post_position = self.db.post.count_documents(conditions) + 1
+        num_posts = gallery.total
+        post_position = gallery.get_position(post)
 
         # Previous page key
         prev_key = inline_keys.prev_post if post_position > 1 else inline_keys.first_page
@@ -367,6 +488,24 @@ class BasePost:
         post_keyboard = create_keyboard(*keys, callback_data=callback_data, is_inline=True)
         return post_keyboard
 
+    def get_likers(self, chat_ids: List) -> set:
+        """
+        Get users among chat_ids who liked the post, with one query for all users
+        and without loading the likes of the post.
+
+        :param chat_ids: Unique ids of the users.
+        :return: Set of unique ids of the users who liked the post.
+        """
+        chat_ids = list(chat_ids)
+        if not (self.post_id and chat_ids):
+            return set()
+
+        result = next(self.collection.aggregate([
+            {'$match': {'_id': ObjectId(self.post_id)}},
+            {'$project': {'likers': {'$setIntersection': [{'$ifNull': ['$likes', []]}, chat_ids]}}},
+        ]), {})
+        return set(result.get('likers', []))
+
     def get_text_and_keyboard(self, preview=False, prettify: bool = True, truncate: bool = True):
         return self.get_text(preview, prettify, truncate), self.get_keyboard(preview, truncate)
 
@@ -378,20 +517,27 @@ class BasePost:
         """
         return self.as_dict().get('followers', [])
 
-    def toggle_post_field(self, field: str, field_value: Any) -> None:
+    def toggle_post_field(self, field: str, field_value: Any, counter_field: str = None) -> None:
         """
         Pull/Push to the collection field of the post.
 
         :param field: Collection field to be toggled (push/pull)
+        :param counter_field: Collection field that keeps the number of values in field, e.g. num_likes.
         """
-        exists_flag = self.collection.find_one({'_id': ObjectId(self.post_id), field: field_value})
+        # Push and pull are conditional so that the value and its counter are updated atomically.
+        # updated_at marks the post as changed for the auto update job
+        current_time = time.time()
+        push_data = {'$addToSet': {field: field_value}, '$set': {'updated_at': current_time}}
+        pull_data = {'$pull': {field: field_value}, '$set': {'updated_at': current_time}}
+        if counter_field:
+            push_data['$inc'] = {counter_field: 1}
+            pull_data['$inc'] = {counter_field: -1}
 
-        if exists_flag:
-            self.collection.update_one({'_id': ObjectId(self.post_id)}, {'$pull': {field: field_value}})
-        else:
-            self.collection.update_one(
-                {'_id': ObjectId(self.post_id)}, {'$addToSet': {field: field_value}}
-            )
+        output = self.collection.update_one({'_id': ObjectId(self.post_id), field: {'$ne': field_value}}, push_data)
+        if not output.modified_count:
+            self.collection.update_one({'_id': ObjectId(self.post_id), field: field_value}, pull_data)
+
+        self.identity_map.invalidate(self.post_id)
 
     def follow(self):
         """
@@ -407,7 +553,7 @@ class BasePost:
 
         :param post_id: Unique id of the post
         """
-        self.toggle_post_field('likes', self.chat_id)
+        self.toggle_post_field('likes', self.chat_id, counter_field='num_likes')
 
     def bookmark(self):
         """
@@ -483,7 +629,7 @@ class BasePost:
             file_name = attachment.get('file_name') or attachment['content_type']
             file_size = human_readable_size(attachment['file_size'])
             keys.append(f"{file_name} - {file_size}")
-            callback_data.append(attachment['file_unique_id'])
+            callback_data.append(f"{constants.FILE_CALLBACK_PREFIX}{attachment['file_unique_id']}")
 
         return create_keyboard(*keys, callback_data=callback_data, is_inline=True)
 
@@ -507,13 +653,26 @@ class BasePost:
         Close/Open post.
         Nobody can comment/answer to a closed post.
         """
-        current_field_value = self.as_dict()[field]
-        new_index = values.index(current_field_value) - 1
+        post = self.as_dict()
+        current_field_value = post[field]
+        new_value = values[values.index(current_field_value) - 1]
 
-        self.collection.update_one(
-            {'_id': ObjectId(self.post_id)},
-            {'$set': {field: values[new_index]}}
+        output = self.collection.update_one(
+            {'_id': ObjectId(self.post_id), field: current_field_value},
+            {'$set': {field: new_value, 'updated_at': time.time()}}
         )
+        self.identity_map.invalidate(self.post_id)
+
+        # Only open replies are counted on the replied to post (delete/undelete, close/open).
+        if output.modified_count and field == 'status':
+            if current_field_value == post_status.OPEN:
+                self.update_reply_counter(post, -1)
+            elif new_value == post_status.OPEN:
+                self.update_reply_counter(post, 1)
+
+            # Closed and deleted questions are not searchable
+            if post['type'] == post_types.QUESTION:
+                search_index.index_post({**post, field: new_value})
 
     def get_post_owner_identity(self) -> str:
         """
@@ -529,24 +688,3 @@ class BasePost:
     @staticmethod
     def remove_non_json_data(json_data):
         return json.loads(json.dumps(json_data, default=json_encoder))
-
-    def export(self, format='html'):
-        """
-        Export post as html
-        """
-        post = self.as_dict()
-        if format == 'html':
-            with open(DATA_DIR / 'post_card.html', 'r') as f:
-                template_html = f.read()
-
-            replace_map = {
-                'emoji': self.html_icon,
-                'post_id': post['_id'],
-                'post_type': post['type'].title(),
-                'text': self.get_text(prettify=False, truncate=False, preview=False),
-                'date': human_readable_unix_time(post['date']),
-            }
-            for key, value in replace_map.items():
-                template_html = template_html.replace(r'{{{' + key + r'}}}', str(value))
-
-            return template_html
@@ -1,6 +1,7 @@
-from bson.objectid import ObjectId
 from src.constants import post_status
 from src.data_models.base import BasePost
+from src.data_models.gallery import Gallery
+from src.data_models.identity_map import PostIdentityMap
 from src.utils.keyboard import create_keyboard
 from telebot import types
 
@@ -11,11 +12,11 @@ class Comment(BasePost):
     """
     def __init__(
         self, db, stackbot, post_id: str = None, chat_id: str = None,
-        is_gallery: bool = False, gallery_filters=None
+        gallery: Gallery = None, identity_map: PostIdentityMap = None
     ):
         super().__init__(
             db=db, stackbot=stackbot, chat_id=chat_id, post_id=post_id,
-            is_gallery=is_gallery, gallery_filters=gallery_filters
+            gallery=gallery, identity_map=identity_map
         )
         self.supported_content_types = ['text']
 
@@ -32,7 +33,7 @@ class Comment(BasePost):
         post = self.as_dict()
 
         # Send to the user who sent the original post
-        related_post = self.db.post.find_one({'_id': ObjectId(post['replied_to_post_id'])})
+        related_post = self.identity_map.get(post['replied_to_post_id'])
         related_post_owner_chat_id = related_post['chat']['id']
 
         # Send to Followers
@@ -0,0 +1,367 @@
+import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+from bson.objectid import ObjectId
+from loguru import logger
+from src.constants import (GALLERY_MAX_WINDOW_SIZE, GALLERY_PREFETCH_MARGIN,
+                           GALLERY_PREFETCH_WORKERS,
+                           GALLERY_SESSION_CACHE_MAX_SIZE,
+                           GALLERY_SESSION_CACHE_TTL, GALLERY_WINDOW_SIZE)
+from src.utils.cache import TTLCache
+
+# Galleries show the newest post first. Ties on date are broken by _id so that
+# every post has a unique position and keyset cursors never skip or repeat posts.
+GALLERY_SORT = [('date', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]
+
+# Posts in the window of a gallery session only keep what navigation needs
+WINDOW_PROJECTION = {'date': 1}
+
+# Warm gallery sessions are kept in memory, so browsing them does not touch the sessions collection
+session_cache = TTLCache(maxsize=GALLERY_SESSION_CACHE_MAX_SIZE, ttl=GALLERY_SESSION_CACHE_TTL)
+
+# Windows are refilled in the background, at most one refill per session at a time
+prefetch_executor = ThreadPoolExecutor(max_workers=GALLERY_PREFETCH_WORKERS, thread_name_prefix='gallery-prefetch')
+refilling_sessions = set()
+refilling_lock = threading.Lock()
+
+
+class Gallery:
+    """
+    Gallery of posts matching filters that users can browse with next/prev buttons.
+
+    Navigation uses keyset cursors on (date, _id), so moving to a neighbouring post is a single
+    indexed lookup regardless of the number of posts. The total is counted once when the gallery
+    is opened and the position of the current post is updated incrementally on every move.
+
+    Every opened gallery has one session that stores its filters, sort, total and a window of
+    neighbouring posts, and messages only reference the session (see src/callback_data.py).
+    Next/prev are served from the window while it covers the move, and the window is extended in
+    the background when the user gets close to its edge. Sessions expire when they
+    are not used for GALLERY_SESSION_TTL (TTL index in src/db.py).
+
+    Ranked galleries (e.g. search results) are browsed in the order of their ranking instead of by
+    date. The whole ranking is stored in the window of their session, so they never query for neighbours.
+    """
+    def __init__(
+        self, db, filters: dict = None, total: int = None, position: int = None, session_id: ObjectId = None,
+        ranking: list = None,
+    ):
+        """
+        :param db: MongoDB connection.
+        :param filters: Posts collection query of the gallery posts.
+        :param total: Cached number of posts in the gallery.
+        :param position: Position of the current post (1 is the oldest post, total is the newest).
+            In ranked galleries 1 is the best match.
+        :param session_id: Unique id of the stored gallery session. Filters are loaded from it when needed.
+        :param ranking: Unique ids of the gallery posts, best match first (ranked galleries only).
+        """
+        self.db = db
+        self._filters = filters
+        self._ranking = ranking
+        self._total = len(ranking) if ranking is not None and total is None else total
+        self.position = position
+        self.session_id = session_id
+        self._session = None
+        self._window = None
+
+    @classmethod
+    def from_callback_data(cls, db, callback_data: dict):
+        """
+        Create gallery from the callback data stored for a message.
+
+        :return: Gallery or None if the message is not a gallery.
+        """
+        gallery = callback_data.get('gallery')
+        if gallery:
+            return cls(db, filters=gallery['filters'], total=gallery.get('total'), position=gallery.get('position'))
+
+        # Messages sent before galleries were cached only store filters.
+        if callback_data.get('is_gallery'):
+            return cls(db, filters=callback_data['gallery_filters'])
+
+    @classmethod
+    def from_dict(cls, db, gallery: dict):
+        """
+        Create gallery from its as_dict output.
+
+        :return: Gallery or None if gallery is empty.
+        """
+        if gallery:
+            return cls(db, session_id=gallery['session_id'], total=gallery['total'], position=gallery['position'])
+
+    def as_dict(self) -> dict:
+        return {'session_id': self.save(), 'total': self.total, 'position': self.position}
+
+    def save(self) -> ObjectId:
+        """
+        Store gallery session once, when the gallery is first sent.
+
+        :return: Unique id of the gallery session.
+        """
+        if self.session_id is None:
+            session = {
+                '_id': ObjectId(), 'filters': self.filters, 'sort': self.sort, 'ranked': self.is_ranked,
+                'total': self.total, 'window': self.window,
+                'created_at': time.time(), 'last_used_at': datetime.datetime.utcnow(),
+            }
+            self.db.gallery_sessions.insert_one(session)
+            session_cache.set(session['_id'], session)
+            self.session_id, self._session = session['_id'], session
+
+        return self.session_id
+
+    @property
+    def session(self) -> dict:
+        """
+        Gallery session document, None if the gallery is not saved yet or its session has expired.
+
+        Sessions loaded from database get their expiry renewed, so a session is written at most
+        once per GALLERY_SESSION_CACHE_TTL while it is in use.
+        """
+        if self._session is None and self.session_id is not None:
+            self._session = session_cache.get(self.session_id)
+            if self._session is None:
+                self._session = self.db.gallery_sessions.find_one_and_update(
+                    {'_id': self.session_id}, {'$set': {'last_used_at': datetime.datetime.utcnow()}},
+                    return_document=pymongo.ReturnDocument.AFTER,
+                )
+                if self._session is not None:
+                    session_cache.set(self.session_id, self._session)
+
+        return self._session
+
+    @property
+    def is_expired(self) -> bool:
+        return self.session_id is not None and self.session is None
+
+    @property
+    def is_ranked(self) -> bool:
+        if self._ranking is not None:
+            return True
+        return bool(self.session and self.session.get('ranked'))
+
+    @property
+    def filters(self) -> dict:
+        if self._filters is None:
+            # Gallery without filters or with an expired session has no posts
+            self._filters = self.session['filters'] if self.session else {'_id': None}
+        return self._filters
+
+    @property
+    def sort(self) -> list:
+        if self.session:
+            return [tuple(key) for key in self.session['sort']]
+        return GALLERY_SORT
+
+    @property
+    def total(self) -> int:
+        if self._total is None:
+            if self.session:
+                self._total = self.session['total']
+            else:
+                self._total = self.db.post.count_documents(self.filters)
+        return self._total
+
+    @property
+    def window(self) -> dict:
+        """
+        Window of neighbouring posts: posts in position order (oldest or best match first) and
+        the position of the first one.
+        """
+        if self.session:
+            return self.session.get('window')
+        return self._window
+
+    @window.setter
+    def window(self, window: dict):
+        if self.session:
+            # Window is extended in memory only, the stored window is the one the gallery was opened with
+            self.session['window'] = window
+        else:
+            self._window = window
+
+    def get_from_window(self, post: dict, step: int) -> dict:
+        """
+        Get the post step positions away from post if the window covers it.
+        """
+        window = self.window
+        if not window or self.position is None:
+            return
+
+        posts = window['posts']
+        index = self.position - window['start']
+        if not (0 <= index < len(posts)) or posts[index]['_id'] != post['_id']:
+            return
+
+        if 0 <= index + step < len(posts):
+            return posts[index + step]
+
+    @property
+    def is_browsable(self) -> bool:
+        """
+        Only galleries with more than one post have next/prev buttons.
+        """
+        return self.total > 1
+
+    def first(self) -> dict:
+        """
+        Get the newest post of the gallery and move the position to it.
+
+        :return: Post document (_id and date) or None if gallery is empty.
+            Ranked galleries start with their best match and their posts only have _id.
+        """
+        if self._ranking is not None:
+            if not self._ranking:
+                return
+
+            self.position = 1
+            self.window = {'start': 1, 'posts': [{'_id': post_id} for post_id in self._ranking]}
+            return self.window['posts'][0]
+
+        posts = list(self.db.post.find(self.filters, WINDOW_PROJECTION, sort=self.sort, limit=GALLERY_WINDOW_SIZE))
+        if not posts:
+            return
+
+        self.position = self.total
+        posts.reverse()
+        self.window = {'start': self.position - len(posts) + 1, 'posts': posts}
+        return posts[-1]
+
+    def next(self, post: dict) -> dict:
+        """
+        Get the post right after post (newer) and move the position to it.
+        """
+        next_post = self.get_from_window(post, 1) or self.find_neighbour(post, newer=True)
+        if next_post and self.position is not None:
+            self.position = min(self.position + 1, self.total)
+            self.prefetch(newer=True)
+        return next_post
+
+    def prev(self, post: dict) -> dict:
+        """
+        Get the post right before post (older) and move the position to it.
+        """
+        prev_post = self.get_from_window(post, -1) or self.find_neighbour(post, newer=False)
+        if prev_post and self.position is not None:
+            self.position = max(self.position - 1, 1)
+            self.prefetch(newer=False)
+        return prev_post
+
+    def fetch_beyond(self, post: dict, newer: bool) -> list:
+        """
+        Get the next GALLERY_WINDOW_SIZE posts after (newer) or before post, nearest first.
+        Ranked galleries are entirely in their window, so there is nothing beyond it.
+        """
+        if self.is_ranked:
+            return []
+
+        operator = '$gt' if newer else '$lt'
+        direction = pymongo.ASCENDING if newer else pymongo.DESCENDING
+        query = {'$and': [self.filters, self.keyset_filter(post, operator)]}
+        return list(self.db.post.find(
+            query, WINDOW_PROJECTION, sort=[('date', direction), ('_id', direction)], limit=GALLERY_WINDOW_SIZE
+        ))
+
+    def prefetch(self, newer: bool) -> None:
+        """
+        Extend the window in the background if the current position is close to its edge in the
+        direction the user is browsing.
+        """
+        window = self.window
+        if self.session is None or not window or self.position is None:
+            return
+
+        index = self.position - window['start']
+        remaining = len(window['posts']) - 1 - index if newer else index
+        if remaining > GALLERY_PREFETCH_MARGIN:
+            return
+
+        with refilling_lock:
+            if self.session_id in refilling_sessions:
+                return
+            refilling_sessions.add(self.session_id)
+
+        prefetch_executor.submit(self.extend_window, newer, self.position)
+
+    def extend_window(self, newer: bool, position: int) -> None:
+        """
+        Add the posts beyond the edge of the window and trim it around position.
+        The window is replaced at once, so readers never see it half updated.
+        """
+        try:
+            window = self.window
+            posts = window['posts']
+            new_posts = self.fetch_beyond(posts[-1] if newer else posts[0], newer)
+            if not new_posts:
+                return
+
+            if newer:
+                window = {'start': window['start'], 'posts': posts + new_posts}
+            else:
+                window = {'start': window['start'] - len(new_posts), 'posts': new_posts[::-1] + posts}
+
+            self.window = self.trim_window(window, position)
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            with refilling_lock:
+                refilling_sessions.discard(self.session_id)
+
+    @staticmethod
+    def trim_window(window: dict, position: int) -> dict:
+        """
+        Keep at most GALLERY_MAX_WINDOW_SIZE posts of the window, centered on position where possible.
+        """
+        posts = window['posts']
+        excess = len(posts) - GALLERY_MAX_WINDOW_SIZE
+        if excess <= 0:
+            return window
+
+        left = max(0, min(position - window['start'] - GALLERY_MAX_WINDOW_SIZE // 2, excess))
+        return {'start': window['start'] + left, 'posts': posts[left:left + GALLERY_MAX_WINDOW_SIZE]}
+
+    def find_neighbour(self, post: dict, newer: bool) -> dict:
+        """
+        Get the neighbour of post with a keyset query. The next posts in the same direction are
+        fetched with it and become the window, so the following moves are served from memory.
+        """
+        posts = self.fetch_beyond(post, newer)
+        if not posts:
+            return
+
+        if self.position is not None:
+            current_post = {'_id': post['_id'], 'date': post['date']}
+            if newer:
+                self.window = {'start': self.position, 'posts': [current_post] + posts}
+            else:
+                self.window = {'start': self.position - len(posts), 'posts': posts[::-1] + [current_post]}
+
+        return posts[0]
+
+    def get_position(self, post: dict) -> int:
+        """
+        Get the position of post in the gallery.
+
+        The incrementally maintained position is used if available. Otherwise (e.g. messages sent before
+        positions were cached) it is counted once and cached.
+        """
+        if self.position is None:
+            query = {'$and': [self.filters, self.keyset_filter(post, '$lt')]}
+            self.position = self.db.post.count_documents(query) + 1
+        return self.position
+
+    @staticmethod
+    def keyset_filter(post: dict, operator: str) -> dict:
+        """
+        Query of posts before ($lt) or after ($gt) post in (date, _id) order.
+
+        The date range condition comes first so that it bounds the index scan, and _id only breaks ties.
+        """
+        inclusive_operator = f'{operator}e'
+        return {
+            'date': {inclusive_operator: post['date']},
+            '$or': [{'date': {operator: post['date']}}, {'_id': {operator: post['_id']}}],
+        }
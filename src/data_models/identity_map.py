@@ -0,0 +1,44 @@
+from bson.objectid import ObjectId
+
+
+class PostIdentityMap:
+    """
+    Per-update identity map for post documents.
+
+    Every post is loaded from database at most once per update and then served from memory.
+    Write paths must invalidate the posts they change so that the next read reloads them.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._posts = {}
+
+    def get(self, post_id) -> dict:
+        """
+        Get post document with post_id, loading it from database on first access.
+
+        :param post_id: Unique id of the post (str or ObjectId).
+        :return: Post document or an empty dict if post does not exist.
+        """
+        if not post_id:
+            return {}
+
+        post_id = ObjectId(post_id)
+        if post_id not in self._posts:
+            # likes can grow large and are only needed through the num_likes counter
+            self._posts[post_id] = self.db.post.find_one({'_id': post_id}, {'likes': 0}) or {}
+
+        return self._posts[post_id]
+
+    def invalidate(self, *post_ids) -> None:
+        """
+        Drop posts from the map so they are reloaded on next access.
+
+        :param post_ids: Unique ids of the posts. If empty, the whole map is cleared.
+        """
+        if not post_ids:
+            self._posts.clear()
+            return
+
+        for post_id in post_ids:
+            if post_id:
+                self._posts.pop(ObjectId(post_id), None)
@@ -1,5 +1,10 @@
-from src.constants import inline_keys, post_status
+from typing import List
+
+from src.constants import (SIMILAR_QUESTIONS_LIMIT,
+                           SIMILAR_QUESTIONS_MIN_SCORE, inline_keys,
+                           post_status)
 from src.data_models.base import BasePost
+from src.search import search_index
 from src.utils.keyboard import create_keyboard
 from telebot import types
 
@@ -10,11 +15,34 @@ class Question(BasePost):
     """
     def send(self) -> dict:
         """Send question to the right audience.
-        We send questions to all users.
+        We send questions to all users in a background broadcast.
 
         :return: The question post.
         """
-        return self.send_to_all()
+        self.send_to_all()
+        return self.as_dict()
+
+    def get_similar_questions(self) -> List:
+        """
+        Get open questions similar to the question the user is typing (possible duplicates).
+
+        Questions that are too short to be sent are not checked, so the user is told about the
+        length first (by submit).
+
+        :return: Unique ids of the similar questions, most similar first.
+        """
+        post = self.collection.find_one({'chat.id': self.chat_id, 'status': post_status.PREP}, {'text': 1})
+        if not post:
+            return []
+
+        post_text = self.get_post_text(post)
+        if self.is_post_text_too_short(post_text):
+            return []
+
+        similar_questions = search_index.similar(
+            post_text, limit=SIMILAR_QUESTIONS_LIMIT, min_score=SIMILAR_QUESTIONS_MIN_SCORE
+        )
+        return [post_id for post_id, _ in similar_questions]
 
     def get_actions_keyboard(self) -> types.InlineKeyboardMarkup:
         """
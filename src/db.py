@@ -1,5 +1,6 @@
 import pymongo
 from loguru import logger
+from src.constants import BROADCAST_DELIVERY_TTL, GALLERY_SESSION_TTL
 
 def build_indexes(db):
     # users
@@ -14,9 +15,18 @@ def build_indexes(db):
     db.post.create_index([('chat.id', 1)])
     db.post.create_index([('status', 1), ('type', 1), ('chat.id', 1)])
     db.post.create_index([('status', 1), ('type', 1), ('replied_to_post_id', 1)])
+    db.post.create_index([('updated_at', 1)])
+
+    # galleries: one index per filter shape, ending with the (date, _id) keyset sort
+    db.post.create_index([('type', 1), ('status', 1), ('date', -1), ('_id', -1)])
+    db.post.create_index([('type', 1), ('chat.id', 1), ('date', -1), ('_id', -1)])
+    db.post.create_index([('replied_to_post_id', 1), ('type', 1), ('status', 1), ('date', -1), ('_id', -1)])
 
     # db.post.create_index([('text', 'text')])
 
+    # gallery sessions (removed by mongodb when not used for GALLERY_SESSION_TTL)
+    db.gallery_sessions.create_index([('last_used_at', 1)], expireAfterSeconds=GALLERY_SESSION_TTL)
+
     # callback data
     db.callback_data.create_index([('chat_id', 1)])
     db.callback_data.create_index([('message_id', 1)])
@@ -25,8 +35,22 @@ def build_indexes(db):
     db.callback_data.create_index([('chat_id', 1), ('message_id', 1), ('post_id', 1)])
     db.callback_data.create_index([('chat_id', 1), ('message_id', 1), ('created_at', 1)])
 
+    # auto delete
+    db.auto_delete.create_index([('due_at', 1)])
+    db.auto_delete.create_index([('chat_id', 1), ('created_at', -1)])
+    db.auto_delete.create_index([('chat_id', 1), ('message_id', 1)])
+
     # auto update
     db.auto_update.create_index([('chat_id', 1), ('message_id', 1)])
+    db.auto_update.create_index([('post_id', 1), ('rendered_at', 1)])
+
+    # broadcasts
+    db.broadcasts.create_index([('post_id', 1)], unique=True)
+    db.broadcasts.create_index([('status', 1)])
+    db.broadcast_deliveries.create_index([('post_id', 1), ('chat_id', 1)], unique=True)
+    db.broadcast_deliveries.create_index([('post_id', 1), ('status', 1), ('claimed_at', 1)])
+    # claims are removed when their broadcast is done, or by mongodb after BROADCAST_DELIVERY_TTL
+    db.broadcast_deliveries.create_index([('claimed_at', 1)], expireAfterSeconds=BROADCAST_DELIVERY_TTL)
 
 # MongoDB connection
 client = pymongo.MongoClient("localhost", 27017)
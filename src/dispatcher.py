@@ -0,0 +1,133 @@
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from typing import List
+
+from loguru import logger
+from telebot import types
+
+# Number of recent updates per lane that latency stats are computed from
+LATENCY_WINDOW = 1000
+
+
+class Lane:
+    """
+    Worker thread that processes its updates one at a time, in the order they are submitted.
+    """
+    def __init__(self, bot, index: int, max_queue_size: int):
+        self.bot = bot
+        self.index = index
+        self.updates = queue.Queue(maxsize=max_queue_size)
+        self.processed = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.thread = threading.Thread(target=self.process_updates, name=f'lane-{index}', daemon=True)
+
+    def process_updates(self):
+        while True:
+            update, submitted_at = self.updates.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                # Latency is measured from submission, so time spent waiting in the lane counts
+                self.latencies.append(time.time() - submitted_at)
+                self.processed += 1
+                self.updates.task_done()
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'lane': self.index,
+            'queue_depth': self.updates.qsize(),
+            'processed': self.processed,
+            'avg_latency': statistics.mean(latencies) if latencies else 0,
+            'p95_latency': latencies[int(len(latencies) * 0.95)] if latencies else 0,
+            'max_latency': latencies[-1] if latencies else 0,
+        }
+
+
+class UpdateDispatcher:
+    """
+    Dispatch telegram updates to worker lanes by chat.
+
+    Updates of a chat always go to the same lane and are processed in order, e.g. the messages of
+    a post being composed are stored before the user's "Send" is handled. Updates of different
+    chats are spread over the lanes and processed in parallel.
+
+    Bot must be created with threaded=False, so that handlers run in the lane thread and
+    not in the worker pool of telebot, which does not keep the order of updates.
+    """
+    def __init__(self, bot, num_lanes: int = 8, max_queue_size: int = 1000):
+        """
+        :param bot: TeleBot instance with registered handlers.
+        :param num_lanes: Number of lanes (worker threads).
+        :param max_queue_size: Maximum number of updates waiting in each lane.
+        """
+        self.lanes = [Lane(bot, index, max_queue_size) for index in range(num_lanes)]
+
+    def start(self):
+        for lane in self.lanes:
+            lane.thread.start()
+
+    def start_stats_reporter(self, db, interval: int = 60) -> threading.Thread:
+        """
+        Store the lane stats in database every interval seconds, so they can be read in polling
+        mode as well as in webhook mode (e.g. with src/jobs/show_dispatcher_stats.py).
+        """
+        def report_stats():
+            while True:
+                time.sleep(interval)
+                try:
+                    db.stats.update_one(
+                        {'_id': 'dispatcher'},
+                        {'$set': {'lanes': self.stats(), 'updated_at': time.time()}},
+                        upsert=True,
+                    )
+                except Exception as e:
+                    logger.error(f'Error storing dispatcher stats: {e}')
+
+        thread = threading.Thread(target=report_stats, name='dispatcher-stats', daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def get_chat_id(update: types.Update) -> int:
+        """
+        Get the chat of the update. Updates without a chat are keyed by their sender or id.
+        """
+        if update.message:
+            return update.message.chat.id
+        if update.edited_message:
+            return update.edited_message.chat.id
+        if update.callback_query:
+            if update.callback_query.message:
+                return update.callback_query.message.chat.id
+            return update.callback_query.from_user.id
+
+        return update.update_id
+
+    def get_lane(self, update: types.Update) -> Lane:
+        return self.lanes[self.get_chat_id(update) % len(self.lanes)]
+
+    def submit(self, update: types.Update, block: bool = True) -> bool:
+        """
+        Queue update in the lane of its chat.
+
+        :param block: If False, return immediately when the lane is full.
+        :return: False if the update is not queued because the lane is full.
+        """
+        try:
+            self.get_lane(update).updates.put((update, time.time()), block=block)
+        except queue.Full:
+            return False
+
+        return True
+
+    def stats(self) -> List[dict]:
+        """
+        Queue depth, number of processed updates and latency (seconds) of each lane.
+        """
+        return [lane.stats() for lane in self.lanes]
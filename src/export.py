@@ -0,0 +1,381 @@
+import csv
+import io
+import json
+import multiprocessing
+import queue
+import shutil
+import tempfile
+import threading
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterator, List
+
+from loguru import logger
+from src import constants
+from src.constants import (EXPORT_BATCH_SIZE, EXPORT_MAX_JOBS_PER_USER,
+                           EXPORT_MAX_WORKERS, EXPORT_PROGRESS_INTERVAL,
+                           post_types)
+from src.data import DATA_DIR
+from src.data_models.base import BasePost
+from src.data_models.gallery import GALLERY_SORT
+from src.user import User
+from src.utils.common import chunked_iterable, human_readable_unix_time
+from src.utils.io import read_file
+
+# Templates are read once, the posts template is split around its cards placeholder
+POSTS_HTML_HEAD, POSTS_HTML_TAIL = read_file(DATA_DIR / 'posts.html').split('{{{POSTS-CARDS}}}')
+POST_CARD_HTML = read_file(DATA_DIR / 'post_card.html')
+REPLIES_HTML_HEAD = (
+    '<button class="btn btn-primary" type="button" data-toggle="collapse" data-target=".{collapse_id}" '
+    'aria-expanded="false" >Replies</button>'
+    '<div class="card-columns collapse {collapse_id} py-3">'
+)
+REPLIES_HTML_TAIL = '</div>'
+
+# Only what the exports show is loaded (e.g. not likes or followers)
+EXPORT_PROJECTION = {
+    'type': 1, 'status': 1, 'text': 1, 'date': 1, 'chat.id': 1, 'replied_to_post_id': 1, 'attachments': 1,
+    'num_likes': 1, 'num_answers': 1, 'num_comments': 1,
+}
+
+# Files of the zip bundle and the export format of each
+BUNDLE_FILES = {'posts.html': 'html', 'posts.jsonl': 'jsonl', 'attachments.csv': 'manifest'}
+MANIFEST_FIELDS = ['post_id', 'file_unique_id', 'content_type', 'mime_type', 'file_size', 'file_name']
+
+# File extension of each export format
+FILE_EXTENSIONS = {'html': 'html', 'jsonl': 'jsonl', 'manifest': 'csv', 'zip': 'zip'}
+
+
+class GalleryExporter:
+    """
+    Export posts of a gallery with their answers.
+
+    Formats:
+        - html: Post cards page.
+        - jsonl: One JSON object per post (answers follow the post they answer).
+        - manifest: CSV of the attachments (file_unique_id, mime type, size, ...).
+        - zip: Bundle of the html, jsonl and manifest.
+
+    Posts are read in batches of EXPORT_BATCH_SIZE. Each batch takes one query for its posts, one for
+    the answers of all of them and one for the identities of their owners, so the number of queries
+    grows with the number of batches and not with the number of posts. The export is produced as
+    a stream of chunks that are written to the file as they are rendered.
+    """
+    def __init__(self, db, filters: dict, on_progress: Callable[[int], None] = None):
+        """
+        :param db: MongoDB connection.
+        :param filters: Posts collection query of the gallery posts.
+        :param on_progress: Called with the number of gallery posts of each batch once it is loaded.
+        """
+        self.db = db
+        self.filters = filters
+        self.on_progress = on_progress
+
+    def iter_batches(self) -> Iterator[List[dict]]:
+        """
+        Yield batches of gallery posts (newest first), each post with its answers (newest first)
+        in the replies field and its owner identity in the owner_identity field.
+        """
+        posts = self.db.post.find(self.filters, EXPORT_PROJECTION, sort=GALLERY_SORT, batch_size=EXPORT_BATCH_SIZE)
+        for batch in chunked_iterable(posts, EXPORT_BATCH_SIZE):
+            replies = self.get_replies([post['_id'] for post in batch])
+            all_posts = list(batch) + [reply for post_replies in replies.values() for reply in post_replies]
+            identities = self.get_owner_identities(all_posts)
+
+            for post in all_posts:
+                post['owner_identity'] = identities.get(post['chat']['id'], post['chat']['id'])
+            for post in batch:
+                post['replies'] = replies.get(post['_id'], [])
+
+            if self.on_progress is not None:
+                self.on_progress(len(batch))
+            yield batch
+
+    def get_replies(self, post_ids: List) -> Dict:
+        """
+        Get answers of posts with one query.
+
+        :return: Mapping from post_id to its answers, newest first.
+        """
+        replies = defaultdict(list)
+        query = {'replied_to_post_id': {'$in': post_ids}, 'type': post_types.ANSWER}
+        for reply in self.db.post.find(query, EXPORT_PROJECTION, sort=GALLERY_SORT):
+            replies[reply['replied_to_post_id']].append(reply)
+
+        return replies
+
+    def get_owner_identities(self, posts: List[dict]) -> Dict:
+        """
+        Get identities of the owners of posts with one query.
+
+        :return: Mapping from chat_id to identity.
+        """
+        chat_ids = list({post['chat']['id'] for post in posts})
+        users = self.db.users.find({'chat.id': {'$in': chat_ids}}, {'chat': 1, 'settings': 1})
+        return {user['chat']['id']: User.get_identity(user) for user in users}
+
+    def iter_html(self) -> Iterator[str]:
+        """
+        Yield the html export in chunks: the page head, post cards and the page tail.
+        """
+        yield POSTS_HTML_HEAD
+
+        post_number = self.db.post.count_documents(self.filters)
+        for batch in self.iter_batches():
+            chunk = []
+            for post in batch:
+                chunk.append(self.post_to_html(post, post_number))
+                post_number -= 1
+
+                if post['replies']:
+                    chunk.append(REPLIES_HTML_HEAD.format(collapse_id=f'collapse_{post["_id"]}'))
+                    num_replies = len(post['replies'])
+                    for reply_index, reply in enumerate(post['replies']):
+                        chunk.append(self.post_to_html(reply, num_replies - reply_index))
+                    chunk.append(REPLIES_HTML_TAIL)
+
+            yield ''.join(chunk)
+
+        yield POSTS_HTML_TAIL
+
+    @staticmethod
+    def post_to_html(post: dict, post_number: int) -> str:
+        replace_map = {
+            'emoji': constants.HTML_ICON.get(post['type']),
+            'post_id': post['_id'],
+            'post_type': post['type'].title(),
+            'post_number': post_number,
+            'user_identity': post['owner_identity'],
+            'text': BasePost.get_post_text(post) or constants.EMPTY_QUESTION_TEXT_MESSAGE,
+            'date': human_readable_unix_time(post['date']),
+        }
+        post_html = POST_CARD_HTML
+        for key, value in replace_map.items():
+            post_html = post_html.replace(r'{{{' + key + r'}}}', str(value))
+
+        return post_html
+
+    def iter_posts(self) -> Iterator[dict]:
+        """
+        Yield gallery posts, each one followed by its answers.
+        """
+        for batch in self.iter_batches():
+            for post in batch:
+                yield post
+                yield from post['replies']
+
+    def iter_jsonl(self) -> Iterator[str]:
+        """
+        Yield the jsonl export in chunks, one chunk per batch.
+        """
+        for batch in chunked_iterable(self.iter_posts(), EXPORT_BATCH_SIZE):
+            yield ''.join(json.dumps(self.post_to_json(post), ensure_ascii=False, default=str) + '\n' for post in batch)
+
+    @staticmethod
+    def post_to_json(post: dict) -> dict:
+        return {
+            '_id': str(post['_id']),
+            'type': post['type'],
+            'status': post.get('status'),
+            'replied_to_post_id': str(post['replied_to_post_id']) if post.get('replied_to_post_id') else None,
+            'owner_identity': post['owner_identity'],
+            'date': post['date'],
+            'text': BasePost.get_post_text(post),
+            'num_likes': post.get('num_likes', 0),
+            'num_answers': post.get('num_answers', 0),
+            'num_comments': post.get('num_comments', 0),
+            'attachments': BasePost.get_post_attachments(post),
+        }
+
+    def iter_manifest(self) -> Iterator[str]:
+        """
+        Yield the attachment manifest (csv) in chunks, one chunk per batch.
+        """
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=MANIFEST_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for batch in chunked_iterable(self.iter_posts(), EXPORT_BATCH_SIZE):
+            for post in batch:
+                for attachment in BasePost.get_post_attachments(post):
+                    writer.writerow({**attachment, 'post_id': str(post['_id'])})
+
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    def iter_chunks(self, format: str = 'html') -> Iterator[str]:
+        if format == 'html':
+            return self.iter_html()
+        elif format == 'jsonl':
+            return self.iter_jsonl()
+        elif format == 'manifest':
+            return self.iter_manifest()
+
+        raise ValueError(f'Unsupported export format: {format}')
+
+    def write(self, f: BinaryIO, format: str = 'html') -> None:
+        """
+        Write the export to a binary file chunk by chunk, so memory use does not grow with the gallery.
+        """
+        if format == 'zip':
+            self.write_bundle(f)
+            return
+
+        for chunk in self.iter_chunks(format):
+            f.write(chunk.encode())
+
+    def write_bundle(self, f: BinaryIO) -> None:
+        """
+        Write the zip bundle. Every file of the bundle is streamed into the archive in its own pass over the gallery.
+        """
+        with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED) as bundle:
+            for file_name, format in BUNDLE_FILES.items():
+                with bundle.open(file_name, 'w', force_zip64=True) as bundle_file:
+                    self.write(bundle_file, format)
+
+
+def render_export(filters: dict, format: str, path: str, progress=None) -> str:
+    """
+    Render the export of a gallery to a temporary file in a worker process of the export queue.
+    Workers open their own database connection, as connections can't be shared with the bot process.
+
+    :param path: Path of the export file, in a temporary directory the caller removes when the export
+        is sent or has failed.
+    :param progress: Queue the percentage of exported posts is put in after each batch.
+    :return: Path of the export file.
+    """
+    from src.db import db
+
+    on_progress = None
+    if progress is not None:
+        # Zip bundles go over the gallery once per file
+        num_passes = len(BUNDLE_FILES) if format == 'zip' else 1
+        total = max(db.post.count_documents(filters) * num_passes, 1)
+        exported = 0
+
+        def on_progress(num_posts: int) -> None:
+            nonlocal exported
+            exported += num_posts
+            progress.put(min(100 * exported // total, 100))
+
+    with open(path, 'wb') as f:
+        GalleryExporter(db, filters, on_progress=on_progress).write(f, format)
+
+    return path
+
+
+class ExportQueue:
+    """
+    Queue of gallery exports that are rendered in worker processes, off the update lanes.
+
+    At most EXPORT_MAX_WORKERS exports are rendered at a time and the rest wait in the queue in
+    submission order. A user can have at most EXPORT_MAX_JOBS_PER_USER exports queued or running,
+    so one user can't fill the queue. The user gets a progress message that shows the share of
+    exported posts while the export is rendered (updated at most every EXPORT_PROGRESS_INTERVAL
+    seconds) and when it is finished. Exports are written to temporary files, which are removed
+    once they are sent or have failed.
+    """
+    def __init__(self, max_workers: int = EXPORT_MAX_WORKERS, max_jobs_per_user: int = EXPORT_MAX_JOBS_PER_USER):
+        """
+        :param max_workers: Number of exports rendered at a time (worker processes).
+        :param max_jobs_per_user: Number of exports a user can have queued or running.
+        """
+        self.max_workers = max_workers
+        self.max_jobs_per_user = max_jobs_per_user
+        self.user_jobs = defaultdict(int)
+        self._lock = threading.Lock()
+        self._processes = None
+        self._jobs = None
+        self._manager = None
+
+    def start(self):
+        """
+        Start the worker processes. Workers are spawned (not forked), so they don't inherit
+        the database connection and threads of the bot process.
+        """
+        with self._lock:
+            if self._processes is None:
+                mp_context = multiprocessing.get_context('spawn')
+                self._processes = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=mp_context)
+                # Workers report progress through queues of a manager process
+                self._manager = mp_context.Manager()
+                # Each job waits for its render and sends the file, so jobs run in threads of their own
+                self._jobs = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='export')
+
+    def submit(self, stackbot, chat_id: int, filters: dict, format: str = 'html') -> bool:
+        """
+        Queue the export of a gallery for a user.
+
+        :param stackbot: StackBot that sends the progress message and the file.
+        :param chat_id: Chat id of the user.
+        :param filters: Posts collection query of the gallery posts.
+        :param format: Export format.
+        :return: False if the user already has the maximum number of exports queued or running.
+        """
+        with self._lock:
+            if self.user_jobs[chat_id] >= self.max_jobs_per_user:
+                return False
+            self.user_jobs[chat_id] += 1
+
+        try:
+            self.start()
+            num_posts = stackbot.db.post.count_documents(filters)
+            message = stackbot.send_message(
+                chat_id, constants.EXPORT_STARTED_MESSAGE.format(num_posts=num_posts)
+            )
+            self._jobs.submit(self.run_job, stackbot, chat_id, message.message_id, filters, format, num_posts)
+        except Exception:
+            self.release(chat_id)
+            raise
+
+        return True
+
+    def run_job(self, stackbot, chat_id: int, message_id: int, filters: dict, format: str, num_posts: int) -> None:
+        # Directory is created here rather than in the worker, so it is removed even if the render fails
+        export_dir = Path(tempfile.mkdtemp(prefix='export-'))
+        try:
+            path = export_dir / f'{chat_id}.{FILE_EXTENSIONS[format]}'
+            progress = self._manager.Queue()
+            future = self._processes.submit(render_export, filters, format, str(path), progress=progress)
+            self.report_progress(stackbot, chat_id, message_id, num_posts, future, progress)
+            future.result()
+            with open(path, 'rb') as document:
+                stackbot.bot.send_document(chat_id, document)
+            stackbot.edit_message(chat_id, message_id, text=constants.EXPORT_DONE_MESSAGE)
+        except Exception as e:
+            logger.exception(e)
+            stackbot.edit_message(chat_id, message_id, text=constants.EXPORT_FAILED_MESSAGE)
+        finally:
+            shutil.rmtree(export_dir, ignore_errors=True)
+            self.release(chat_id)
+
+    def report_progress(self, stackbot, chat_id: int, message_id: int, num_posts: int, future, progress) -> None:
+        """
+        Edit the progress message with the latest progress of the worker until the export is rendered.
+        """
+        shown_percent = None
+        while not wait([future], timeout=EXPORT_PROGRESS_INTERVAL).done:
+            percent = shown_percent
+            try:
+                while True:
+                    percent = progress.get_nowait()
+            except queue.Empty:
+                pass
+
+            if percent != shown_percent:
+                shown_percent = percent
+                stackbot.edit_message(chat_id, message_id, text=constants.EXPORT_PROGRESS_MESSAGE.format(
+                    num_posts=num_posts, percent=percent
+                ))
+
+    def release(self, chat_id: int) -> None:
+        with self._lock:
+            self.user_jobs[chat_id] -= 1
+            if self.user_jobs[chat_id] <= 0:
+                del self.user_jobs[chat_id]
+
+
+# Shared export queue of the bot process
+export_queue = ExportQueue()
@@ -18,11 +18,13 @@ class BaseHandler(ABC):
         Register telebot handlers.
         """
 
-    def get_settings_keyboard(self):
+    def get_settings_keyboard(self, user):
         """
         Returns settings main menu keyboard.
+
+        :param user: User of the current update.
         """
-        muted_bot = self.stackbot.user.settings.get('muted_bot')
+        muted_bot = user.settings.get('muted_bot')
         if muted_bot:
             keys = [inline_keys.change_identity]
         else:
@@ -30,14 +32,16 @@ class BaseHandler(ABC):
 
         return create_keyboard(*keys, is_inline=True)
 
-    def get_settings_text(self):
+    def get_settings_text(self, user):
         """
         Returns settings text message.
+
+        :param user: User of the current update.
         """
         text = SETTINGS_START_MESSAGE.format(
-            first_name=self.stackbot.user.first_name,
-            username=self.stackbot.user.username,
-            identity=self.stackbot.user.identity,
-            **self.stackbot.user.stats(),
+            first_name=user.first_name,
+            username=user.username,
+            identity=user.identity,
+            **user.stats(),
         )
         return text
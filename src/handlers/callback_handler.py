@@ -1,62 +1,66 @@
 import re
 
-import emoji
-from bson.objectid import ObjectId
-from loguru import logger
 from src import constants
 from src.bot import bot
-from src.constants import (inline_keys, keyboards, post_status, post_types,
+from src.callback_data import CallbackData
+from src.constants import (FILE_CALLBACK_PREFIX, callback_actions,
+                           inline_keys, keyboards, post_status, post_types,
                            states)
-from src.data import DATA_DIR
+from src.context import UpdateContext
 from src.data_models.base import BasePost
+from src.data_models.gallery import Gallery
+from src.export import export_queue
 from src.handlers.base import BaseHandler
 from src.user import User
+from src.utils import emojis
 from src.utils.keyboard import create_keyboard
 
+LEGACY_FILE_CALLBACK_PATTERN = re.compile(r'[A-Za-z0-9_-]+')
+
 
 class CallbackHandler(BaseHandler):
+    def __init__(self, stackbot, db):
+        super().__init__(stackbot, db)
+
+        # Callback handlers by inline key and by callback data prefix, see dispatch.
+        self.callbacks = {}
+        self.prefix_callbacks = {}
+
     def register(self):
         @self.stackbot.bot.middleware_handler(update_types=['callback_query'])
         def init_callback_handler(bot_instance, call):
             """
-            Initialize user to use in other callback handlers.
+            Initialize update context to use in other callback handlers.
 
-            1. Get user object.
-            2. Demojize call data and call message text.
+            1. Decode call data to its inline key, post and gallery.
+            2. Get user object and attach it to the call context.
             """
-            # Every message sent with inline keyboard is stored in database with callback_data and
-            # post_type (question, answer, comment, ...). When user clicks on an inline keyboard button,
-            # we get the post type to know what kind of post we are dealing with.
-            call_info = self.get_call_info(call)
-            post_id = call_info.get('post_id')
-
-            print(call_info)
-
-
-            if post_id is None:
-                logger.warning('post_id is None!')
+            # Inline keys carry the post and gallery of their message in the callback data, see src/callback_data.py.
+            # Prefixed callback data (e.g. attachments) is not about the post of the message.
+            payload = CallbackData.decode(self.db, call.data)
+            if payload is not None:
+                call.data, post_id, gallery = payload.action, payload.post_id, payload.gallery
+            elif self.get_prefix_callback(call.data)[0] is not None:
+                post_id, gallery = None, None
+            else:
+                # Messages sent before callback data was encoded are looked up in database
+                call_info = self.get_call_info(call)
+                post_id, gallery = call_info.get('post_id'), Gallery.from_callback_data(self.db, call_info)
+                call.data = self.decode_callback_data(call.data)
 
-            self.stackbot.user = User(
+            user = User(
                 chat_id=call.message.chat.id, first_name=call.message.chat.first_name,
                 db=self.db, stackbot=self.stackbot, post_id=post_id
             )
+            call.context = UpdateContext(user)
             # register user if not exists
-            if not self.stackbot.user.is_registered:
-                self.stackbot.user.register(call.message)
+            if not user.is_registered:
+                user.register(call.message)
 
             # update post info
-            gallery_filters = self.get_gallery_filters(
-                call.message.chat.id, call.message.message_id,
-                self.stackbot.user.post.post_id
-            )
-            self.stackbot.user.post.is_gallery = call_info.get('is_gallery', False)
-            self.stackbot.user.post.gallery_filters = gallery_filters
+            user.post.gallery = gallery
 
-            # Demojize text
-            call.data = emoji.demojize(call.data)
-            call.message.text = emoji.demojize(call.message.text)
-
-        @bot.callback_query_handler(func=lambda call: call.data == inline_keys.actions)
+        @self.callback_handler(inline_keys.actions)
         def actions_callback(call):
             """Actions >> inline key callback.
             Post actions include follow/unfollow, answer, comment, open/close, edit, ...
@@ -65,11 +69,12 @@ class CallbackHandler(BaseHandler):
             2. Get post text content.
             3. Edit message with post text and actions keyboard.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
-            keyboard = self.stackbot.user.post.get_actions_keyboard()
-            self.stackbot.user.edit_message(call.message.message_id, reply_markup=keyboard)
+            keyboard = user.post.get_actions_keyboard()
+            user.edit_message(call.message.message_id, reply_markup=keyboard)
 
-        @bot.callback_query_handler(func=lambda call: call.data in [inline_keys.answer, inline_keys.comment])
+        @self.callback_handler(inline_keys.answer, inline_keys.comment)
         def answer_comment_callback(call):
             """
             Answer/Comment inline key callback.
@@ -80,21 +85,22 @@ class CallbackHandler(BaseHandler):
                 to store the post_id of the post that the user replied to in the answer/comment or any other reply type.
             3. Send start typing message.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
             current_post_type = post_types.COMMENT if call.data == inline_keys.comment else post_types.ANSWER
 
-            self.stackbot.user.update_state(states.ANSWER_QUESTION if call.data == inline_keys.answer else states.COMMENT_POST)
-            self.stackbot.user.track(replied_to_post_id=self.stackbot.user.post.post_id)
+            user.update_state(states.ANSWER_QUESTION if call.data == inline_keys.answer else states.COMMENT_POST)
+            user.track(replied_to_post_id=user.post.post_id)
 
-            self.stackbot.user.send_message(
+            user.send_message(
                 constants.POST_START_MESSAGE.format(
-                    first_name=self.stackbot.user.first_name,
+                    first_name=user.first_name,
                     post_type=current_post_type
                 ),
                 reply_markup=keyboards.send_post,
             )
 
-        @bot.callback_query_handler(func=lambda call: call.data == inline_keys.back)
+        @self.callback_handler(inline_keys.back)
         def back_callback(call):
             """
             Back inline key callback.
@@ -103,22 +109,18 @@ class CallbackHandler(BaseHandler):
                 - For a post: Edit message with post keyboard.
                 - For settings: Edit message with settings keyboard.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
             # main menu keyboard
-            if self.stackbot.user.post.post_id is not None:
+            if user.post.post_id is not None:
                 # back is called on a post (question, answer or comment
-                self.stackbot.user.edit_message(call.message.message_id, reply_markup=self.stackbot.user.post.get_keyboard())
+                user.edit_message(call.message.message_id, reply_markup=user.post.get_keyboard())
             else:
                 # back is called in settings
-                self.stackbot.user.edit_message(call.message.message_id, reply_markup=self.stackbot.get_settings_keyboard())
+                user.edit_message(call.message.message_id, reply_markup=self.get_settings_keyboard(user))
 
-        @bot.callback_query_handler(
-            func=lambda call: call.data in [
-                inline_keys.like,
-                inline_keys.follow, inline_keys.unfollow,
-            ]
-        )
+        @self.callback_handler(inline_keys.like, inline_keys.follow, inline_keys.unfollow)
         def toggle_callback(call):
             """
             Toggle callback is used for actions that toggle between pull and push data, such as like, follow, ...
@@ -129,22 +131,21 @@ class CallbackHandler(BaseHandler):
                 - ...
             2. Edit message with new keyboard that toggles based on pull/push.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
             if call.data == inline_keys.like:
-                self.stackbot.user.post.like()
-                keyboard = self.stackbot.user.post.get_keyboard()
+                user.post.like()
+                keyboard = user.post.get_keyboard()
 
             elif call.data in [inline_keys.follow, inline_keys.unfollow]:
-                self.stackbot.user.post.follow()
-                keyboard = self.stackbot.user.post.get_actions_keyboard()
+                user.post.follow()
+                keyboard = user.post.get_actions_keyboard()
 
             # update main menu keyboard
-            self.stackbot.user.edit_message(call.message.message_id, reply_markup=keyboard)
+            user.edit_message(call.message.message_id, reply_markup=keyboard)
 
-        @bot.callback_query_handler(
-            func=lambda call: call.data in [inline_keys.open, inline_keys.close, inline_keys.delete, inline_keys.undelete]
-        )
+        @self.callback_handler(inline_keys.open, inline_keys.close, inline_keys.delete, inline_keys.undelete)
         def toggle_post_field_values_callback(call):
             """
             Open/Close Delete/Undelete or any other toggling between two values.
@@ -154,6 +155,7 @@ class CallbackHandler(BaseHandler):
             2. Edit message with new keyboard and text
                 - New post text reflects the new open/close status.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
             if call.data in [inline_keys.open, inline_keys.close]:
@@ -163,49 +165,47 @@ class CallbackHandler(BaseHandler):
                 field = 'status'
 
                 # toggle between deleted and current post status
-                other_status = self.stackbot.user.post.post_status
+                other_status = user.post.post_status
                 if other_status == post_status.DELETED:
                     other_status = post_status.OPEN
                 values = list({post_status.DELETED, other_status})
 
-            self.stackbot.user.post.switch_field_between_multiple_values(field=field, values=values)
-            self.stackbot.user.edit_message(
+            user.post.switch_field_between_multiple_values(field=field, values=values)
+            user.edit_message(
                 call.message.message_id,
-                text=self.stackbot.user.post.get_text(),
-                reply_markup=self.stackbot.user.post.get_actions_keyboard()
+                text=user.post.get_text(),
+                reply_markup=user.post.get_actions_keyboard()
             )
 
-        @bot.callback_query_handler(
-            func=lambda call: call.data in [inline_keys.bookmark, inline_keys.unbookmark]
-        )
+        @self.callback_handler(inline_keys.bookmark, inline_keys.unbookmark)
         def toggle_user_field_values_callback(call):
             """
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
-            self.stackbot.user.toggle_user_field(field='bookmarks', field_value=self.stackbot.user.post.post_id)
-            self.stackbot.user.edit_message(
+            user.toggle_user_field(field='bookmarks', field_value=user.post.post_id)
+            user.edit_message(
                 call.message.message_id,
-                text=self.stackbot.user.post.get_text(),
-                reply_markup=self.stackbot.user.post.get_actions_keyboard()
+                text=user.post.get_text(),
+                reply_markup=user.post.get_actions_keyboard()
             )
 
-        @bot.callback_query_handler(
-            func=lambda call: call.data in [inline_keys.accept, inline_keys.unaccept]
-        )
+        @self.callback_handler(inline_keys.accept, inline_keys.unaccept)
         def accept_answer(call):
             """
             Accept/Unaccept answer callback.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
-            self.stackbot.user.post.accept_answer()
-            self.stackbot.user.edit_message(
+            user.post.accept_answer()
+            user.edit_message(
                 call.message.message_id,
-                text=self.stackbot.user.post.get_text(),
-                reply_markup=self.stackbot.user.post.get_actions_keyboard()
+                text=user.post.get_text(),
+                reply_markup=user.post.get_actions_keyboard()
             )
 
-        @bot.callback_query_handler(func=lambda call: call.data == inline_keys.change_identity)
+        @self.callback_handler(inline_keys.change_identity)
         def change_identity_callback(call):
             """
             Change identity inline key callback.
@@ -216,17 +216,16 @@ class CallbackHandler(BaseHandler):
                     - Username
                     - First name
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
             keyboard = create_keyboard(
                 inline_keys.ananymous, inline_keys.first_name, inline_keys.username,
                 is_inline=True
             )
-            self.stackbot.user.edit_message(call.message.message_id, reply_markup=keyboard)
+            user.edit_message(call.message.message_id, reply_markup=keyboard)
 
-        @bot.callback_query_handler(
-            func=lambda call: call.data in [inline_keys.ananymous, inline_keys.first_name, inline_keys.username]
-        )
+        @self.callback_handler(inline_keys.ananymous, inline_keys.first_name, inline_keys.username)
         def set_identity_callback(call):
             """
             Set new user identity.
@@ -234,15 +233,16 @@ class CallbackHandler(BaseHandler):
             1. Update settings with new identity.
             2. Edit message with new settings text and main keyboard.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
-            self.stackbot.user.update_settings(identity_type=call.data)
-            self.stackbot.user.edit_message(
+            user.update_settings(identity_type=call.data)
+            user.edit_message(
                 call.message.message_id,
-                text=self.get_settings_text(), reply_markup=self.get_settings_keyboard()
+                text=self.get_settings_text(user), reply_markup=self.get_settings_keyboard(user)
             )
 
-        @bot.callback_query_handler(func=lambda call: call.data == inline_keys.original_post)
+        @self.callback_handler(inline_keys.original_post)
         def original_post(call):
             """
             Original post inline key callback.
@@ -252,99 +252,91 @@ class CallbackHandler(BaseHandler):
             1. Get the current post.
             2. Get the original post from replied_to_post_id.
             3. Edit message with original post keyboard and text.
-            4. Update callback data with original post_id.
+            4. Keys of the message now carry the original post_id.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
-            post = self.stackbot.user.post.as_dict()
-            original_post_id = self.db.post.find_one({'_id': post['replied_to_post_id']})['_id']
-
-            original_post_info = self.db.callback_data.find_one(
-                {'chat_id': call.message.chat.id, 'message_id': call.message.message_id, 'post_id': original_post_id}
-            ) or {}
+            post = user.post.as_dict()
+            original_post_id = user.identity_map.get(post['replied_to_post_id'])['_id']
 
-            is_gallery = original_post_info.get('is_gallery')
-            gallery_filters = original_post_info.get('gallery_filters')
-
-            self.stackbot.user.post = BasePost(
-                db=self.stackbot.user.db, stackbot=self.stackbot,
-                post_id=original_post_id, chat_id=self.stackbot.user.chat_id,
-                gallery_filters=gallery_filters, is_gallery=is_gallery
+            user.post = BasePost(
+                db=user.db, stackbot=self.stackbot,
+                post_id=original_post_id, chat_id=user.chat_id,
+                identity_map=user.identity_map,
             )
-            # Edit message with new gallery
-            post_text, post_keyboard = self.stackbot.user.post.get_text_and_keyboard()
-            self.stackbot.user.edit_message(
+            # Edit message with the original post
+            post_text, post_keyboard = user.post.get_text_and_keyboard()
+            user.edit_message(
                 call.message.message_id,
                 text=post_text,
                 reply_markup=post_keyboard
             )
 
-        @bot.callback_query_handler(
-            func=lambda call: call.data in [inline_keys.show_comments, inline_keys.show_answers]
-        )
+        @self.callback_handler(inline_keys.show_comments, inline_keys.show_answers)
         def show_posts(call):
             """
             Show comments and answers of a post.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
-            post = self.stackbot.user.post.as_dict()
+            post = user.post.as_dict()
 
             gallery_post_type = post_types.ANSWER if call.data == inline_keys.show_answers else post_types.COMMENT
             gallery_filters = {'replied_to_post_id': post['_id'], 'type': gallery_post_type, 'status': post_status.OPEN}
-            posts = self.db.post.find(gallery_filters).sort('date', -1)
-
-            num_posts = self.db.post.count_documents(gallery_filters)
-            next_post = next(posts)
+            gallery = Gallery(self.db, filters=gallery_filters)
+            next_post = gallery.first()
+            if not next_post:
+                self.answer_callback_query(
+                    call.id, constants.GALLERY_NO_POSTS_MESSAGE.format(post_type=gallery_post_type)
+                )
+                return
 
-            is_gallery = True if num_posts > 1 else False
-            self.edit_gallery(call, next_post['_id'], is_gallery, gallery_filters)
+            self.edit_gallery(user, call, next_post['_id'], gallery)
 
-        @bot.callback_query_handler(func=lambda call: call.data in [inline_keys.next_post, inline_keys.prev_post])
+        @self.callback_handler(inline_keys.next_post, inline_keys.prev_post)
         def next_prev_callback(call):
             """
             Next/Prev post inline key callback.
             """
-            self.answer_callback_query(call.id, text=call.data)
+            user = call.context.user
 
-            post = self.stackbot.user.post.as_dict()
-            operator = '$gt' if call.data == inline_keys.next_post else '$lt'
-            asc_desc = 1 if call.data == inline_keys.next_post else -1
-
-            # Get basic filters and gallery filters
-            filters = {'date': {operator: post['date']}}
-            gallery_filters = self.db.callback_data.find_one(
-                {'chat_id': call.message.chat.id, 'message_id': call.message.message_id, 'post_id': ObjectId(post['_id'])}
-            )['gallery_filters']
-            filters.update(gallery_filters)
+            # Gallery is loaded from callback data in the middleware
+            gallery = user.post.gallery
+            if gallery is None or gallery.is_expired:
+                self.answer_callback_query(call.id, text=constants.GALLERY_EXPIRED_MESSAGE)
+                return
 
-            # Get relevant posts
-            posts = self.db.post.find(filters).sort('date', asc_desc)
+            self.answer_callback_query(call.id, text=call.data)
+            post = user.post.as_dict()
+            if call.data == inline_keys.next_post:
+                next_post = gallery.next(post)
+            else:
+                next_post = gallery.prev(post)
 
-            try:
-                next_post = next(posts)
-            except StopIteration:
+            if not next_post:
                 self.answer_callback_query(
                     call.id,
-                    constants.GALLERY_NO_POSTS_MESSAGE.format(post_type=gallery_filters.get('type', 'post'))
+                    constants.GALLERY_NO_POSTS_MESSAGE.format(post_type=gallery.filters.get('type', 'post'))
                 )
                 return
 
-            is_gallery = True
-            self.edit_gallery(call, next_post['_id'], is_gallery, gallery_filters)
+            self.edit_gallery(user, call, next_post['_id'], gallery)
 
-        @bot.callback_query_handler(func=lambda call: call.data in [inline_keys.first_page, inline_keys.last_page])
+        @self.callback_handler(inline_keys.first_page, inline_keys.last_page)
         def gallery_first_last_page(call):
             """
             First and last page of a gallery button.
             """
             self.answer_callback_query(call.id, text=constants.GALLERY_NO_POSTS_MESSAGE.format(post_type='post'))
 
-        @bot.callback_query_handler(func=lambda call: call.data in [inline_keys.show_more, inline_keys.show_less])
+        @self.callback_handler(inline_keys.show_more, inline_keys.show_less)
         def show_more_less(call):
             """
             Show more or less text for a long post.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
 
             if call.data == inline_keys.show_more:
@@ -354,162 +346,176 @@ class CallbackHandler(BaseHandler):
 
             # check if it's a preview or a full post
             preview = False
-            if self.stackbot.user.state == states.ASK_QUESTION:
+            if user.state == states.ASK_QUESTION:
                 preview = True
 
             # update text and keyboard
-            text, keyboard = self.stackbot.user.post.get_text_and_keyboard(truncate=truncate, preview=preview)
-            self.stackbot.user.edit_message(call.message.message_id, text=text, reply_markup=keyboard)
+            text, keyboard = user.post.get_text_and_keyboard(truncate=truncate, preview=preview)
+            user.edit_message(call.message.message_id, text=text, reply_markup=keyboard)
 
-        @bot.callback_query_handler(func=lambda call: call.data in [inline_keys.export_gallery])
+        @self.callback_handler(inline_keys.export_gallery)
         def export_gallery(call):
             """
-            Show more or less text for a long post.
+            Export gallery key callback: show the export formats.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
-            chat_id = self.stackbot.user.chat_id
-            gallery_filters = self.get_call_info(call)['gallery_filters']
+            keyboard = create_keyboard(inline_keys.back, *constants.EXPORT_FORMATS, is_inline=True)
+            user.edit_message(call.message.message_id, reply_markup=keyboard)
+
+        @self.callback_handler(*constants.EXPORT_FORMATS)
+        def export_gallery_format(call):
+            """
+            Export gallery posts (with their answers) in the chosen format.
+            """
+            user = call.context.user
+            gallery = user.post.gallery
+            if gallery is None or gallery.is_expired:
+                self.answer_callback_query(call.id, text=constants.GALLERY_EXPIRED_MESSAGE)
+                return
 
-            # Send html file to user
-            file_content = self.export_gallery(gallery_filters=gallery_filters, format='html')
-            with open(DATA_DIR / 'export' / f'{chat_id}.html', 'w') as f:
-                f.write(file_content)
+            # Exports are rendered in the background, the file is sent to the user when it is ready
+            export_format = constants.EXPORT_FORMATS[call.data]
+            if not export_queue.submit(self.stackbot, user.chat_id, gallery.filters, format=export_format):
+                self.answer_callback_query(call.id, text=constants.EXPORT_IN_PROGRESS_MESSAGE)
+                return
 
-            with open(DATA_DIR / 'export' / f'{chat_id}.html', 'r') as f:
-                self.stackbot.bot.send_document(
-                    self.stackbot.user.chat_id, f
-                )
+            self.answer_callback_query(call.id, text=call.data)
+            user.edit_message(call.message.message_id, reply_markup=user.post.get_keyboard())
 
-        @bot.callback_query_handler(func=lambda call: call.data == inline_keys.attachments)
+        @self.callback_handler(inline_keys.attachments)
         def show_attachments(call):
             """
             Show attached files.
             """
+            user = call.context.user
             self.answer_callback_query(call.id, text=call.data)
-            keyboard = self.stackbot.user.post.get_attachments_keyboard()
-            self.stackbot.user.edit_message(call.message.message_id, reply_markup=keyboard)
+            keyboard = user.post.get_attachments_keyboard()
+            user.edit_message(call.message.message_id, reply_markup=keyboard)
 
-        @bot.callback_query_handler(func=lambda call: re.match(r'[a-zA-Z0-9-]+', call.data))
-        def send_file(call):
+        @self.callback_prefix_handler(FILE_CALLBACK_PREFIX)
+        def send_file(call, file_unique_id):
             """
-            Send file callback. Callback data is file_unique_id. We use this to get file from telegram database.
+            Send file callback. Callback data is file:<file_unique_id>. We use this to get file from telegram database.
             """
-            self.answer_callback_query(call.id, text=f'Sending file: {call.data}...')
-            self.stackbot.send_file(call.message.chat.id, call.data, message_id=call.message.message_id)
+            self.answer_callback_query(call.id, text=f'Sending file: {file_unique_id}...')
+            self.stackbot.send_file(call.message.chat.id, file_unique_id, message_id=call.message.message_id)
 
         @bot.callback_query_handler(func=lambda call: True)
-        def not_implemented_callback(call):
+        def dispatch_callback(call):
             """
-            Raises not implemented callback answer for buttons that are not working yet.
+            All callbacks are routed by the dispatch table.
             """
-            self.answer_callback_query(call.id, text=f':cross_mark: {call.data} not implemented.')
+            self.dispatch(call)
+
+    def callback_handler(self, *keys):
+        """
+        Register the decorated function as the callback handler of inline keys.
+        """
+        def decorator(handler):
+            for key in keys:
+                self.callbacks[key] = handler
+            return handler
+
+        return decorator
+
+    def callback_prefix_handler(self, prefix):
+        """
+        Register the decorated function as the callback handler of callback data that starts with prefix.
+        The handler gets the rest of the callback data as the second argument.
+        """
+        def decorator(handler):
+            self.prefix_callbacks[prefix] = handler
+            return handler
+
+        return decorator
+
+    @staticmethod
+    def decode_callback_data(data: str) -> str:
+        """
+        Get the inline key of an action code. Messages sent before action codes send the key text.
+        """
+        return callback_actions.get(data) or emojis.demojize(data)
+
+    def get_prefix_callback(self, data: str):
+        """
+        Get the handler of prefixed callback data (prefix:value) and the value.
+        """
+        prefix, separator, value = data.partition(':')
+        if not separator:
+            return None, None
+
+        return self.prefix_callbacks.get(prefix + separator), value
+
+    def dispatch(self, call):
+        """
+        Route callback to its handler with one dict lookup, so the cost does not grow with the number of keys.
+
+        1. Inline keys are looked up by key.
+        2. Other callback data is looked up by its prefix (prefix:value).
+        3. Callback data of attachment keys sent before prefixes is a bare file_unique_id.
+        4. Otherwise, the key is not implemented.
+        """
+        handler = self.callbacks.get(call.data)
+        if handler is not None:
+            handler(call)
+            return
+
+        prefix_handler, value = self.get_prefix_callback(call.data)
+        if prefix_handler is None and LEGACY_FILE_CALLBACK_PATTERN.fullmatch(call.data):
+            prefix_handler, value = self.prefix_callbacks[FILE_CALLBACK_PREFIX], call.data
+
+        if prefix_handler is not None:
+            prefix_handler(call, value)
+            return
+
+        self.answer_callback_query(call.id, text=f':cross_mark: {call.data} not implemented.')
 
     def answer_callback_query(self, call_id, text, emojize=True):
         """
         Answer to a callback query.
         """
         if emojize:
-            text = emoji.emojize(text)
+            text = emojis.emojize(text)
         self.stackbot.bot.answer_callback_query(call_id, text=text)
 
     def get_call_info(self, call):
         """
-        Get call info from call data.
-
-        Every message with inline keyboard has information stored in database, particularly the post_id.
+        Get call info of messages sent before callback data was encoded.
 
-        We store the post_id in the database to use it later when user click on any inline button.
-        For example, if user click on 'answer' button, we know which post_id to store answer for.
-        This post_id is stored in the database as 'replied_to_post_id' field.
-
-        We also store post_type in the database to use the right handler in user object (Question, Answer, Comment).
+        These messages have their post_id in the last line of the message text and their
+        gallery stored in the callback_data collection.
         """
         post_id = self.stackbot.retrive_post_id_from_message_text(call.message.text)
+        if post_id is None:
+            return {}
 
-        print(post_id)
         callback_data = self.db.callback_data.find_one(
-            {'chat_id': call.message.chat.id, 'message_id': call.message.message_id, 'post_id': ObjectId(post_id)}
+            {'chat_id': call.message.chat.id, 'message_id': call.message.message_id, 'post_id': post_id}
         )
+        return callback_data or {'post_id': post_id}
 
-        print(list(self.db.callback_data.find(
-            {'chat_id': call.message.chat.id, 'message_id': call.message.message_id}
-        )))
-
-        return callback_data or {}
-
-    def get_gallery_filters(self, chat_id, message_id, post_id):
-        result = self.db.callback_data.find_one({'chat_id': chat_id, 'message_id': message_id, 'post_id': post_id}) or {}
-        return result.get('gallery_filters', {})
-
-    def edit_gallery(self, call, next_post_id, is_gallery=False, gallery_fiters=None):
+    def edit_gallery(self, user, call, next_post_id, gallery=None):
         """
         Edit gallery of posts to show next or previous post. Next post to show is the one
         with post_id=next_post_id.
 
-        :param chat_id: Chat id to send gallery to.
+        :param user: User of the current update.
+        :param call: Callback query of the gallery message.
         :param next_post_id: post_id of the next post to show.
-        :param is_gallery: If True, send gallery of posts. If False, send single post.
-            Next and previous buttions will be added to the message if is_gallery is True.
+        :param gallery: Gallery with the position moved to the next post.
+            Next and previous buttions will be added to the message if gallery has more than one post.
         """
-        self.stackbot.user.post = BasePost(
-            db=self.stackbot.user.db, stackbot=self.stackbot,
-            post_id=next_post_id, chat_id=self.stackbot.user.chat_id,
-            is_gallery=is_gallery, gallery_filters=gallery_fiters
+        user.post = BasePost(
+            db=user.db, stackbot=self.stackbot,
+            post_id=next_post_id, chat_id=user.chat_id,
+            gallery=gallery, identity_map=user.identity_map,
         )
 
         # Edit message with new gallery
-        post_text, post_keyboard = self.stackbot.user.post.get_text_and_keyboard()
-        self.stackbot.user.edit_message(
+        post_text, post_keyboard = user.post.get_text_and_keyboard()
+        user.edit_message(
             call.message.message_id,
             text=post_text,
             reply_markup=post_keyboard
         )
-
-    def export_gallery(self, gallery_filters, format='html'):
-        """
-        Export gallery data.
-        """
-        user_identity = self.stackbot.user.identity
-        if format != 'html':
-            return
-
-        with open(DATA_DIR / 'posts.html') as f:
-            template_html = f.read()
-
-        BODY = ''
-        num_posts = self.db.post.count_documents(gallery_filters)
-        posts = self.db.post.find(gallery_filters).sort('date', -1)
-        for post_ind, post in enumerate(posts):
-            post_ind = num_posts - post_ind
-            BODY += self.post_to_html(post['_id'], post_ind, user_identity)
-
-            # Add replies
-            replies_filter = {'replied_to_post_id': post['_id'], 'type': post_types.ANSWER}
-            replies = self.db.post.find(replies_filter).sort('date', -1)
-            num_replies = self.db.post.count_documents(replies_filter)
-
-            if num_replies > 0:
-                BODY += (
-                    '<button class="btn btn-primary" type="button" data-toggle="collapse" data-target=".{{{collapse_id}}}" '
-                    'aria-expanded="false" >Replies</button>'.replace(r'{{{collapse_id}}}', f'collapse_{post["_id"]}')
-                )
-                BODY += '<div class="card-columns collapse {{{collapse_id}}} py-3">'.replace(r'{{{collapse_id}}}', f'collapse_{post["_id"]}')
-            for reply_ind, reply in enumerate(replies):
-                reply_ind = num_replies - reply_ind
-                BODY += self.post_to_html(reply['_id'], reply_ind, user_identity)
-
-            if num_replies > 0:
-                BODY += '</div>'
-
-        return template_html.replace(r'{{{POSTS-CARDS}}}', BODY)
-
-    def post_to_html(self, post_id, post_number, user_identity):
-        post = BasePost(
-            db=self.stackbot.user.db, stackbot=self.stackbot,
-            post_id=post_id, chat_id=self.stackbot.user.chat_id
-        )
-        post_html = post.export(format='html')
-        post_html = post_html.replace(r'{{{user_identity}}}', str(user_identity))
-        post_html = post_html.replace(r'{{{post_number}}}', str(post_number))
-
-        return post_html
@@ -1,12 +1,17 @@
+import html
+
 import bson
-import emoji
 from loguru import logger
 from src import constants
 from src.bot import bot
 from src.constants import keyboards, keys, post_status, post_types, states
+from src.context import UpdateContext
 from src.data_models.base import BasePost
+from src.data_models.gallery import Gallery
 from src.handlers.base import BaseHandler
+from src.search import search_index
 from src.user import User
+from src.utils import emojis
 
 
 class MessageHandler(BaseHandler):
@@ -14,27 +19,28 @@ class MessageHandler(BaseHandler):
         @self.stackbot.bot.middleware_handler(update_types=['message'])
         def init_message_handler(bot_instance, message):
             """
-            Initialize user to use in other message handlers.
+            Initialize update context to use in other message handlers.
 
-            1. Get user object (also registers user if not exists)
+            1. Get user object (also registers user if not exists) and attach it to the message context.
             3. Demojize message text.
             4. Send user message for auto deletion.
                 All user messages gets deleted from bot after a period of time to keep the bot history clean.
                 This is managed a cron job that deletes old messages periodically.
             """
             # Getting updated user before message reaches any other handler
-            self.stackbot.user = User(
+            user = User(
                 chat_id=message.chat.id, first_name=message.chat.first_name,
                 db=self.db, stackbot=self.stackbot,
             )
+            message.context = UpdateContext(user)
 
             # register if not exits already
-            if not self.stackbot.user.is_registered:
-                self.stackbot.user.register(message)
+            if not user.is_registered:
+                user.register(message)
 
             # Demojize text
             if message.content_type == 'text':
-                message.text = emoji.demojize(message.text)
+                message.text = emojis.demojize(message.text)
 
             self.stackbot.queue_message_deletion(message.chat.id, message.message_id, constants.DELETE_USER_MESSAGES_AFTER_TIME)
 
@@ -47,13 +53,14 @@ class MessageHandler(BaseHandler):
             2. Send how to ask a question guide.
             3. Send start typing message.
             """
-            if not self.stackbot.user.state == states.MAIN:
+            user = message.context.user
+            if not user.state == states.MAIN:
                 return
 
-            self.stackbot.user.update_state(states.ASK_QUESTION)
-            self.stackbot.user.send_message(constants.HOW_TO_ASK_QUESTION_GUIDE, reply_markup=keyboards.send_post)
-            self.stackbot.user.send_message(constants.POST_START_MESSAGE.format(
-                first_name=self.stackbot.user.first_name, post_type='question'
+            user.update_state(states.ASK_QUESTION)
+            user.send_message(constants.HOW_TO_ASK_QUESTION_GUIDE, reply_markup=keyboards.send_post)
+            user.send_message(constants.POST_START_MESSAGE.format(
+                first_name=user.first_name, post_type='question'
             ))
 
         @self.stackbot.bot.message_handler(text=[keys.cancel, keys.back])
@@ -65,53 +72,68 @@ class MessageHandler(BaseHandler):
             2. Send cancel message.
             3. Delete previous bot messages.
             """
-            self.stackbot.user.clean_preview()
-            self.stackbot.user.send_message(constants.BACK_TO_HOME_MESSAGE, reply_markup=keyboards.main)
-            self.stackbot.user.reset()
+            user = message.context.user
+            user.clean_preview()
+            user.send_message(constants.BACK_TO_HOME_MESSAGE, reply_markup=keyboards.main)
+            user.reset()
 
         @self.stackbot.bot.message_handler(text=[keys.send_post])
         def send_post(message):
             """
             User sends a post.
 
-            1. Submit post to database.
-            2. Check if post is not empty.
-            3. Send post to the relevant audience.
-            4. Reset user state and data.
-            5. Delete previous bot messages.
+            1. Show similar questions (once) before a new question is sent, if it is long enough to be sent.
+            2. Submit post to database.
+            3. Check if post is not empty or too short.
+            4. Send post to the relevant audience.
+            5. Reset user state and data.
+            6. Delete previous bot messages.
             """
-            post_id = self.stackbot.user.post.submit()
+            user = message.context.user
+            if user.state == states.ASK_QUESTION and self.send_similar_questions(user):
+                # User clicks send again if the question is not a duplicate
+                return
+
+            post_id = user.post.submit()
             if not post_id:
                 # Either post is empty or too short
                 return
 
-            self.stackbot.user.post.post_id = post_id
-            self.stackbot.user.post.send()
-            self.stackbot.user.send_message(
+            user.post.post_id = post_id
+            user.post.send()
+            user.send_message(
                 text=constants.POST_OPEN_SUCCESS_MESSAGE.format(
-                    post_type=self.stackbot.user.post.post_type.title(),
+                    post_type=user.post.post_type.title(),
                 ),
                 reply_markup=keyboards.main
             )
 
             # Reset user state and data
-            self.stackbot.user.clean_preview()
-            self.stackbot.user.reset()
+            user.clean_preview()
+            user.reset()
 
         @self.stackbot.bot.message_handler(text=[keys.settings])
         def settings(message):
             """
             User wants to change settings.
             """
-            self.stackbot.user.send_message(self.get_settings_text(), self.get_settings_keyboard())
+            user = message.context.user
+            user.send_message(self.get_settings_text(user), self.get_settings_keyboard(user))
 
         @self.stackbot.bot.message_handler(text=[keys.search_questions])
         def search_questions(message):
             """
-            User asks for all questions to search through.
+            User wants to search questions.
+
+            1. Update state.
+            2. Ask for the search keywords (they are handled by echo as long as the user is in search state).
             """
-            gallery_filters = {'type': post_types.QUESTION, 'status': post_status.OPEN}
-            self.send_gallery(gallery_filters=gallery_filters)
+            user = message.context.user
+            if not user.state == states.MAIN:
+                return
+
+            user.update_state(states.SEARCH_QUESTIONS)
+            user.send_message(constants.SEARCH_START_MESSAGE, reply_markup=keyboards.search)
 
         @self.stackbot.bot.message_handler(text=[
             keys.my_questions, keys.my_answers, keys.my_comments, keys.my_bookmarks
@@ -120,10 +142,11 @@ class MessageHandler(BaseHandler):
             """
             User asks for all questions to search through.
             """
+            user = message.context.user
             if message.text == keys.my_bookmarks:
                 # Bookmarks are stored in user collection not each post
                 # This makes it faster to fetch all bookmarks
-                post_ids = self.db.users.find_one({'chat.id': message.chat.id}).get('bookmarks', [])
+                post_ids = user.user.get('bookmarks', [])
                 gallery_filters = {'_id': {'$in': post_ids}}
             else:
                 if message.text == keys.my_questions:
@@ -134,15 +157,16 @@ class MessageHandler(BaseHandler):
                     filter_type = post_types.COMMENT
                 gallery_filters = {'type': filter_type, 'chat.id': message.chat.id}
 
-            self.send_gallery(gallery_filters=gallery_filters)
+            self.send_gallery(user, gallery_filters=gallery_filters)
 
         @self.stackbot.bot.message_handler(text=[keys.my_data])
         def my_data(message):
             """
             User asks for all his data (Questions, Answers, Comments, etc.)
             """
+            user = message.context.user
             # we should change the post_id for the buttons
-            self.stackbot.user.send_message(constants.MY_DATA_MESSAGE, keyboards.my_data)
+            user.send_message(constants.MY_DATA_MESSAGE, keyboards.my_data)
 
         # Handles all other messages with the supported content_types
         @bot.message_handler(content_types=constants.SUPPORTED_CONTENT_TYPES)
@@ -155,40 +179,100 @@ class MessageHandler(BaseHandler):
             3. Send message preview to the user.
             4. Delete previous post preview.
             """
+            user = message.context.user
             print(message.text)
-            if self.stackbot.user.state in states.MAIN:
+            if user.state in states.MAIN:
                 post_id = message.text
 
                 try:
-                    self.stackbot.user.post = BasePost(
-                        db=self.stackbot.user.db, stackbot=self.stackbot,
-                        post_id=post_id, chat_id=self.stackbot.user.chat_id,
+                    user.post = BasePost(
+                        db=user.db, stackbot=self.stackbot,
+                        post_id=post_id, chat_id=user.chat_id,
+                        identity_map=user.identity_map,
                     )
-                    self.stackbot.user.post.send_to_one(message.chat.id)
+                    user.post.send_to_one(message.chat.id)
                 except bson.errors.InvalidId:
                     logger.warning('Invalid post id: {post_id}')
                 return
 
-            elif self.stackbot.user.state in [states.ASK_QUESTION, states.ANSWER_QUESTION, states.COMMENT_POST]:
+            elif user.state == states.SEARCH_QUESTIONS:
+                if message.content_type == 'text':
+                    self.search(user, message.text)
+                return
+
+            elif user.state in [states.ASK_QUESTION, states.ANSWER_QUESTION, states.COMMENT_POST]:
                 # Not all types of post support all content types. For example comments do not support texts.
-                supported_contents = self.stackbot.user.post.supported_content_types
+                supported_contents = user.post.supported_content_types
                 if message.content_type not in supported_contents:
-                    self.stackbot.user.send_message(
+                    user.send_message(
                         constants.UNSUPPORTED_CONTENT_TYPE_MESSAGE.format(supported_contents=' '.join(supported_contents))
                     )
                     return
 
                 # Update the post content with the new message content
-                self.stackbot.user.post.update(message, replied_to_post_id=self.stackbot.user.tracker.get('replied_to_post_id'))
+                user.post.update(message, replied_to_post_id=user.tracker.get('replied_to_post_id'))
 
                 # Send message preview to the user
-                new_preview_message = self.stackbot.user.post.send_to_one(chat_id=message.chat.id, preview=True)
+                new_preview_message = user.post.send_to_one(chat_id=message.chat.id, preview=True)
 
                 # Delete previous preview message and set the new one
-                self.stackbot.user.clean_preview(new_preview_message.message_id)
+                user.clean_preview(new_preview_message.message_id)
                 return
 
-    def send_gallery(self, gallery_filters=None, order_by='date'):
+    def send_similar_questions(self, user) -> bool:
+        """
+        Send open questions that are similar to the question the user is about to send.
+
+        Similar questions are checked only once per question, so the user can still send
+        the question by clicking send again. They are deleted like other bot messages, so
+        they don't stay in the chat history.
+
+        :param user: User who sends the question.
+        :return: True if similar questions are sent.
+        """
+        if user.tracker.get('similar_questions_shown'):
+            return False
+
+        similar_question_ids = user.post.get_similar_questions()
+        if not similar_question_ids:
+            return False
+
+        user.track(similar_questions_shown=True)
+        user.send_message(constants.SIMILAR_QUESTIONS_MESSAGE.format(num_questions=len(similar_question_ids)))
+        for post_id in similar_question_ids:
+            BasePost(
+                db=user.db, stackbot=self.stackbot,
+                post_id=post_id, chat_id=user.chat_id,
+                identity_map=user.identity_map,
+            ).send_to_one(user.chat_id, delete_after=constants.DELETE_BOT_MESSAGES_AFTER_TIME)
+
+        return True
+
+    def search(self, user, query: str):
+        """
+        Send ranked gallery of the open questions that match the query.
+
+        1. Rank questions with the search index.
+        2. Drop posts that are no longer open questions (in case the index is behind the database).
+        3. Send the results as a gallery, best match first.
+
+        :param user: User who searches.
+        :param query: Search keywords.
+        """
+        results = search_index.search(query, limit=constants.SEARCH_MAX_RESULTS)
+        gallery_filters = {
+            '_id': {'$in': [post_id for post_id, _ in results]},
+            'type': post_types.QUESTION, 'status': post_status.OPEN,
+        }
+        open_post_ids = {post['_id'] for post in self.db.post.find(gallery_filters, {'_id': 1})}
+        ranking = [post_id for post_id, _ in results if post_id in open_post_ids]
+        if not ranking:
+            user.send_message(constants.SEARCH_NO_RESULTS_MESSAGE.format(query=html.escape(query)))
+            return
+
+        return self.send_gallery(user, gallery_filters=gallery_filters, ranking=ranking)
+
+    def send_gallery(self, user, gallery_filters=None, ranking: list = None):
         """
         Send gallery of posts starting with the post with post_id.
 
@@ -198,33 +282,27 @@ class MessageHandler(BaseHandler):
         4. Clean the preview messages as galleries are not meant to stay in bot history.
             We delete the galleries after a period of time to keep the bot history clean.
 
-        :param chat_id: Chat id to send gallery to.
-        :param post_id: Post id to start gallery from.
-        :param is_gallery: If True, send gallery of posts. If False, send single post.
-            Next and previous buttions will be added to the message if is_gallery is True.
+        :param user: User to send the gallery to.
+        :param gallery_filters: Filters of the gallery posts.
+            Next and previous buttions will be added to the message if there is more than one post.
+        :param ranking: Unique ids of the gallery posts, best match first. Galleries without
+            ranking are sorted by date, newest first.
         """
-        posts = self.db.post.find(gallery_filters)
-        if order_by:
-            posts = posts.sort(order_by, -1)
-
-        try:
-            next_post_id = next(posts)['_id']
-        except StopIteration:
+        gallery = Gallery(self.db, filters=gallery_filters, ranking=ranking)
+        next_post = gallery.first()
+        if not next_post:
             text = constants.GALLERY_NO_POSTS_MESSAGE.format(post_type=gallery_filters.get('type', 'post'))
-            self.stackbot.user.send_message(text)
+            user.send_message(text)
             return
 
         # Send the posts gallery
-        num_posts = self.db.post.count_documents(gallery_filters)
-        is_gallery = True if num_posts > 1 else False
-
-        self.stackbot.user.post = BasePost(
-            db=self.stackbot.user.db, stackbot=self.stackbot,
-            post_id=next_post_id, chat_id=self.stackbot.user.chat_id,
-            is_gallery=is_gallery, gallery_filters=gallery_filters
+        user.post = BasePost(
+            db=user.db, stackbot=self.stackbot,
+            post_id=next_post['_id'], chat_id=user.chat_id,
+            gallery=gallery, identity_map=user.identity_map,
         )
-        message = self.stackbot.user.post.send_to_one(self.stackbot.user.chat_id)
+        message = user.post.send_to_one(user.chat_id)
 
         # if user asks for this gallery again, we delete the old one to keep the history clean.
-        self.stackbot.user.clean_preview(message.message_id)
+        user.clean_preview(message.message_id)
         return message
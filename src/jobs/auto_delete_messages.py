@@ -1,4 +1,5 @@
 import time
+from collections import defaultdict
 
 from loguru import logger
 from src.bot import bot
@@ -9,47 +10,125 @@ from src.run import StackBot
 
 stackbot = StackBot(db=db, telebot=bot)
 DELETION_SLEEP = 10  # seconds
+DELETION_BATCH_SIZE = 500
 KEEP_LAST_MESSAGES_NUMBER = 3
 
-while True:
-    print('Start deletion process...')
-    chat_ids = set()
-    skip_chat_ids = set()
-    for chat_id in db.auto_delete.distinct('chat_id'):
-        # Only users in main states
-        user = db.users.find_one({'chat.id': chat_id, 'state': states.MAIN})
-        if not user:
-            continue
+# Messages that can not be deleted yet because the user is not in main state are checked again
+# after this delay. Last messages of a chat are kept out of the due queue instead (see keep_messages).
+POSTPONE_DELETION = 60  # seconds
 
-        # Only users that have more than 3 uncleaned messages
-        num_messages = db.auto_delete.count_documents({'chat_id': chat_id})
 
-        # Delete messages
-        for ind, doc in enumerate(db.auto_delete.find({'chat_id': chat_id})):
-            chat_id = doc['chat_id']
-            message_id = doc['message_id']
-            current_time = time.time()
+def backfill_due_at():
+    """
+    Messages queued before due_at was stored get it computed from created_at and delete_after.
+    """
+    db.auto_delete.update_many(
+        {'due_at': {'$exists': False}, 'delete_after': {'$ne': -1}, 'kept': {'$ne': True}},
+        [{'$set': {'due_at': {'$add': ['$created_at', '$delete_after']}}}]
+    )
 
-            # Don't delete the last message
-            if ind >= (num_messages - KEEP_LAST_MESSAGES_NUMBER):
-                continue
 
-            # -1 flag shows the message should not be deleted
-            if doc['delete_after'] == -1:
-                continue
+def get_last_message_ids(chat_ids):
+    """
+    Get ids of the last messages of the chats that should not be deleted, in one query.
+
+    :return: Set of message ids by chat id.
+    """
+    last_messages = db.auto_delete.aggregate([
+        {'$match': {'chat_id': {'$in': list(chat_ids)}}},
+        {'$sort': {'chat_id': 1, 'created_at': -1}},
+        {'$group': {'_id': '$chat_id', 'message_ids': {'$push': '$message_id'}}},
+        {'$project': {'message_ids': {'$slice': ['$message_ids', KEEP_LAST_MESSAGES_NUMBER]}}},
+    ])
+    return {doc['_id']: set(doc['message_ids']) for doc in last_messages}
+
+
+def keep_messages(docs):
+    """
+    Take the last messages of a chat out of the due queue.
+
+    Kept messages have no due_at, so they are not polled again. They are deleted when a newer
+    message of the chat is due (see delete_due_messages) and they are no longer the last ones.
+    """
+    db.auto_delete.update_many(
+        {'_id': {'$in': [doc['_id'] for doc in docs]}},
+        {'$set': {'kept': True}, '$unset': {'due_at': 1}}
+    )
+
+
+def delete_due_messages(current_time):
+    """
+    Delete a batch of messages that are due, in due order.
+
+    :return: Number of processed messages.
+    """
+    due_docs = list(
+        db.auto_delete.find({'due_at': {'$lte': current_time}}).sort('due_at', 1).limit(DELETION_BATCH_SIZE)
+    )
+    if not due_docs:
+        return 0
 
-            remaining_time = doc['created_at'] + doc['delete_after'] - current_time
-            if remaining_time > 0:
+    docs_by_chat = defaultdict(list)
+    for doc in due_docs:
+        docs_by_chat[doc['chat_id']].append(doc)
+
+    # Only users in main states
+    main_state_chat_ids = {
+        user['chat']['id'] for user in db.users.find(
+            {'chat.id': {'$in': list(docs_by_chat)}, 'state': states.MAIN}, {'chat.id': 1}
+        )
+    }
+
+    # Messages kept earlier are deleted with the due messages of their chat once newer messages replace them
+    for doc in db.auto_delete.find({'chat_id': {'$in': list(main_state_chat_ids)}, 'kept': True}):
+        docs_by_chat[doc['chat_id']].append(doc)
+
+    last_message_ids = get_last_message_ids(main_state_chat_ids)
+    deleted, postponed, kept = [], [], []
+    for chat_id, docs in docs_by_chat.items():
+        if chat_id not in main_state_chat_ids:
+            postponed.extend(docs)
+            continue
+
+        # Don't delete the last messages
+        for doc in docs:
+            if doc['message_id'] in last_message_ids.get(chat_id, ()):
+                if not doc.get('kept'):
+                    kept.append(doc)
                 continue
 
-            # Delete message
-            stackbot.delete_message(chat_id=chat_id, message_id=message_id)
-            db.auto_delete.delete_one({'_id': doc['_id']})
+            try:
+                stackbot.bot.delete_message(chat_id, doc['message_id'])
+            except Exception as e:
+                logger.debug(f'Error deleting message: {e}')
+            deleted.append(doc)
+
+    if deleted:
+        # Delete message in auto_delete, callback data and auto_update data
+        db.auto_delete.delete_many({'_id': {'$in': [doc['_id'] for doc in deleted]}})
+        messages = [{'chat_id': doc['chat_id'], 'message_id': doc['message_id']} for doc in deleted]
+        db.callback_data.delete_many({'$or': messages})
+        db.auto_update.delete_many({'$or': messages})
 
-            # Delete message in callback data and auto_update data
-            db.callback_data.delete_many({'chat_id': chat_id, 'message_id': message_id})
-            db.auto_update.delete_many({'chat_id': chat_id, 'message_id': message_id})
+    if postponed:
+        db.auto_delete.update_many(
+            {'_id': {'$in': [doc['_id'] for doc in postponed]}},
+            {'$set': {'due_at': current_time + POSTPONE_DELETION}}
+        )
+
+    if kept:
+        keep_messages(kept)
+
+    return len(due_docs)
+
+
+backfill_due_at()
+while True:
+    print('Start deletion process...')
 
-            chat_ids.add(chat_id)
+    # Keep popping batches until nothing is due, so a backlog is drained in one pass
+    current_time = time.time()
+    while delete_due_messages(current_time) == DELETION_BATCH_SIZE:
+        pass
 
     time.sleep(DELETION_SLEEP)
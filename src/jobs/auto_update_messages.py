@@ -1,56 +1,148 @@
-import concurrent.futures
 import time
 
 from loguru import logger
+from pymongo import DeleteOne, UpdateOne
 from src.bot import bot
 from src.constants import inline_keys
 from src.data_models.base import BasePost
+from src.data_models.gallery import Gallery
 from src.db import db
 from src.run import StackBot
+from src.utils.common import chunked_iterable
 
 
 stackbot = StackBot(db=db, telebot=bot)
 UPDATE_SLEEP = 1 * 60  # seconds
 UPDATE_DELAY = 30
+UPDATE_BATCH_SIZE = 500
 
 
-def update_message(update_doc):
-    chat_id = update_doc['chat_id']
-    message_id = update_doc['message_id']
+def get_latest_callback_data(update_docs):
+    """
+    Get the latest callback data of each message with one query.
 
-    callback_data = db.callback_data.find(
-        {'chat_id': chat_id, 'message_id': message_id}
-    ).sort('created_at', -1)
+    Only messages sent before their buttons and gallery were stored with the update doc need it.
 
-    try:
-        callback_data = next(callback_data)
-    except StopIteration:
-        db.auto_update.delete_one({'_id': update_doc['_id']})
-        return
+    :return: Mapping from (chat_id, message_id) to callback data.
+    """
+    messages = [{'chat_id': doc['chat_id'], 'message_id': doc['message_id']} for doc in update_docs]
+    latest_callback_data = {}
+    if not messages:
+        return latest_callback_data
 
-    current_time = time.time()
-    if (current_time - callback_data['created_at']) < UPDATE_DELAY:
-        return
+    for callback_data in db.callback_data.find({'$or': messages}).sort('created_at', 1):
+        latest_callback_data[(callback_data['chat_id'], callback_data['message_id'])] = callback_data
 
-    post_handler = BasePost(
-        db=db, stackbot=stackbot, post_id=callback_data['post_id'], chat_id=chat_id,
-        is_gallery=callback_data['is_gallery'], gallery_filters=callback_data['gallery_filters']
-    )
+    return latest_callback_data
 
-    text, keyboard = post_handler.get_text_and_keyboard()
-    if (inline_keys.show_less not in callback_data['buttons']) and (inline_keys.actions in callback_data['buttons']):
-        stackbot.edit_message(chat_id, message_id, text=text, reply_markup=keyboard)
 
-while True:
-    print('Start update process...')
-    # with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-    #     for update_doc in db.auto_update.find():
-    #         executor.submit(update_message, update_doc)
+def backfill_post_ids():
+    """
+    Messages queued before post_id and rendered_at were stored get them from their latest callback data.
+
+    Messages without callback data can't be re-rendered and are removed.
+    """
+    legacy_docs = db.auto_update.find({'post_id': {'$exists': False}}, {'chat_id': 1, 'message_id': 1})
+    for update_docs_chunk in chunked_iterable(legacy_docs, UPDATE_BATCH_SIZE):
+        latest_callback_data = get_latest_callback_data(update_docs_chunk)
+
+        requests = []
+        for update_doc in update_docs_chunk:
+            callback_data = latest_callback_data.get((update_doc['chat_id'], update_doc['message_id']))
+            if callback_data is None:
+                requests.append(DeleteOne({'_id': update_doc['_id']}))
+            else:
+                requests.append(UpdateOne({'_id': update_doc['_id']}, {'$set': {
+                    'post_id': callback_data['post_id'], 'rendered_at': callback_data['created_at'],
+                }}))
+
+        db.auto_update.bulk_write(requests, ordered=False)
+
+
+def update_post_messages(post_id, update_docs):
+    """
+    Re-render messages showing the post with post_id.
+
+    Post text and shared keys are rendered once, and each message only gets its own
+    like status and gallery position on top of them.
+    """
+    post_handler = BasePost(db=db, stackbot=stackbot, post_id=post_id)
+    text = post_handler.get_text()
+    shared_keys = post_handler.get_shared_keys()
+
+    for update_docs_chunk in chunked_iterable(update_docs, UPDATE_BATCH_SIZE):
+        current_time = time.time()
+        legacy_docs = [doc for doc in update_docs_chunk if 'buttons' not in doc]
+        latest_callback_data = get_latest_callback_data(legacy_docs)
+        likers = post_handler.get_likers({doc['chat_id'] for doc in update_docs_chunk})
+
+        rendered_ids, removed_ids = [], []
+        for update_doc in update_docs_chunk:
+            chat_id, message_id = update_doc['chat_id'], update_doc['message_id']
+            if 'buttons' in update_doc:
+                buttons, gallery = update_doc['buttons'], Gallery.from_dict(db, update_doc['gallery'])
+            else:
+                callback_data = latest_callback_data.get((chat_id, message_id))
+                if callback_data is None:
+                    removed_ids.append(update_doc['_id'])
+                    continue
+                if callback_data['post_id'] != post_id:
+                    continue
+                buttons, gallery = callback_data['buttons'], Gallery.from_callback_data(db, callback_data)
+
+            # User is interacting with the message, it is rendered by the bot itself.
+            # The post is checked again in the next run as changed posts are looked up with UPDATE_DELAY overlap.
+            if (current_time - update_doc['rendered_at']) < UPDATE_DELAY:
+                continue
+
+            # Only the main keyboard of the post is re-rendered (not actions, attachments or the full text)
+            if (inline_keys.show_less not in buttons) and (inline_keys.actions in buttons):
+                post_handler.gallery = gallery
+                keyboard = post_handler.get_viewer_keyboard(*shared_keys, liked_by_user=chat_id in likers)
+                stackbot.edit_message(chat_id, message_id, text=text, reply_markup=keyboard, post=post_handler)
+            else:
+                rendered_ids.append(update_doc['_id'])
+
+        # Messages showing other keyboards are up to date until the post changes again
+        if rendered_ids:
+            db.auto_update.update_many({'_id': {'$in': rendered_ids}}, {'$set': {'rendered_at': current_time}})
+        if removed_ids:
+            db.auto_update.delete_many({'_id': {'$in': removed_ids}})
+
+        # Messages re-rendered by the job are recorded like the ones edited by the bot
+        stackbot.flush_rendered_messages()
+
+
+def update_changed_posts(since):
+    """
+    Re-render messages whose post has changed after the message was rendered.
+
+    :param since: Only posts updated after this unix time are checked.
+    """
+    for post in db.post.find({'updated_at': {'$gt': since}}, {'updated_at': 1}):
+        stale_messages = list(
+            db.auto_update.find({'post_id': post['_id'], 'rendered_at': {'$lt': post['updated_at']}})
+        )
+        if not stale_messages:
+            continue
 
-    for update_doc in db.auto_update.find():
         try:
-            update_message(update_doc)
+            update_post_messages(post['_id'], stale_messages)
         except Exception as e:
             logger.exception(e)
 
+
+# Last run time is stored so that changes made while the job is down are not missed.
+job_state = db.jobs.find_one({'_id': 'auto_update'}) or {}
+last_run_at = job_state.get('last_run_at', time.time())
+
+backfill_post_ids()
+while True:
+    print('Start update process...')
+    current_time = time.time()
+    update_changed_posts(since=last_run_at - UPDATE_DELAY)
+
+    last_run_at = current_time
+    db.jobs.update_one({'_id': 'auto_update'}, {'$set': {'last_run_at': last_run_at}}, upsert=True)
+
     time.sleep(UPDATE_SLEEP)
@@ -0,0 +1,66 @@
+"""
+Rebuild denormalized post counters (num_answers, num_comments, num_likes) from scratch.
+
+Counters are maintained with $inc on every write path. Run this once after deploying the
+counters to backfill existing posts, or any time to repair drifted counters:
+
+    python src/jobs/rebuild_post_counters.py
+"""
+from collections import defaultdict
+
+from loguru import logger
+from pymongo import UpdateOne
+from src.constants import REPLY_COUNTER_FIELDS, post_status
+from src.db import db
+from src.utils.common import chunked_iterable
+
+BATCH_SIZE = 1000
+
+
+def count_open_replies(db) -> dict:
+    """
+    Count open replies of each post grouped by reply type.
+
+    :return: Mapping from post_id to its counters, e.g. {post_id: {'num_answers': 2}}.
+    """
+    counters = defaultdict(dict)
+    pipeline = [
+        {'$match': {'status': post_status.OPEN, 'type': {'$in': list(REPLY_COUNTER_FIELDS)}}},
+        {'$group': {'_id': {'post_id': '$replied_to_post_id', 'type': '$type'}, 'count': {'$sum': 1}}},
+    ]
+    for row in db.post.aggregate(pipeline):
+        post_id, post_type = row['_id'].get('post_id'), row['_id']['type']
+        if post_id:
+            counters[post_id][REPLY_COUNTER_FIELDS[post_type]] = row['count']
+
+    return counters
+
+
+def rebuild_post_counters(db) -> int:
+    """
+    Recompute counters of all posts and write them in bulk.
+
+    :return: Number of updated posts.
+    """
+    reply_counters = count_open_replies(db)
+
+    num_updated = 0
+    posts = db.post.find({}, {'_id': 1, 'num_likes': {'$size': {'$ifNull': ['$likes', []]}}})
+    for chunk in chunked_iterable(posts, BATCH_SIZE):
+        requests = []
+        for post in chunk:
+            counters = {field: 0 for field in REPLY_COUNTER_FIELDS.values()}
+            counters.update(reply_counters.get(post['_id'], {}))
+            counters['num_likes'] = post['num_likes']
+            requests.append(UpdateOne({'_id': post['_id']}, {'$set': counters}))
+
+        result = db.post.bulk_write(requests, ordered=False)
+        num_updated += result.modified_count
+
+    return num_updated
+
+
+if __name__ == '__main__':
+    logger.info('Rebuilding post counters...')
+    num_updated = rebuild_post_counters(db)
+    logger.info(f'Post counters rebuilt. {num_updated} posts updated.')
@@ -0,0 +1,17 @@
+"""
+Rebuild the full-text search index of questions from database.
+
+The bot keeps the index up to date on every submit, close/open and delete, and builds it on
+its first start. Run this to repair the index, e.g. after posts are changed directly in database.
+Stop the bot first, as it holds the index in memory and would overwrite the rebuilt files:
+
+    python src/jobs/rebuild_search_index.py
+"""
+from loguru import logger
+from src.db import db
+from src.search import search_index
+
+if __name__ == '__main__':
+    logger.info('Rebuilding search index...')
+    search_index.build(db)
+    logger.info(f'Search index rebuilt with {len(search_index)} questions.')
@@ -0,0 +1,45 @@
+"""
+Rebuild truncated text (truncated_text, needs_truncation) of submitted posts from scratch.
+
+Truncated text is stored when a post is submitted. Posts submitted before it was stored are
+truncated on every render until this job backfills them. Run it once after deploying, and
+after changing how posts are truncated:
+
+    python src/jobs/rebuild_truncated_texts.py
+"""
+from loguru import logger
+from pymongo import UpdateOne
+from src.constants import post_status
+from src.data_models.base import BasePost
+from src.db import db
+from src.utils.common import chunked_iterable
+
+BATCH_SIZE = 1000
+
+
+def rebuild_truncated_texts(db) -> int:
+    """
+    Recompute truncated text of all submitted posts and write them in bulk.
+
+    :return: Number of updated posts.
+    """
+    num_updated = 0
+    posts = db.post.find({'status': {'$ne': post_status.PREP}}, {'text': 1})
+    for chunk in chunked_iterable(posts, BATCH_SIZE):
+        requests = []
+        for post in chunk:
+            truncated_text, needs_truncation = BasePost.truncate_post_text(BasePost.get_post_text(post))
+            requests.append(UpdateOne({'_id': post['_id']}, {'$set': {
+                'truncated_text': truncated_text, 'needs_truncation': needs_truncation,
+            }}))
+
+        result = db.post.bulk_write(requests, ordered=False)
+        num_updated += result.modified_count
+
+    return num_updated
+
+
+if __name__ == '__main__':
+    logger.info('Rebuilding truncated texts...')
+    num_updated = rebuild_truncated_texts(db)
+    logger.info(f'Truncated texts rebuilt. {num_updated} posts updated.')
@@ -0,0 +1,21 @@
+"""
+Show queue depth, number of processed updates and latency of the dispatcher lanes.
+
+The bot stores them in database every DISPATCHER_STATS_INTERVAL seconds, in polling and
+webhook modes alike:
+
+    python src/jobs/show_dispatcher_stats.py
+"""
+import json
+import time
+
+from loguru import logger
+from src.db import db
+
+if __name__ == '__main__':
+    stats = db.stats.find_one({'_id': 'dispatcher'})
+    if not stats:
+        logger.info('No dispatcher stats stored yet.')
+    else:
+        logger.info(f'Dispatcher stats of {time.time() - stats["updated_at"]:.0f} seconds ago:')
+        print(json.dumps(stats['lanes'], indent=2))
@@ -1,19 +1,32 @@
+import os
 import re
 import sys
+import threading
 import time
 from typing import Union
 
-import emoji
 from bson.objectid import ObjectId
 from loguru import logger
+from pymongo import UpdateOne
 from telebot import custom_filters, types
 
 from src.bot import bot
-from src.constants import (DELETE_BOT_MESSAGES_AFTER_TIME,
-                           DELETE_FILE_MESSAGES_AFTER_TIME)
+from src.broadcast import Broadcast
+from src.callback_data import CallbackData
+from src.constants import (AUTO_UPDATE_FLUSH_INTERVAL,
+                           DELETE_BOT_MESSAGES_AFTER_TIME,
+                           DELETE_FILE_MESSAGES_AFTER_TIME,
+                           DISPATCHER_MAX_QUEUE_SIZE, DISPATCHER_NUM_LANES,
+                           DISPATCHER_STATS_INTERVAL, WEBHOOK_HOST,
+                           WEBHOOK_MAX_BODY_SIZE, WEBHOOK_PORT)
 from src.db import db
+from src.dispatcher import UpdateDispatcher
+from src.export import export_queue
 from src.filters import IsAdmin
 from src.handlers import CallbackHandler, CommandHandler, MessageHandler
+from src.search import search_index
+from src.utils import emojis
+from src.webhook import WebhookServer
 
 logger.remove()
 logger.add(sys.stderr, format="{time} {level} {message}", level="ERROR")
@@ -34,10 +47,6 @@ class StackBot:
         self.bot.add_custom_filter(custom_filters.TextMatchFilter())
         self.bot.add_custom_filter(custom_filters.TextStartsFilter())
 
-        # User (user can be None when bot is not used by a user, but
-        # used for sending messages in general)
-        self.user = None
-
         # Note: The order of handlers matters as the first
         # handler that matches a message will be executed.
         self.handlers = [
@@ -47,10 +56,83 @@ class StackBot:
         ]
         self.register()
 
-    def run(self):
+        # Renders of auto updated messages waiting to be written, keyed by (chat_id, message_id)
+        self.rendered_messages = {}
+        self._rendered_messages_lock = threading.Lock()
+
+        # Updates are processed in order per chat and in parallel across chats
+        self.dispatcher = UpdateDispatcher(
+            self.bot, num_lanes=DISPATCHER_NUM_LANES, max_queue_size=DISPATCHER_MAX_QUEUE_SIZE,
+        )
+
+    def run(self, polling_timeout: int = 20):
+        """
+        Run bot with long polling. Updates are fed to the dispatcher, polling waits
+        when the lane of a chat is full.
+        """
+        self.start()
+
         # run bot with polling
         logger.info('Bot is running...')
-        self.bot.infinity_polling()
+        offset = None
+        while True:
+            try:
+                updates = self.bot.get_updates(
+                    offset=offset, timeout=polling_timeout, long_polling_timeout=polling_timeout
+                )
+            except Exception as e:
+                logger.error(f'Error getting updates: {e}')
+                time.sleep(3)
+                continue
+
+            for update in updates:
+                self.dispatcher.submit(update)
+                offset = update.update_id + 1
+
+    def run_webhook(
+        self, secret_token: str, url: str = None,
+        host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT,
+    ):
+        """
+        Run bot in webhook mode: Telegram posts updates to a local HTTP server.
+
+        :param secret_token: Secret token that authorizes Telegram requests.
+        :param url: Public url of the server. If None, webhook is not set on Telegram,
+            which is useful for posting recorded updates to the server locally.
+        :param host: Host to listen on.
+        :param port: Port to listen on.
+        """
+        if not secret_token:
+            raise ValueError('Webhook secret token is required.')
+
+        self.start()
+
+        if url:
+            # Secret token is sent as the url path, so we can tell Telegram requests apart.
+            self.bot.remove_webhook()
+            self.bot.set_webhook(url=f"{url.rstrip('/')}/{secret_token}")
+
+        server = WebhookServer(
+            self.dispatcher, secret_token=secret_token, host=host, port=port,
+            max_body_size=WEBHOOK_MAX_BODY_SIZE,
+        )
+        logger.info('Bot is running in webhook mode...')
+        server.serve_forever()
+
+    def start(self):
+        """
+        Prepare the bot process before receiving updates. Jobs that create a StackBot
+        only to send or edit messages don't call this.
+        """
+        # Full-text search index of questions, loaded from disk (or built on first run)
+        search_index.open(self.db)
+        export_queue.start()
+
+        # Resume broadcasts interrupted by the last shutdown
+        Broadcast.resume_all(self.db, self)
+        self.dispatcher.start()
+        self.dispatcher.start_stats_reporter(self.db, interval=DISPATCHER_STATS_INTERVAL)
+        threading.Thread(target=self.flush_rendered_messages_forever, name='rendered-messages', daemon=True).start()
 
     def register(self):
         for handler in self.handlers:
@@ -62,6 +144,7 @@ class StackBot:
         emojize: bool = True,
         delete_after: Union[int, bool] = DELETE_BOT_MESSAGES_AFTER_TIME,
         auto_update: bool = False,
+        post=None,
     ):
         """
         Send message to telegram bot having a chat_id and text_content.
@@ -71,12 +154,16 @@ class StackBot:
         :param reply_markup: Reply markup of the message.
         :param emojize: Emojize the text.
         :param delete_after: Auto delete message in seconds.
+        :param auto_update: Re-render message when its post changes.
+        :param post: Post handler of the post shown in the message. Messages of
+            the bot that are not about a post (e.g. general notifications) have no post.
         """
-        text = emoji.emojize(text) if emojize else text
+        text = emojis.emojize(text) if emojize else text
+        reply_markup = self.encode_callback_data(reply_markup, post)
         message = self.bot.send_message(chat_id, text, reply_markup=reply_markup)
 
         if auto_update:
-            self.queue_message_update(chat_id, message.message_id)
+            self.queue_message_update(chat_id, message.message_id, post, reply_markup)
 
         if (type(delete_after) == int) and isinstance(reply_markup, types.ReplyKeyboardMarkup):
             # We need to keep the message which generated main keyboard so that
@@ -87,31 +174,29 @@ class StackBot:
             delete_after = -1
             self.db.auto_delete.update_many(
                 {'chat_id': chat_id, 'delete_after': -1},
-                {'$set': {'delete_after': 1}}
+                {'$set': {'delete_after': 1, 'due_at': time.time() + 1}}
             )
             self.queue_message_deletion(chat_id, message.message_id, delete_after)
         elif delete_after:
             self.queue_message_deletion(chat_id, message.message_id, delete_after)
 
-        # If user is None, we don't have to update any callback data.
-        # The message is sent by the bot and not by the user.
-        if self.user is not None:
-            self.update_callback_data(chat_id, message.message_id, reply_markup)
-        else:
-            logger.warning("User is None, callback data won't be updated.")
-
         return message
 
     def edit_message(
         self, chat_id: int, message_id: int, text: str = None,
         reply_markup: Union[types.ReplyKeyboardMarkup, types.InlineKeyboardMarkup] = None,
         emojize: bool = True,
+        post=None,
     ):
         """
         Edit telegram message text and/or reply_markup.
+
+        :param post: Post handler of the post shown in the message. Auto updated messages
+            record the new render only when the post is given.
         """
         if emojize and text:
-            text = emoji.emojize(text)
+            text = emojis.emojize(text)
+        reply_markup = self.encode_callback_data(reply_markup, post)
 
         # if message text or reply_markup is the same as before, telegram raises an invalid request error
         # so we are doing try/catch to avoid this.
@@ -123,7 +208,8 @@ class StackBot:
             elif text:
                 self.bot.edit_message_text(text=text, chat_id=chat_id, message_id=message_id)
 
-            self.update_callback_data(chat_id, message_id, reply_markup)
+            if post is not None:
+                self.mark_message_rendered(chat_id, message_id, post, reply_markup)
         except Exception as e:
             logger.debug(f'Error editing message: {e}')
 
@@ -178,61 +264,120 @@ class StackBot:
         """
         Get post_id from message text.
         """
-        text = emoji.demojize(text)
+        text = emojis.demojize(text)
         last_line = text.split('\n')[-1]
         pattern = '^:ID_button: (?P<id>[A-Za-z0-9]+)$'
         match = re.match(pattern, last_line)
-        post_id = match.group('id') if match else None
-        return ObjectId(post_id)
+        return ObjectId(match.group('id')) if match else None
 
     def queue_message_deletion(self, chat_id: int, message_id: int, delete_after: Union[int, bool]):
-        self.db.auto_delete.insert_one({
+        """
+        Schedule message for deletion after delete_after seconds.
+        Messages with delete_after=-1 are kept until another message replaces them.
+        """
+        created_at = time.time()
+        doc = {
             'chat_id': chat_id, 'message_id': message_id,
-            'delete_after': delete_after, 'created_at': time.time(),
-        })
+            'delete_after': delete_after, 'created_at': created_at,
+        }
+        if delete_after != -1:
+            # Deletion job pops messages by due time
+            doc['due_at'] = created_at + delete_after
+        self.db.auto_delete.insert_one(doc)
+
+    def encode_callback_data(
+        self, reply_markup: Union[types.ReplyKeyboardMarkup, types.InlineKeyboardMarkup], post=None
+    ):
+        """
+        Encode action codes of inline keys with the post and gallery of the message, so callbacks
+        don't need to look up the message. Other keyboards are returned as they are.
+        """
+        if not isinstance(reply_markup, types.InlineKeyboardMarkup):
+            return reply_markup
 
-    def queue_message_update(self, chat_id: int, message_id: int):
+        if post is None:
+            return CallbackData.encode_keyboard(reply_markup)
+
+        gallery = post.gallery if post.is_gallery else None
+        return CallbackData.encode_keyboard(reply_markup, post.post_id, gallery)
+
+    @staticmethod
+    def get_message_state(post, reply_markup) -> dict:
+        """
+        Post, gallery and buttons of a message, used by the auto update job to re-render it.
+        """
+        state = {
+            'post_id': post.post_id,
+            'gallery': post.gallery.as_dict() if post.is_gallery else None,
+        }
+
+        if isinstance(reply_markup, types.InlineKeyboardMarkup):
+            # Buttons tell which keyboard the message shows, e.g. the job only re-renders main keyboards.
+            state['buttons'] = [emojis.demojize(button.text) for row in reply_markup.keyboard for button in row]
+
+        return state
+
+    def queue_message_update(self, chat_id: int, message_id: int, post, reply_markup=None):
+        """
+        Keep message fresh with its post. Message is re-rendered by the auto update job
+        when the post is updated after the message is rendered.
+        """
+        current_time = time.time()
         self.db.auto_update.insert_one({
-            'chat_id': chat_id, 'message_id': message_id, 'created_at': time.time(),
+            'chat_id': chat_id, 'message_id': message_id,
+            'created_at': current_time, 'rendered_at': current_time,
+            **self.get_message_state(post, reply_markup),
         })
 
-    def update_callback_data(
-        self, chat_id: int, message_id: int,
-        reply_markup: Union[types.ReplyKeyboardMarkup, types.InlineKeyboardMarkup]
-    ):
-        if reply_markup and isinstance(reply_markup, types.InlineKeyboardMarkup):
-
-            # If the reply_markup is an inline keyboard with actions button, it is the main keyboard and
-            # we update its data once in a while to keep it fresh with number of likes, etc.
-            buttons = []
-            for sublist in reply_markup.keyboard:
-                sub_buttons = map(lambda button: emoji.demojize(button.text), sublist)
-                buttons.extend(list(sub_buttons))
-
-            self.db.callback_data.update_one(
-                {
-                    'chat_id': chat_id,
-                    'message_id': message_id,
-                    'post_id': self.user.post.post_id,
-                },
-                {
-                    '$set': {
-                        'is_gallery': self.user.post.is_gallery,
-                        'gallery_filters': self.user.post.gallery_filters,
-
-                        # We need the buttons to check to not update it asynchroneously
-                        # with the wrong keys.
-                        'buttons': buttons,
-
-                        # We need the date of the callback data update to get the current active post on
-                        # the gallery for refreshing post info such as likes, answers, etc.
-                        'created_at': time.time()
-                    }
-                },
-                upsert=True
-            )
+    def mark_message_rendered(self, chat_id: int, message_id: int, post, reply_markup=None):
+        """
+        Record what an auto updated message shows and when it was rendered.
+
+        Renders are kept in memory and written in batches by flush_rendered_messages, so flipping
+        through a gallery does not write on every page. Only the last render of a message is written.
+        Messages that are not about a post (e.g. settings) are not auto updated and not recorded.
+        """
+        if post.post_id is None:
+            return
+
+        state = {'rendered_at': time.time(), **self.get_message_state(post, reply_markup)}
+        with self._rendered_messages_lock:
+            self.rendered_messages[(chat_id, message_id)] = state
+
+    def flush_rendered_messages(self) -> None:
+        """
+        Write the recorded renders of auto updated messages in one bulk write.
+        """
+        with self._rendered_messages_lock:
+            rendered_messages, self.rendered_messages = self.rendered_messages, {}
+
+        if not rendered_messages:
+            return
+
+        self.db.auto_update.bulk_write([
+            UpdateOne({'chat_id': chat_id, 'message_id': message_id}, {'$set': state})
+            for (chat_id, message_id), state in rendered_messages.items()
+        ], ordered=False)
+
+    def flush_rendered_messages_forever(self) -> None:
+        while True:
+            time.sleep(AUTO_UPDATE_FLUSH_INTERVAL)
+            try:
+                self.flush_rendered_messages()
+            except Exception as e:
+                logger.error(f'Error writing rendered messages: {e}')
 
 if __name__ == '__main__':
     logger.info('Bot started...')
     stackbot = StackBot(telebot=bot, db=db)
-    stackbot.run()
+
+    # Webhook mode is enabled by setting a secret token, otherwise bot uses polling.
+    webhook_secret = os.environ.get('TELEGRAMBOT_WEBHOOK_SECRET')
+    if webhook_secret:
+        stackbot.run_webhook(
+            secret_token=webhook_secret,
+            url=os.environ.get('TELEGRAMBOT_WEBHOOK_URL'),
+            port=int(os.environ.get('TELEGRAMBOT_WEBHOOK_PORT', WEBHOOK_PORT)),
+        )
+    else:
+        stackbot.run()
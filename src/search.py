@@ -0,0 +1,295 @@
+import heapq
+import html
+import json
+import math
+import os
+import pickle
+import re
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import List, Tuple
+
+from bson.objectid import ObjectId
+from loguru import logger
+from src.constants import (SEARCH_BM25_B, SEARCH_BM25_K1,
+                           SEARCH_INDEX_COMPACT_AFTER, SEARCH_INDEX_DIR,
+                           post_status, post_types)
+
+SNAPSHOT_FILE = 'index.pickle'
+JOURNAL_FILE = 'journal.jsonl'
+SNAPSHOT_VERSION = 1
+
+TAG_PATTERN = re.compile(r'<[^>]+>')
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split post text (telegram html) into lowercase word tokens.
+    """
+    text = html.unescape(TAG_PATTERN.sub(' ', text or ''))
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class SearchIndex:
+    """
+    Inverted index over raw_text of open questions with BM25 ranking and TF-IDF similarity.
+
+    The index is kept in memory and persisted to a directory as a snapshot (pickle) and a journal
+    of the changes made after it. Every change is appended to the journal, and the journal is
+    folded into a new snapshot once it has SEARCH_INDEX_COMPACT_AFTER entries. At startup the
+    snapshot is loaded and the journal is replayed; replaying is idempotent, so a crash between
+    writing the snapshot and truncating the journal is harmless.
+    """
+    def __init__(self, path: Path = SEARCH_INDEX_DIR):
+        """
+        :param path: Directory of the index files.
+        """
+        self.path = Path(path)
+        self.postings = defaultdict(dict)  # term -> {post_id: term frequency}
+        self.doc_terms = {}  # post_id -> {term: term frequency}
+        self.doc_lengths = {}  # post_id -> number of tokens
+        self.doc_norms = {}  # post_id -> norm of the tf-idf vector
+        self.total_length = 0
+        self.journal_size = 0
+        self._lock = threading.RLock()
+
+    @property
+    def snapshot_path(self) -> Path:
+        return self.path / SNAPSHOT_FILE
+
+    @property
+    def journal_path(self) -> Path:
+        return self.path / JOURNAL_FILE
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def open(self, db) -> None:
+        """
+        Load the index from disk, or build it from database if it has not been stored yet.
+        """
+        with self._lock:
+            if self.snapshot_path.exists() or self.journal_path.exists():
+                self.load()
+            else:
+                self.build(db)
+        logger.info(f'Search index loaded with {len(self)} posts.')
+
+    def load(self) -> None:
+        with self._lock:
+            self.clear()
+            if self.snapshot_path.exists():
+                with open(self.snapshot_path, 'rb') as f:
+                    snapshot = pickle.load(f)
+                if snapshot.get('version') == SNAPSHOT_VERSION:
+                    for post_id, terms in snapshot['doc_terms'].items():
+                        self._add(post_id, terms)
+
+            if self.journal_path.exists():
+                with open(self.journal_path) as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # Last line is cut if the bot stopped while writing it
+                            continue
+                        self._remove(entry['post_id'])
+                        if entry.get('text') is not None:
+                            self._add(entry['post_id'], Counter(tokenize(entry['text'])))
+                        self.journal_size += 1
+
+            self.update_norms()
+
+    def build(self, db) -> None:
+        """
+        Rebuild the index from all open questions in database and store it.
+        """
+        with self._lock:
+            self.clear()
+            query = {'type': post_types.QUESTION, 'status': post_status.OPEN}
+            for post in db.post.find(query, {'raw_text': 1}):
+                self._add(str(post['_id']), Counter(tokenize(post.get('raw_text'))))
+            self.save()
+
+    def save(self) -> None:
+        """
+        Write a new snapshot atomically and truncate the journal.
+        """
+        with self._lock:
+            self.update_norms()
+            self.path.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.snapshot_path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'version': SNAPSHOT_VERSION, 'doc_terms': self.doc_terms}, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.snapshot_path)
+
+            open(self.journal_path, 'w').close()
+            self.journal_size = 0
+
+    def clear(self) -> None:
+        with self._lock:
+            self.postings.clear()
+            self.doc_terms.clear()
+            self.doc_lengths.clear()
+            self.doc_norms.clear()
+            self.total_length = 0
+            self.journal_size = 0
+
+    def add(self, post_id: ObjectId, text: str) -> None:
+        """
+        Index post text. A post that is already indexed is replaced (e.g. after an edit).
+        """
+        post_id = str(post_id)
+        with self._lock:
+            self._remove(post_id)
+            self._add(post_id, Counter(tokenize(text)))
+            self.log(post_id, text)
+
+    def remove(self, post_id: ObjectId) -> None:
+        post_id = str(post_id)
+        with self._lock:
+            if post_id in self.doc_terms:
+                self._remove(post_id)
+                self.log(post_id, None)
+
+    def index_post(self, post: dict) -> None:
+        """
+        Keep the index in sync with a question: open questions are indexed and other questions are removed.
+        Only questions are searched, so other posts (answers, comments) are ignored.
+        """
+        if post.get('type') != post_types.QUESTION:
+            return
+
+        if post.get('status') == post_status.OPEN:
+            self.add(post['_id'], post.get('raw_text', ''))
+        else:
+            self.remove(post['_id'])
+
+    def search(self, query: str, limit: int = 100) -> List[Tuple[ObjectId, float]]:
+        """
+        Rank indexed posts by BM25 score of the query.
+
+        :param query: Search keywords.
+        :param limit: Maximum number of results.
+        :return: (post_id, score) of the matching posts, best match first.
+        """
+        terms = set(tokenize(query))
+        scores = defaultdict(float)
+        with self._lock:
+            num_docs = len(self.doc_lengths)
+            if not num_docs:
+                return []
+
+            avg_length = self.total_length / num_docs
+            for term in terms:
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+
+                idf = math.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                for post_id, tf in postings.items():
+                    length_norm = 1 - SEARCH_BM25_B + SEARCH_BM25_B * self.doc_lengths[post_id] / avg_length
+                    scores[post_id] += idf * tf * (SEARCH_BM25_K1 + 1) / (tf + SEARCH_BM25_K1 * length_norm)
+
+        # Ties are broken by post_id, i.e. newer posts first
+        ranked = sorted(scores.items(), key=lambda item: (item[1], item[0]), reverse=True)[:limit]
+        return [(ObjectId(post_id), score) for post_id, score in ranked]
+
+    def similar(
+        self, text: str, limit: int = 3, min_score: float = 0.5
+    ) -> List[Tuple[ObjectId, float]]:
+        """
+        Find indexed posts similar to text by cosine similarity of their TF-IDF vectors.
+
+        Only posts that share a term with text are scored, through the postings of its terms.
+
+        :param text: Text of the new post.
+        :param limit: Maximum number of results.
+        :param min_score: Minimum cosine similarity (0 to 1) of the results.
+        :return: (post_id, similarity) of the similar posts, most similar first.
+        """
+        terms = Counter(tokenize(text))
+        dot_products = defaultdict(float)
+        with self._lock:
+            query_norm = 0
+            for term, tf in terms.items():
+                idf = self.idf(term)
+                query_norm += (tf * idf) ** 2
+                for post_id, doc_tf in self.postings.get(term, {}).items():
+                    dot_products[post_id] += tf * doc_tf * idf * idf
+
+            if not query_norm:
+                return []
+
+            query_norm = math.sqrt(query_norm)
+            scores = [
+                (post_id, dot_product / (query_norm * self.doc_norms[post_id]))
+                for post_id, dot_product in dot_products.items() if self.doc_norms.get(post_id)
+            ]
+
+        ranked = heapq.nlargest(limit, (item for item in scores if item[1] >= min_score), key=lambda item: item[1])
+        return [(ObjectId(post_id), min(score, 1.0)) for post_id, score in ranked]
+
+    def idf(self, term: str) -> float:
+        """
+        Smoothed inverse document frequency of term (TF-IDF weight).
+        """
+        return math.log((1 + len(self.doc_lengths)) / (1 + len(self.postings.get(term, ())))) + 1
+
+    def norm(self, terms: dict) -> float:
+        return math.sqrt(sum((tf * self.idf(term)) ** 2 for term, tf in terms.items()))
+
+    def update_norms(self) -> None:
+        """
+        Recompute the TF-IDF norms of all posts.
+
+        Norms of new posts are computed with the idf at the time they are added, so they drift
+        slightly as the index grows. They are refreshed whenever the index is loaded or saved.
+        """
+        with self._lock:
+            self.doc_norms = {post_id: self.norm(terms) for post_id, terms in self.doc_terms.items()}
+
+    def log(self, post_id: str, text: str = None) -> None:
+        """
+        Append a change to the journal. Text is None for removed posts.
+        """
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps({'post_id': post_id, 'text': text}) + '\n')
+
+        self.journal_size += 1
+        if self.journal_size >= SEARCH_INDEX_COMPACT_AFTER:
+            self.save()
+
+    def _add(self, post_id: str, terms: Counter) -> None:
+        if not terms:
+            return
+
+        self.doc_terms[post_id] = dict(terms)
+        for term, tf in terms.items():
+            self.postings[term][post_id] = tf
+
+        length = sum(terms.values())
+        self.doc_lengths[post_id] = length
+        self.total_length += length
+        self.doc_norms[post_id] = self.norm(terms)
+
+    def _remove(self, post_id: str) -> None:
+        terms = self.doc_terms.pop(post_id, None)
+        if terms is None:
+            return
+
+        for term in terms:
+            postings = self.postings[term]
+            postings.pop(post_id, None)
+            if not postings:
+                del self.postings[term]
+
+        self.total_length -= self.doc_lengths.pop(post_id)
+        self.doc_norms.pop(post_id, None)
+
+
+# Shared index of the bot process, opened by StackBot at startup
+search_index = SearchIndex()
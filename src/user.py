@@ -1,3 +1,4 @@
+import copy
 from typing import Any, Union
 
 from loguru import logger
@@ -8,6 +9,14 @@ from src.constants import (DELETE_BOT_MESSAGES_AFTER_TIME, inline_keys,
                            keyboards, post_status, post_types, states)
 from src.data_models import Answer, Comment, Question
 from src.data_models.base import BasePost
+from src.data_models.identity_map import PostIdentityMap
+from src.utils.cache import TTLCache
+
+# Hot user documents are kept in memory between updates. The cache is per process: writes of the bot
+# go through User and keep it in sync, writes to users from other processes (jobs, export workers, mongo
+# shell) are served stale until the entry expires, for at most USER_CACHE_TTL. Such writers must not need
+# the bot to see the change sooner, or the bot must run with USER_CACHE_MAX_SIZE = 0.
+user_cache = TTLCache(maxsize=constants.USER_CACHE_MAX_SIZE, ttl=constants.USER_CACHE_TTL)
 
 
 class User:
@@ -33,6 +42,12 @@ class User:
         self.post_id = post_id
         self._post = None
 
+        # Posts loaded during this update are shared by all post handlers of the user
+        self.identity_map = PostIdentityMap(db)
+
+        # User document snapshot, loaded once per update
+        self._user = None
+
     @staticmethod
     def get_post_handler(state, post_type):
         if (post_type == post_types.QUESTION) or (state == states.ASK_QUESTION):
@@ -52,8 +67,11 @@ class User:
         if self._post is not None:
             return self._post
 
-        post = self.db.post.find_one({'_id': self.post_id}) or {}
-        args = dict(db=self.db, stackbot=self.stackbot, chat_id=self.chat_id, post_id=self.post_id)
+        post = self.identity_map.get(self.post_id)
+        args = dict(
+            db=self.db, stackbot=self.stackbot, chat_id=self.chat_id, post_id=self.post_id,
+            identity_map=self.identity_map,
+        )
         self._post = self.get_post_handler(self.state, post.get('type'))(**args)
 
         return self._post
@@ -65,16 +83,45 @@ class User:
 
         args = dict(
             db=post_handler.db, stackbot=post_handler.stackbot, chat_id=post_handler.chat_id,
-            is_gallery=post_handler.is_gallery, gallery_filters=post_handler.gallery_filters,
-            post_id=post_handler.post_id,
+            gallery=post_handler.gallery, post_id=post_handler.post_id, identity_map=self.identity_map,
         )
 
-        post_type = self.db.post.find_one({'_id': post_handler.post_id})['type']
+        post_type = self.identity_map.get(post_handler.post_id)['type']
         self._post = self.get_post_handler(self.state, post_type)(**args)
 
     @property
     def user(self):
-        return self.db.users.find_one({'chat.id': self.chat_id}) or {}
+        """
+        User document snapshot.
+
+        It is loaded once per update (or served from the process-wide user cache) and
+        kept in sync by the write methods of this class.
+        """
+        if self._user is None:
+            cached_user = user_cache.get(self.chat_id)
+            if cached_user is not None:
+                self._user = copy.deepcopy(cached_user)
+            else:
+                self.refresh()
+
+        return self._user
+
+    def refresh(self):
+        """
+        Reload user snapshot from database.
+        """
+        self._user = self.db.users.find_one({'chat.id': self.chat_id}) or {}
+        self._cache_snapshot()
+
+    def _cache_snapshot(self):
+        """
+        Write the snapshot through to the process-wide user cache. If the snapshot is not
+        loaded, the cached copy may be stale after a write, so it is dropped instead.
+        """
+        if self._user:
+            user_cache.set(self.chat_id, copy.deepcopy(self._user))
+        else:
+            user_cache.pop(self.chat_id)
 
     @property
     def state(self):
@@ -103,18 +150,25 @@ class User:
 
         User identity is set from settings menu.
         """
-        user = self.user
-        username = self.username
+        return self.get_identity(self.user)
+
+    @staticmethod
+    def get_identity(user: dict):
+        """
+        Get identity of a user document, e.g. to show the owners of many posts without loading each user.
+        """
+        chat_id = user['chat']['id']
+        username = user['chat'].get('username')
 
         identity_type = user['settings']['identity_type']
         if identity_type == inline_keys.ananymous:
-            return self.chat_id
+            return chat_id
         elif (identity_type == inline_keys.username) and (username is not None):
-            return username
+            return f'@{username}'
         elif identity_type == inline_keys.first_name:
-            return f"{user['chat']['first_name']} ({self.chat_id})"
+            return f"{user['chat']['first_name']} ({chat_id})"
 
-        return user['chat'].get(identity_type) or self.chat_id
+        return user['chat'].get(identity_type) or chat_id
 
     def send_message(
         self, text: str, reply_markup: Union[types.InlineKeyboardMarkup, types.ReplyKeyboardMarkup] = None,
@@ -129,7 +183,7 @@ class User:
         """
         message = self.stackbot.send_message(
             chat_id=self.chat_id, text=text, reply_markup=reply_markup,
-            emojize=emojize, delete_after=delete_after
+            emojize=emojize, delete_after=delete_after, post=self.post,
         )
 
         return message
@@ -137,7 +191,7 @@ class User:
     def edit_message(self, message_id, text=None, reply_markup=None, emojize: bool = True):
         self.stackbot.edit_message(
             chat_id=self.chat_id, message_id=message_id, text=text,
-            reply_markup=reply_markup, emojize=emojize
+            reply_markup=reply_markup, emojize=emojize, post=self.post,
         )
 
     def delete_message(self, message_id: str):
@@ -170,6 +224,9 @@ class User:
         :param state: New state.
         """
         self.db.users.update_one({'chat.id': self.chat_id}, {'$set': {'state': state}})
+        if self._user:
+            self._user['state'] = state
+        self._cache_snapshot()
 
     def reset(self):
         """
@@ -180,8 +237,13 @@ class User:
             {'chat.id': self.chat_id},
             {'$set': {'state': states.MAIN}, '$unset': {'tracker': 1}}
         )
+        if self._user:
+            self._user['state'] = states.MAIN
+            self._user.pop('tracker', None)
+        self._cache_snapshot()
 
         self.db.post.delete_one({'chat.id': self.chat_id, 'status': constants.post_status.PREP})
+        self.identity_map.invalidate()
 
     def register(self, message):
         logger.info('Registering user...')
@@ -191,6 +253,7 @@ class User:
             delete_after=False
         )
         self.db.users.update_one({'chat.id': message.chat.id}, {'$set': message.json}, upsert=True)
+        self.refresh()
         self.update_settings(identity_type=inline_keys.ananymous, muted_bot=False)
         self.reset()
 
@@ -199,10 +262,7 @@ class User:
         """
         Check if user exists in database.
         """
-        if self.db.users.find_one({'chat.id': self.chat_id}) is None:
-            return False
-
-        return True
+        return bool(self.user)
 
     def track(self, **kwargs):
         """
@@ -214,12 +274,19 @@ class User:
             {'chat.id': self.chat_id},
             {'$set': {'tracker': track_data}}
         )
+        if self._user:
+            self._user['tracker'] = track_data
+        self._cache_snapshot()
 
     def untrack(self, *args):
         self.db.users.update_one(
             {'chat.id': self.chat_id},
             {'$unset': {f'tracker.{arg}': 1 for arg in args}}
         )
+        if self._user:
+            for arg in args:
+                self._user.get('tracker', {}).pop(arg, None)
+        self._cache_snapshot()
 
     def update_settings(self, **kwargs):
         """
@@ -230,6 +297,9 @@ class User:
             {'chat.id': self.chat_id},
             {'$set': settings}
         )
+        if self._user:
+            self._user.setdefault('settings', {}).update(kwargs)
+        self._cache_snapshot()
 
     def stats(self):
         num_questions = self.db.post.count_documents({'chat.id': self.chat_id, 'type': post_types.QUESTION})
@@ -253,11 +323,16 @@ class User:
 
         :param key: Collection key to be toggled (push/pull)
         """
-        exists_flag = self.db.users.find_one({'chat.id': self.chat_id, field: field_value})
-
-        if exists_flag:
+        values = self.user.get(field, [])
+        if field_value in values:
             self.db.users.update_one({'chat.id': self.chat_id}, {'$pull': {field: field_value}})
+            values = [value for value in values if value != field_value]
         else:
             self.db.users.update_one(
                 {'chat.id': self.chat_id}, {'$addToSet': {field: field_value}}
             )
+            values = values + [field_value]
+
+        if self._user:
+            self._user[field] = values
+        self._cache_snapshot()
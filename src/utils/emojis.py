@@ -0,0 +1,104 @@
+import re
+from types import MappingProxyType
+
+import emoji
+from emoji import unicode_codes
+
+# Emoji names (e.g. :red_heart:) of emoji 1.5 and their unicode emoji
+EMOJI_UNICODE = unicode_codes.EMOJI_UNICODE['en']
+EMOJI_NAME_PATTERN = re.compile(u'(:[\\w\\-&.’”“()!#*+?–,/]+:)')
+
+# Unicode emoji and their names. Emoji are looked up by their first character, longest first.
+UNICODE_EMOJI = unicode_codes.UNICODE_EMOJI['en']
+EMOJI_LENGTHS = {}
+for unicode_emoji in UNICODE_EMOJI:
+    EMOJI_LENGTHS.setdefault(unicode_emoji[0], set()).add(len(unicode_emoji))
+EMOJI_LENGTHS = {char: sorted(lengths, reverse=True) for char, lengths in EMOJI_LENGTHS.items()}
+
+# Characters that may start an emoji: the few below U+2000 (e.g. '#' of keycaps) and the blocks of the
+# others. A class of every first character is slow to match, candidates are checked in EMOJI_LENGTHS.
+_low_chars = sorted(char for char in EMOJI_LENGTHS if char < '\u2000')
+_bmp_chars = sorted(char for char in EMOJI_LENGTHS if '\u2000' <= char <= '\uffff')
+_astral_chars = sorted(char for char in EMOJI_LENGTHS if char > '\uffff')
+EMOJI_START_PATTERN = re.compile(
+    '[' + ''.join(map(re.escape, _low_chars))
+    + f'{_bmp_chars[0]}-{_bmp_chars[-1]}{_astral_chars[0]}-{_astral_chars[-1]}]'
+)
+
+# Constant texts (keys, messages, statuses, ...) emojized once, and the reverse table to demojize them.
+# They are filled by load_constants when src/constants.py is imported and read only afterwards.
+emojized_texts = MappingProxyType({})
+demojized_texts = MappingProxyType({})
+
+
+def load_constants(*texts) -> None:
+    """
+    Emojize constant texts once and add them to the translation tables.
+    """
+    global emojized_texts, demojized_texts
+
+    emojized = dict(emojized_texts)
+    demojized = dict(demojized_texts)
+    for text in texts:
+        if isinstance(text, str):
+            emojized[text] = emoji.emojize(text)
+            demojized.setdefault(emojized[text], text)
+
+    emojized_texts = MappingProxyType(emojized)
+    demojized_texts = MappingProxyType(demojized)
+
+
+def replace_emoji_name(match) -> str:
+    return EMOJI_UNICODE.get(match.group(1), match.group(1))
+
+
+def emojize(text: str) -> str:
+    """
+    Replace emoji names in text with unicode emoji, same as emoji.emojize.
+
+    Constant texts are looked up in the translation table. Other texts (e.g. formatted messages)
+    are converted in a single pass of a precompiled pattern, and texts without ":" are not scanned.
+    """
+    emojized = emojized_texts.get(text)
+    if emojized is not None:
+        return emojized
+
+    if ':' not in text:
+        return text
+
+    return EMOJI_NAME_PATTERN.sub(replace_emoji_name, text)
+
+
+def demojize(text: str) -> str:
+    """
+    Replace unicode emoji in text with emoji names, same as emoji.demojize.
+
+    Keys sent by the keyboards are looked up in the reverse translation table. Emoji are never
+    ASCII, so ASCII texts (e.g. commands, callback data) are returned as they are. Other free-form
+    text is converted in a single pass: only characters that start an emoji are looked up, and the
+    longest emoji starting there is replaced, as the emoji library does with its regex of all emoji.
+    """
+    demojized = demojized_texts.get(text)
+    if demojized is not None:
+        return demojized
+
+    if text.isascii():
+        return text
+
+    parts = []
+    position = 0
+    match = EMOJI_START_PATTERN.search(text)
+    while match:
+        start = match.start()
+        for length in EMOJI_LENGTHS.get(text[start], ()):
+            name = UNICODE_EMOJI.get(text[start:start + length])
+            if name is not None:
+                parts.append(text[position:start])
+                parts.append(name)
+                position = start + length
+                break
+
+        match = EMOJI_START_PATTERN.search(text, max(position, start + 1))
+
+    parts.append(text[position:])
+    return ''.join(parts).replace(u'\ufe0f', '')
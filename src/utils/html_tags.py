@@ -0,0 +1,43 @@
+import re
+
+# Tags of telegram html (https://core.telegram.org/bots/api#html-style)
+TELEGRAM_TAGS = frozenset({
+    'b', 'strong', 'i', 'em', 'u', 'ins', 's', 'strike', 'del',
+    'code', 'pre', 'a', 'span', 'tg-spoiler',
+})
+TAG_PATTERN = re.compile(r'<(/?)([a-zA-Z][\w-]*)[^>]*>')
+# Entity cut in the middle at the end of text, e.g. '&am' of '&amp;'
+PARTIAL_ENTITY_PATTERN = re.compile(r'&#?\w*$')
+
+
+def close_open_tags(text: str) -> str:
+    """
+    Close the tags left open in the beginning part of telegram html, e.g. of a truncated post.
+
+    Tags are matched in a single pass and the text is returned as it is, followed by the closing
+    tags. A tag or an entity cut in the middle at the end of text (e.g. '<a' of '<a href="...">'
+    or '&am' of '&amp;') is dropped, as telegram can't parse it.
+
+    :param text: Beginning part of a telegram html text.
+    :return: Text with all its tags closed.
+    """
+    # Text is escaped by telegram (&lt;), so "<" always starts a tag
+    tag_start = text.rfind('<')
+    if tag_start > text.rfind('>'):
+        text = text[:tag_start]
+    text = PARTIAL_ENTITY_PATTERN.sub('', text)
+
+    open_tags = []
+    for match in TAG_PATTERN.finditer(text):
+        is_closing, tag = match.group(1), match.group(2).lower()
+        if tag not in TELEGRAM_TAGS:
+            continue
+
+        if not is_closing:
+            open_tags.append(tag)
+        elif tag in open_tags:
+            # Telegram tags are nested, so the closing tag closes the last open tag with its name
+            while open_tags.pop() != tag:
+                pass
+
+    return text + ''.join(f'</{tag}>' for tag in reversed(open_tags))
@@ -1,15 +1,56 @@
-import emoji
+from functools import lru_cache
+from typing import Tuple
+
 from loguru import logger
+from src.utils.emojis import emojize
 from telebot import types
 
+# Number of distinct keyboard layouts and button labels kept compiled in memory
+KEYBOARD_CACHE_SIZE = 1024
+
+# Labels repeat across renders (only counts and page numbers change), so they are emojized once
+emojize_label = lru_cache(maxsize=KEYBOARD_CACHE_SIZE)(emojize)
+
+
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def compile_inline_layout(callback_data: Tuple[str], row_width: int) -> Tuple:
+    """
+    Compile the layout of an inline keyboard: the order of its keys and where rows break.
+
+    Keys are sorted by their group in inline_keys_groups and a new row starts when the group
+    changes by 10 or more, or when a row has row_width keys. The layout only depends on the
+    callback data of the keys, so it is computed once for each distinct keyboard.
+
+    :param callback_data: Callback data of the keys, in the order they are given.
+    :param row_width: Maximum number of keys in a row.
+    :return: Rows of (key index, callback data sent to telegram).
+    """
+    from src.constants import callback_codes, inline_keys_groups
+
+    sort_by_array = [inline_keys_groups.get(callback, ind + 100) for ind, callback in enumerate(callback_data)]
+    sorted_indexes = sorted(range(len(callback_data)), key=lambda ind: sort_by_array[ind])
+
+    groups = []
+    old_value = None
+    for ind in sorted_indexes:
+        if old_value is None or sort_by_array[ind] - old_value >= 10:
+            groups.append([])
+        old_value = sort_by_array[ind]
+
+        callback = callback_data[ind]
+        groups[-1].append((ind, callback_codes.get(callback, callback)))
+
+    return tuple(
+        tuple(group[start:start + row_width])
+        for group in groups for start in range(0, len(group), row_width)
+    )
+
 
 def create_keyboard(
     *keys,
     reply_row_width=2, inline_row_width=4,
     resize_keyboard=True, is_inline=False, callback_data=None
 ):
-    from src.constants import inline_keys
-    from src.constants import inline_keys_groups
     """
     Create a keyboard with buttons.
 
@@ -18,8 +59,8 @@ def create_keyboard(
     :param resize_keyboard: Resize keyboard to small ones (works with reply keys only, not inline keys).
     :param is_inline: If True, create inline keyboard.
     :param callback_data: If not None, use keys text as callback data.
+        Inline keys are sent with their compact code (constants.callback_codes) as callback data.
     """
-    keys = list(keys)
     if callback_data and (len(keys) != len(callback_data)):
         logger.warning('Callback data length is not equal to keys length. Some keys will be missing.')
 
@@ -32,32 +73,23 @@ def create_keyboard(
         if callback_data is None:
             callback_data = keys
 
-        sort_by_array = [inline_keys_groups.get(callback, ind + 100) for ind, callback in enumerate(callback_data)]
-
-        print(keys, callback_data, sort_by_array)
-        sorted_array = sorted(zip(sort_by_array, keys, callback_data), key=lambda x: x[0])
-        print(sorted_array)
+        # Keys with dynamic labels (e.g. number of likes, page number) keep their callback data,
+        # so every render of the same keyboard reuses its compiled layout.
+        num_keys = min(len(keys), len(callback_data))
+        layout = compile_inline_layout(tuple(callback_data[:num_keys]), inline_row_width)
 
-        old_value = sorted_array[0][0]
-        buttons = []
+        # Buttons are created on every call, as their callback data is encoded per message
         markup = types.InlineKeyboardMarkup(row_width=inline_row_width)
-
-        for sort_by, key, callback in sorted_array:
-            if sort_by - old_value >= 10:
-                markup.add(*buttons)
-                buttons = []
-
-            old_value = sort_by
-            key = emoji.emojize(key)
-            button = types.InlineKeyboardButton(key, callback_data=callback)
-            buttons.append(button)
-
-        markup.add(*buttons)
+        for row in layout:
+            markup.row(*[
+                types.InlineKeyboardButton(emojize_label(keys[ind]), callback_data=callback)
+                for ind, callback in row
+            ])
         return markup
 
     else:
         # create reply keyboard
-        keys = list(map(emoji.emojize, keys))
+        keys = list(map(emojize_label, keys))
         markup = types.ReplyKeyboardMarkup(
             row_width=reply_row_width,
             resize_keyboard=resize_keyboard
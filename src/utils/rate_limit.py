@@ -0,0 +1,89 @@
+import threading
+import time
+
+from src.utils.cache import TTLCache
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Tokens are refilled at rate per second up to capacity
+    and every acquire takes one token, waiting for it if the bucket is empty.
+    """
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: Number of tokens added per second.
+        :param capacity: Maximum number of tokens (burst size). Defaults to rate.
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """
+        Take one token if available.
+
+        :return: 0 if token is taken, otherwise seconds to wait before trying again.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Take one token, blocking until it is available.
+        """
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Do not give any tokens for the next seconds, e.g. when Telegram asks to retry after a while.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Rate limiter of outgoing messages with a global limit and a limit per chat.
+    """
+    def __init__(self, rate: float, chat_rate: float, max_chats: int = 100000):
+        """
+        :param rate: Messages per second over all chats.
+        :param chat_rate: Messages per second to a single chat.
+        :param max_chats: Maximum number of chat buckets kept in memory.
+        """
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(rate)
+
+        # A chat bucket that has not been used for a minute is full again, so it can be dropped.
+        self.chat_buckets = TTLCache(maxsize=max_chats, ttl=60)
+        self._lock = threading.Lock()
+
+    def acquire(self, chat_id: int) -> None:
+        with self._lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate)
+            self.chat_buckets.set(chat_id, bucket)
+
+        bucket.acquire()
+        self.global_bucket.acquire()
+
+    def pause(self, seconds: float) -> None:
+        self.global_bucket.pause(seconds)
@@ -0,0 +1,115 @@
+import hmac
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from loguru import logger
+from telebot import types
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    """
+    Lightweight HTTP server that receives Telegram updates (webhook mode).
+
+    Updates are validated with the secret token and handed to the update dispatcher, which
+    processes them in order per chat. When the lane of the chat is full the server answers with 503,
+    so Telegram sends the update again later instead of it being lost.
+
+    Secret token is accepted either in the X-Telegram-Bot-Api-Secret-Token header or as the
+    URL path (https://host/<secret_token>). GET <secret_token>/stats returns the dispatcher stats.
+    Requests with a body larger than max_body_size are answered with 413 without reading the body.
+    """
+    def __init__(
+        self, dispatcher, secret_token: str, host: str = '0.0.0.0', port: int = 8443,
+        max_body_size: int = 1024 * 1024,
+    ):
+        """
+        :param dispatcher: Started UpdateDispatcher that processes the updates.
+        :param secret_token: Secret token that every request must carry.
+        :param host: Host to listen on.
+        :param port: Port to listen on.
+        :param max_body_size: Maximum size of an update in bytes.
+        """
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+        self.max_body_size = max_body_size
+        self.httpd = ThreadingHTTPServer((host, port), self.create_request_handler())
+
+    def serve_forever(self):
+        logger.info(f'Webhook server is listening on {self.httpd.server_address}...')
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def is_authorized(self, path: str, headers) -> bool:
+        token = headers.get(SECRET_TOKEN_HEADER) or path.strip('/')
+        return hmac.compare_digest(token.encode(), self.secret_token.encode())
+
+    def submit(self, update_json: dict) -> bool:
+        """
+        Queue update for processing.
+
+        :param update_json: Telegram update. A bare message (e.g. src/data/message.json)
+            is accepted as well, which is handy for replaying recorded messages locally.
+        :return: False if the lane of the chat is full.
+        """
+        if 'update_id' not in update_json and 'message_id' in update_json:
+            update_json = {'update_id': 0, 'message': update_json}
+
+        return self.dispatcher.submit(types.Update.de_json(update_json), block=False)
+
+    def create_request_handler(self):
+        server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                token, _, resource = self.path.strip('/').partition('/')
+                if resource != 'stats' or not server.is_authorized(token, {}):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = json.dumps(server.dispatcher.stats()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                if not server.is_authorized(self.path, self.headers):
+                    self.send_response(403)
+                    self.end_headers()
+                    return
+
+                try:
+                    content_length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    content_length = -1
+
+                if not 0 <= content_length <= server.max_body_size:
+                    # Updates are a few kilobytes, the body is not read into memory
+                    self.send_response(413 if content_length > 0 else 400)
+                    self.send_header('Connection', 'close')
+                    self.end_headers()
+                    self.close_connection = True
+                    return
+
+                try:
+                    submitted = server.submit(json.loads(self.rfile.read(content_length)))
+                except Exception as e:
+                    logger.debug(f'Invalid update: {e}')
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+
+                self.send_response(200 if submitted else 503)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        return RequestHandler
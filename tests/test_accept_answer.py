@@ -0,0 +1,64 @@
+from unittest import mock
+
+import pytest
+from bson.objectid import ObjectId
+from src.constants import post_status, post_types
+from src.data_models import answer as answer_module
+from src.data_models.answer import Answer
+from src.data_models.identity_map import PostIdentityMap
+from src.search import SearchIndex
+
+
+@pytest.fixture
+def posts():
+    question = {
+        '_id': ObjectId(), 'type': post_types.QUESTION, 'status': post_status.OPEN, 'chat': {'id': 1},
+        'raw_text': 'How to merge two dictionaries in python?', 'replied_to_post_id': None,
+    }
+    answer = {
+        '_id': ObjectId(), 'type': post_types.ANSWER, 'status': post_status.OPEN, 'chat': {'id': 2},
+        'replied_to_post_id': question['_id'],
+    }
+    return {question['_id']: question, answer['_id']: answer}
+
+
+@pytest.fixture
+def search_index(tmp_path, monkeypatch, posts):
+    index = SearchIndex(tmp_path)
+    for post in posts.values():
+        index.index_post(post)
+
+    monkeypatch.setattr(answer_module, 'search_index', index)
+    return index
+
+
+@pytest.fixture
+def answer(posts):
+    db = mock.MagicMock()
+    db.post.find_one.side_effect = lambda query, projection=None: posts.get(query['_id'])
+
+    answer_id = next(post_id for post_id, post in posts.items() if post['type'] == post_types.ANSWER)
+    answer = Answer(db=db, stackbot=mock.MagicMock(), post_id=answer_id, chat_id=1, identity_map=PostIdentityMap(db))
+    answer.send_to_many = mock.MagicMock()
+    return answer
+
+
+def test_accept_answer_removes_question_from_search(answer, posts, search_index):
+    assert search_index.search('merge dictionaries')
+
+    answer.accept_answer()
+    assert search_index.search('merge dictionaries') == []
+    assert search_index.similar('How to merge two dictionaries in python?') == []
+
+
+def test_unaccept_answer_adds_question_to_search(answer, posts, search_index):
+    question = answer.question
+    answer.accept_answer()
+
+    # Accepted answer is stored on the question by the update above
+    question.update({'status': post_status.RESOLVED, 'accepted_answer': answer.post_id})
+    answer.identity_map.invalidate()
+    answer.accept_answer()
+
+    results = search_index.search('merge dictionaries')
+    assert [post_id for post_id, _ in results] == [question['_id']]
@@ -0,0 +1,30 @@
+import pytest
+from src.constants import MESSAGE_SPLIT_CHAR_LIMIT
+from src.data_models.base import BasePost
+from src.utils.html_tags import close_open_tags
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('plain text', 'plain text'),
+    ('<b>bold <i>italic', '<b>bold <i>italic</i></b>'),
+    ('<b>a</b> <i>b', '<b>a</b> <i>b</i>'),
+    ('<pre>line\n    indented', '<pre>line\n    indented</pre>'),
+    ('<a href="https://example.com">link</a> <span class="tg-spoiler">secret', (
+        '<a href="https://example.com">link</a> <span class="tg-spoiler">secret</span>'
+    )),
+    ('text <a', 'text '),
+    ('<b>Tom &amp; Jerry &am', '<b>Tom &amp; Jerry </b>'),
+    ('x &#12', 'x '),
+    ('x &lt; y', 'x &lt; y'),
+])
+def test_close_open_tags(text, expected):
+    assert close_open_tags(text) == expected
+
+
+def test_truncate_post_text_cut_inside_entity():
+    # Text without spaces is cut at the char limit, right after the "&" of "&amp;"
+    post_text = '<b>' + 'a' * (MESSAGE_SPLIT_CHAR_LIMIT - 4) + '&amp;' + 'b' * MESSAGE_SPLIT_CHAR_LIMIT + '</b>'
+
+    truncated_text, needs_truncation = BasePost.truncate_post_text(post_text)
+    assert needs_truncation
+    assert truncated_text == '<b>' + 'a' * (MESSAGE_SPLIT_CHAR_LIMIT - 4) + '</b>'